@@ -1,27 +1,23 @@
 import sys
 import os
-import subprocess
 import json
 import argparse
 import datetime as dt
 from utils.bars import Bar
-import email_trades
+from utils.file_follower import FileFollower
+from notifier import TradeNotifier
+from utils.latency import LatencyRecorder
 from config import EMAIL_RECIPIENTS
 
 BARS_DIR = "bars"
 bar_count = 0
 max_secs = -1
 last_bar = None
-bars_closed = []
-bars = []
-bars_current_one_minute = []
-num_trades = 0
-current_trade = None
-total_profit = 0
-total_trades = 0
 
 BRACKET_UP = 2.0
 BRACKET_DOWN = 4.0
+NUM_UP_BARS = 2
+NUM_UP_TICKS = 3
 
 def is_now(datetime):
     """Determine if the datetime is within 5 seconds of now.
@@ -70,7 +66,6 @@ def get_close_bar_minute_gaps(line):
     bar_count += 1
     global max_secs
     global last_bar
-    global total_profit
     
     bar = Bar(line)
     if bar.is_open == False:
@@ -84,7 +79,7 @@ def get_close_bar_minute_gaps(line):
             max_secs = temp_max_secs
         last_bar = bar
 
-def main(ticker, date):
+def main(ticker, date, resume=True):
     
     print(f"Retrieving data for {ticker} on {date}")
     
@@ -93,25 +88,34 @@ def main(ticker, date):
     if os.path.exists(filename) is False:
         print(f"File {filename} does not exist")
         return
-    f = subprocess.Popen(['tail','-F', '-n 100000', filename],\
-        stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-    while True:
-        line = f.stdout.readline()
-        #get_close_bar_minute_gaps(line)
-        bar = Bar(line)
-        strategy1(bar)
+    # Follow the file from the last checkpoint, moving to the next day's file at midnight
+    follower = FileFollower(BARS_DIR, ticker, date, name="bar_study", resume=resume)
+    latency = LatencyRecorder("bar_study")
+    strategy = Strategy1(notifier=TradeNotifier(EMAIL_RECIPIENTS, latency=latency))
+    # Bars received before the start are a backlog, not a measure of latency
+    started = dt.datetime.now()
+    for lines in follower.batches():
+        for line in lines:
+            #get_close_bar_minute_gaps(line)
+            bar = Bar(line)
+            if bar.datetime >= started:
+                latency.record('receipt_to_strategy', (dt.datetime.now() - bar.datetime).total_seconds(), ticker)
+            strategy.on_bar(bar)
         
 class Trade:
     
-    def __init__(self, bar: Bar, direction: int):
+    def __init__(self, bar: Bar, direction: int, bracket_up: float = BRACKET_UP,
+                 bracket_down: float = BRACKET_DOWN):
         self.bar = bar
         self.direction = direction
+        self.bracket_up = bracket_up
+        self.bracket_down = bracket_down
         
     def should_sell(self, bar: Bar):
         # If the direction is 1, we are looking for a sell
         # Sell if the bar is up 2 points or mor, or down 4 ponints or more.
         if self.direction == 1:
-            if bar.close - self.bar.close >= BRACKET_UP or self.bar.close - bar.close >= BRACKET_DOWN:
+            if bar.close - self.bar.close >= self.bracket_up or self.bar.close - bar.close >= self.bracket_down:
                 return True
         return False
     
@@ -119,7 +123,7 @@ class Trade:
         # If the direction is -1, we are looking for a buy
         # Buy if the bar is down 2 points or more, or up 4 points or more.
         if self.direction == -1:
-            if self.bar.close - bar.close >= BRACKET_UP or bar.close - self.bar.close >= BRACKET_DOWN:
+            if self.bar.close - bar.close >= self.bracket_up or bar.close - self.bar.close >= self.bracket_down:
                 return True
         return False
     
@@ -136,97 +140,119 @@ class Trade:
             return self.bar.close - current_bar.close
         
         
-def strategy1(bar: Bar):
-    """First try at a strategy
-    Args:
-        bar (Bar): The bar to process
-    Returns:
-        None
-    """
-    global bars_closed
-    global bars
-    global num_trades
-    global bars_current_one_minute
-    global current_trade
-    global total_profit
-    global total_trades
-    
-    # Only during the trading day!
-    if not bar.is_during_day():
-        return
-    
-    # If closed, add to the list of closed bars
-    if bar.is_open == False:
-        bars_closed.append(bar)
-        if current_trade != None:
-            print("\n")
-        print(f"Bars closed {bar.get_local_time()}, volume: ({bar.up_volume-bar.down_ticks}), {bar.down_volume}, {bar.up_volume} [{total_profit}:{num_trades}]")
-        bars_current_one_minute = []
-        return
-    
-    # If the bar is not closed, add it to the list of current one-minute bars
-    bars_current_one_minute.append(bar)
-    
-    if current_trade != None:
-        if current_trade.should_sell(bar):
-            print(f"\n**SELL {bar.get_local_time()}, close: {bar.close}, profit: {current_trade.profit(bar)}")
-            total_profit += current_trade.profit(bar)
-            
-            if is_now(bar.datetime):
-                for recipient in EMAIL_RECIPIENTS:
-                    email_trades.send_email(recipient, f"SELL", f"**SELL  {bar.get_local_time()}, close: {bar.close}, total_profit: {total_profit}", None)
+class Strategy1:
+    """First try at a strategy. Buy when the last num_up_bars closed bars
+    were up bars and the open bar has num_up_ticks up ticks, sell when the
+    price is bracket_up above or bracket_down below the entry."""
+
+    def __init__(self, bracket_up: float = BRACKET_UP, bracket_down: float = BRACKET_DOWN,
+                 num_up_bars: int = NUM_UP_BARS, num_up_ticks: int = NUM_UP_TICKS,
+                 live: bool = True, notifier: TradeNotifier = None):
+        """Constructor
+        Args:
+            bracket_up (float): Points above the entry to take the profit
+            bracket_down (float): Points below the entry to stop the loss
+            num_up_bars (int): Number of previous closed bars that must be up
+            num_up_ticks (int): Number of up ticks of the open bar before buying
+            live (bool): Print the progress and email the trades happening now.
+                False when evaluating recorded bars, e.g. in a parameter sweep.
+            notifier (TradeNotifier): Sends the trade emails, one to
+                EMAIL_RECIPIENTS is started if None and live
+        """
+        self.bracket_up = bracket_up
+        self.bracket_down = bracket_down
+        self.num_up_bars = num_up_bars
+        self.num_up_ticks = num_up_ticks
+        self.live = live
+        if notifier is None and live:
+            notifier = TradeNotifier(EMAIL_RECIPIENTS)
+        self.notifier = notifier
+        self.bars_closed = []
+        self.bars_current_one_minute = []
+        self.current_trade = None
+        self.num_trades = 0
+        self.total_profit = 0
+        self.peak_profit = 0
+        self.max_drawdown = 0
 
+    def _close_trade(self, bar: Bar) -> None:
+        """Realize the profit of the current trade"""
+        self.total_profit += self.current_trade.profit(bar)
+        self.peak_profit = max(self.peak_profit, self.total_profit)
+        self.max_drawdown = max(self.max_drawdown, self.peak_profit - self.total_profit)
+        self.current_trade = None
+
+    def on_bar(self, bar: Bar) -> None:
+        """Process a bar update
+        Args:
+            bar (Bar): The bar to process
+        Returns:
+            None
+        """
+        # Only during the trading day!
+        if not bar.is_during_day():
+            return
+
+        # If closed, add to the list of closed bars
+        if bar.is_open == False:
+            self.bars_closed.append(bar)
+            if self.live:
+                if self.current_trade != None:
+                    print("\n")
+                print(f"Bars closed {bar.get_local_time()}, volume: ({bar.up_volume-bar.down_ticks}), {bar.down_volume}, {bar.up_volume} [{self.total_profit}:{self.num_trades}]")
+            self.bars_current_one_minute = []
+            return
+
+        # If the bar is not closed, add it to the list of current one-minute bars
+        self.bars_current_one_minute.append(bar)
+
+        if self.current_trade != None:
+            if self.current_trade.should_sell(bar):
+                profit = self.current_trade.profit(bar)
+                self._close_trade(bar)
+                if self.live:
+                    print(f"\n**SELL {bar.get_local_time()}, close: {bar.close}, profit: {profit}")
+                    if is_now(bar.datetime):
+                        self.notifier.notify(f"SELL", f"**SELL  {bar.get_local_time()}, close: {bar.close}, total_profit: {self.total_profit}")
+                    print(f"Total profit: {self.total_profit}")
+            """elif current_trade.should_buy(bar):
+                print(f"\n**BUY {bar.get_local_time()}, close: {bar.close}, profit: {current_trade.profit(bar)}")
+                total_profit += current_trade.profit(bar)
+                print(f"Total profit: {total_profit}")
+                current_trade = None"""
+            if self.current_trade != None and self.live:
+                print(f"{self.current_trade.profit(bar)}" , end=",", flush=True)
+            return
+
+        if Bar.are_previous_up_bars(self.bars_closed, self.num_up_bars):
+            if Bar.are_last_n_ticks_up(self.bars_current_one_minute, self.num_up_ticks):
+                self.num_trades += 1
+                if self.live:
+                    print(f"**BUY  {bar.get_local_time()}, close: {bar.close}")
+                    if is_now(bar.datetime):
+                        self.notifier.notify(f"Buy", f"**BUY  {bar.get_local_time()}, close: {bar.close}")
+                self.current_trade = Trade(bar, 1, self.bracket_up, self.bracket_down)
+        """if Bar.are_previous_down_bars(bars_closed, 2):
+            if Bar.are_last_n_ticks_down(bars_current_one_minute, 3):
+                num_trades += 1
+                print(f"**SELL  {bar.get_local_time()}, close: {bar.close}")
+                current_trade = Trade(bar, -1)"""
 
-            print(f"Total profit: {total_profit}")
-            current_trade = None
-        """elif current_trade.should_buy(bar):
-            print(f"\n**BUY {bar.get_local_time()}, close: {bar.close}, profit: {current_trade.profit(bar)}")
-            total_profit += current_trade.profit(bar)
-            print(f"Total profit: {total_profit}")
-            current_trade = None"""
-        if current_trade != None:
-            print(f"{current_trade.profit(bar)}" , end=",", flush=True)
-        return
-    
-    if Bar.are_previous_up_bars(bars_closed, 2):
-        if Bar.are_last_n_ticks_up(bars_current_one_minute, 3):
-            num_trades += 1
-            print(f"**BUY  {bar.get_local_time()}, close: {bar.close}")
-            
-            if is_now(bar.datetime):
-                for recipient in EMAIL_RECIPIENTS:
-                    email_trades.send_email(recipient, f"Buy", f"**BUY  {bar.get_local_time()}, close: {bar.close}", None)
-            current_trade = Trade(bar, 1)
-            """print("BARS CLOSED")
-            for bar in bars_closed[-2:]:
-                print(f"{bar.datetime} {bar.open} {bar.close}")
-            print("ONE_MINUTES")
-            last = None
-            for bar in bars_current_one_minute[-3:]:
-                print(f"{bar.datetime} {bar.close}")"""
-            #sys.exit(0)
-            """print(f"Number of trades: {num_trades}")
-            print(f"Bars closed: {len(bars_closed)}")
-            print(f"TRADE {num_trades} {bar.datetime}")"""
-    """if Bar.are_previous_down_bars(bars_closed, 2):
-        if Bar.are_last_n_ticks_down(bars_current_one_minute, 3):
-            num_trades += 1
-            print(f"**SELL  {bar.get_local_time()}, close: {bar.close}")
-            current_trade = Trade(bar, -1)"""
-        
-    #print(f"Bars closed: {len(bars_closed)}, num_trades: {num_trades}")
-    
 if __name__ == '__main__':
     
     parser = argparse.ArgumentParser(description='Retrieves data from TradeStation and sends it to a redis-stream.')
 
     parser.add_argument('ticker')
     parser.add_argument('date')
+    parser.add_argument('-s', '--from_start', action='store_true', help='Read \
+                            the file from the start instead of resuming from \
+                            the last checkpoint.')
     
     ticker = parser.parse_args().ticker
     date = parser.parse_args().date
+    from_start = parser.parse_args().from_start
     
-    main(ticker, date)  # Call the main function
+    main(ticker, date, not from_start)  # Call the main function
     
 
     
@@ -0,0 +1,134 @@
+import os
+import sys
+import random
+import argparse
+import itertools
+import tempfile
+import time
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+from utils.bar_loader import load_bar_logs, to_bars
+from utils.snapshot_store import read_snapshots, to_bar_array
+from bar_study import Strategy1, BARS_DIR
+
+"""
+Parameter sweep of bar_study's Strategy1 over recorded bar logs.
+
+The bar logs are parsed once into a NumPy structured array that is saved to
+a temporary .npy file. Each worker of the process pool memory-maps it
+read-only and builds its list of bars once, then evaluates its share of the
+parameter sets. The result is a table ranked by profit with the number of
+trades and the maximum drawdown of each parameter set.
+"""
+
+# The default grid, every combination is evaluated unless sampled
+GRID = {
+    'bracket_up': [1.0, 1.5, 2.0, 3.0, 4.0],
+    'bracket_down': [2.0, 3.0, 4.0, 6.0, 8.0],
+    'num_up_bars': [1, 2, 3],
+    'num_up_ticks': [1, 2, 3, 4, 5],
+}
+
+# The bars of the worker, set by _init_worker
+_bars = None
+
+def _init_worker(bars_filename: str) -> None:
+    """Pool initializer, builds the bars from the shared memory-mapped array"""
+    global _bars
+    _bars = to_bars(np.load(bars_filename, mmap_mode='r'))
+
+def evaluate(params: dict, bars: list = None) -> dict:
+    """Run Strategy1 with a parameter set over the bars.
+    Args:
+        params (dict): The keyword arguments of Strategy1
+        bars (list): The bars, the worker's bars if None
+    Returns:
+        dict: The parameters with total_profit, num_trades and max_drawdown
+    """
+    strategy = Strategy1(live=False, **params)
+    for bar in _bars if bars is None else bars:
+        strategy.on_bar(bar)
+    return dict(params, total_profit=strategy.total_profit, num_trades=strategy.num_trades,
+                max_drawdown=strategy.max_drawdown)
+
+def parameter_sets(grid: dict, samples: int = None, seed: int = 0) -> list:
+    """Get the parameter sets of a grid.
+    Args:
+        grid (dict): The values of each parameter
+        samples (int): Number of parameter sets drawn at random from the
+            grid, None for all of them
+        seed (int): The seed of the random sample
+    Returns:
+        list: A list of dicts of parameters
+    """
+    names = list(grid.keys())
+    sets = [dict(zip(names, values)) for values in itertools.product(*grid.values())]
+    if samples is not None and samples < len(sets):
+        sets = random.Random(seed).sample(sets, samples)
+    return sets
+
+def sweep(filenames: list, sets: list, processes: int = None) -> pd.DataFrame:
+    """Evaluate the parameter sets over the bar logs in a process pool.
+    Args:
+        filenames (list): The bar log files, or .snap snapshot files, in time order
+        sets (list): The parameter sets
+        processes (int): The number of worker processes, None for one per CPU
+    Returns:
+        pd.DataFrame: One row per parameter set ranked by total_profit,
+            then by the smallest max_drawdown
+    """
+    if all(filename.endswith('.snap') for filename in filenames):
+        bars = np.concatenate([to_bar_array(read_snapshots(filename)) for filename in filenames])
+    else:
+        bars = load_bar_logs(filenames, processes=processes)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bars_filename = os.path.join(tmp_dir, "bars.npy")
+        np.save(bars_filename, bars)
+        with Pool(processes, initializer=_init_worker, initargs=(bars_filename,)) as pool:
+            results = pool.map(evaluate, sets, chunksize=max(1, len(sets) // (8 * (processes or os.cpu_count()))))
+    table = pd.DataFrame(results)
+    if len(table) == 0:
+        return table
+    return table.sort_values(['total_profit', 'max_drawdown'], ascending=[False, True]).reset_index(drop=True)
+
+def _parse_values(text: str, type_) -> list:
+    return [type_(value) for value in text.split(',')]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Sweeps the Strategy1 parameters over recorded bar logs.')
+    parser.add_argument('ticker')
+    parser.add_argument('dates', nargs='+', help='The dates, YYYYMMDD, of the bars/<date>/<ticker>.log files')
+    parser.add_argument('--bracket_up', help='Comma separated values of bracket_up')
+    parser.add_argument('--bracket_down', help='Comma separated values of bracket_down')
+    parser.add_argument('--num_up_bars', help='Comma separated values of num_up_bars')
+    parser.add_argument('--num_up_ticks', help='Comma separated values of num_up_ticks')
+    parser.add_argument('-n', '--samples', type=int, help='Evaluate a random sample of this many parameter sets')
+    parser.add_argument('-p', '--processes', type=int, help='Number of worker processes')
+    parser.add_argument('-t', '--top', type=int, default=20, help='Number of rows to print')
+    parser.add_argument('-o', '--output', help='Write the whole table to this CSV file')
+    parser.add_argument('-s', '--snapshots', action='store_true', help='Read the \
+                            bars/<date>/<ticker>.snap snapshot files instead of the logs')
+    args = parser.parse_args()
+
+    grid = dict(GRID)
+    for name in GRID:
+        if getattr(args, name) is not None:
+            grid[name] = _parse_values(getattr(args, name), float if name.startswith('bracket') else int)
+
+    extension = "snap" if args.snapshots else "log"
+    filenames = [os.path.join(BARS_DIR, date, f"{args.ticker}.{extension}") for date in args.dates]
+    missing = [filename for filename in filenames if not os.path.exists(filename)]
+    if len(missing) > 0:
+        print(f"Files do not exist: {', '.join(missing)}")
+        sys.exit(1)
+
+    sets = parameter_sets(grid, args.samples)
+    start = time.time()
+    table = sweep(filenames, sets, args.processes)
+    print(f"Evaluated {len(sets)} parameter sets in {time.time() - start:.1f} seconds")
+    print(table.head(args.top).to_string())
+    if args.output is not None:
+        table.to_csv(args.output, index=False)
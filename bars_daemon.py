@@ -1,21 +1,29 @@
 from io import TextIOWrapper
 import os
+import time
+import signal
+import argparse
 import sys
 from datetime import datetime as dt
-from datetime import timedelta
-import requests
+from datetime import timedelta, timezone
 import asyncio
 import json
 import MySQLdb as mdb
 import numpy as np
-from logger.logger import Logger
+from logger.logger import Logger, WARNING
 from processes.processes import Processes
+from processes.supervisor import Heartbeat
 from scipy.stats import linregress
 from ts_auth0 import TS_Auth
 current = os.path.dirname(os.path.realpath(__file__))
 parent = os.path.dirname(current)
 sys.path.append(parent)
 from utils.datetime_utils import *
+from utils.async_stream import open_stream
+from utils.bar_journal import BarJournalWriter
+from utils.snapshot_store import SnapshotWriter
+from utils.shm_bus import BarBusWriter
+from utils.latency import LatencyRecorder
 from config import API_KEY, API_SECRET_KEY
 from config import API_BASE_URL, API_STREAM_BARCHARTS_URI
 
@@ -23,38 +31,95 @@ LOG_NAME = "bars_d"
 BARS_DIR = "bars"
 REQUEST_TIMEOUT = 10.0
 
+# Seconds before reopening a stream refused with an error status, doubled
+# on each refusal up to MAX_RETRY_SECONDS
+RETRY_SECONDS = 1.0
+MAX_RETRY_SECONDS = 60.0
+
+# Most stream lines and bar writes logged per second and ticker, the
+# others are counted in the periodic summaries of the logger
+LINE_LOG_PER_SECOND = 1.0
+BAR_LOG_PER_SECOND = 0.2
+
+# Seconds without a line, bar or stream heartbeat, from a ticker before the
+# process stops sending heartbeats to the supervisor
+STREAM_STALE_SECONDS = 30.0
+
+# Group commit policy of the binary bar journals and snapshot files
+BINARY_FLUSH_RECORDS = 100
+BINARY_FLUSH_MS = 500.0
+
 BAR_DOJI = "----"
 BAR_UP = u'\u2191'
 BAR_DOWN = u'\u2193'
 BAR_UP = ' UP '
 BAR_DOWN = 'DOWN'
 
-async def loop(ts: TS_Auth, tickers: list, logger: Logger) -> None:
+async def loop(ts: TS_Auth, tickers: list, logger: Logger, binary: bool = False,
+               snapshots: bool = False, shared_memory: bool = False) -> None:
     """Create and start the tasks for each ticker.
     Args:
         ts (TS_Auth): The TS_Auth object
         tickers (list): The list of tickers
         logger (Logger): The logger object
+        binary (bool): Write binary bar journals instead of JSON lines
+        snapshots (bool): Write delta encoded snapshot files instead
+        shared_memory (bool): Also publish the bars to the shared memory
+            bar bus read by the strategies on this host
     Returns:
         None
     """
 
     logger.info(f"Starting loop for {tickers}")
-    tasks = []
+    bus = BarBusWriter(tickers) if shared_memory else None
+    latency = LatencyRecorder(LOG_NAME)
+    last_lines = {}
+    files = {}
+    tasks = [send_heartbeats(tickers, last_lines, logger)]
     for ticker in tickers:
-        tasks.append(stream_bars(ts, ticker, logger))
-    await asyncio.gather(*tasks)
+        tasks.append(stream_bars(ts, ticker, logger, binary, snapshots, last_lines, bus, latency, files))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # Also flushes the group commit of the journals and snapshot files
+        for fp in files.values():
+            fp.close()
+        if bus is not None:
+            bus.close()
+
+async def send_heartbeats(tickers: list, last_lines: dict, logger: Logger) -> None:
+    """Send heartbeats to the supervisor while every ticker's stream is alive.
+    Args:
+        tickers (list): The list of tickers
+        last_lines (dict): Ticker to the monotonic time of its last stream line
+        logger (Logger): The logger object
+    """
+    heartbeat = Heartbeat.from_environment()
+    log_stale = logger.call_site("stale stream", level=WARNING, per_second=0.1)
+    start = time.monotonic()
+    while True:
+        now = time.monotonic()
+        stale = [ticker for ticker in tickers
+                 if now - last_lines.get(ticker, start) > STREAM_STALE_SECONDS]
+        if len(stale) == 0:
+            heartbeat.beat()
+        else:
+            log_stale("No stream lines", tickers=stale)
+        await asyncio.sleep(1.0)
     
 def main(args):
     """Kicks off starting all the tasks and waits for them to finish.
     Args:
         args (dict): a dict containing the comma separated tickers 
-                    passed to the script
-                    {'tickers' : "ticker1,ticker2,..."}
+                    passed to the script and optionally whether to
+                    write binary bar journals or snapshot files and
+                    publish to the shared memory bar bus
+                    {'tickers' : "ticker1,ticker2,...", 'binary' : False,
+                     'snapshots' : False, 'shared_memory' : False}
     Returns:
         None
     """
-    logger = Logger(LOG_NAME)
+    logger = Logger(LOG_NAME, queued=True)
     
     # Make sure we have tickers to work with
     if 'tickers' not in args.keys():
@@ -74,35 +139,74 @@ def main(args):
     run_loop = asyncio.get_event_loop()
     #for ticker in tickers:
     #logger.info(f"Starting task for {ticker}")
-    run_loop.run_until_complete(loop(ts, tickers, logger))
+    task = run_loop.create_task(loop(ts, tickers, logger, args.get('binary', False),
+                                     args.get('snapshots', False), args.get('shared_memory', False)))
+    # The supervisor stops the process with SIGTERM. Cancelling the tasks
+    # closes the bar files and the bus, and returning from main lets atexit
+    # write the queued log records and the latency histograms.
+    run_loop.add_signal_handler(signal.SIGTERM, task.cancel)
+    try:
+        run_loop.run_until_complete(task)
+    except asyncio.CancelledError:
+        logger.info("Stopped by SIGTERM")
+        print("Stopped by SIGTERM")
     run_loop.close()
 
 def get_file(ticker: str, 
              current_filename: str, 
-             current_filepointer: TextIOWrapper) -> tuple:
+             current_filepointer: TextIOWrapper,
+             binary: bool = False,
+             snapshots: bool = False) -> tuple:
     """Create a filename and open a file pointer for the bar data.
     Args:
         ticker (str): The ticker symbol
         current_filename (str): The current filename
+        binary (bool): Open a BarJournalWriter on a .bin file instead
+            of a JSON lines .log file
+        snapshots (bool): Open a SnapshotWriter on a .snap file instead
     Returns:
         tuple: The filename and file pointer
     """
     date = dt.now().strftime("%Y%m%d")
-    filename = os.path.join(BARS_DIR, date, f"{ticker}.log")
+    extension = "snap" if snapshots else "bin" if binary else "log"
+    filename = os.path.join(BARS_DIR, date, f"{ticker}.{extension}")
     if filename != current_filename:
         if current_filepointer is not None:
             current_filepointer.close()
         new_dir = os.path.join(BARS_DIR, date)
         if not os.path.isdir(new_dir):
             os.mkdir(new_dir)
-        filename = os.path.join(new_dir, f"{ticker}.log")
+        filename = os.path.join(new_dir, f"{ticker}.{extension}")
+        if snapshots:
+            return filename, SnapshotWriter(filename, BINARY_FLUSH_RECORDS, BINARY_FLUSH_MS)
+        if binary:
+            return filename, BarJournalWriter(filename, BINARY_FLUSH_RECORDS, BINARY_FLUSH_MS)
         return filename, open(filename, 'a')
     return current_filename, current_filepointer
 
-async def stream_bars(ts: TS_Auth, ticker: str, logger: Logger) -> None:
+async def stream_bars(ts: TS_Auth, ticker: str, logger: Logger, binary: bool = False,
+                      snapshots: bool = False, last_lines: dict = None,
+                      bus: BarBusWriter = None, latency: LatencyRecorder = None,
+                      files: dict = None) -> None:
     """Stream bars from tradestation
     Args:
+        ts (TS_Auth): The TS_Auth object
+        ticker (str): The ticker symbol
+        logger (Logger): The logger object
+        binary (bool): Write a binary bar journal instead of JSON lines
+        snapshots (bool): Write a delta encoded snapshot file instead
+        last_lines (dict): Set to the monotonic time of each stream line,
+            including the stream heartbeats, for send_heartbeats
+        bus (BarBusWriter): Also publish the bars to this bus, if not None
+        latency (LatencyRecorder): Records the latency of the bars from the
+            exchange to their receipt and from their receipt to their write
+        files (dict): Set to the open bar file of the ticker, for loop to
+            close it when the tasks are cancelled
     """
+    if last_lines is None:
+        last_lines = {}
+    if files is None:
+        files = {}
 
     barsback = 10
     MAX_TREND_PRICES = 100
@@ -114,8 +218,12 @@ async def stream_bars(ts: TS_Auth, ticker: str, logger: Logger) -> None:
     close = 0
     log_filename = ""
     fp = None
+    stream = None
+    retry = RETRY_SECONDS
     
     logger.info(f"Starting stream_bars for {ticker}")
+    log_line = logger.call_site(f"{ticker} stream line", per_second=LINE_LOG_PER_SECOND, burst=5)
+    log_bar = logger.call_site(f"{ticker} bar written", per_second=BAR_LOG_PER_SECOND)
     
     await asyncio.sleep(0.1)
     
@@ -135,23 +243,31 @@ async def stream_bars(ts: TS_Auth, ticker: str, logger: Logger) -> None:
             bar_direction = BAR_DOJI
             waiting_for_open = False
 
-            # Set up the request with a timeout
+            # Open the stream with a timeout, this does not block the other tickers
             try:
-                res = requests.get(url = url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT)
-            except requests.exceptions.Timeout:
+                stream = await open_stream(url, headers=headers, timeout=REQUEST_TIMEOUT)
+            except asyncio.TimeoutError:
                 await asyncio.sleep(REQUEST_TIMEOUT)
                 print("REQUEST TIMEOUT!")
                 continue
             
-            if res.status_code != 200: 
-                #print(f'Status code from bar stream for {ticker}: {res.status_code}')
+            if stream.status != 200: 
+                logger.info(f'Status code from bar stream for {ticker}: {stream.status}, retrying in {retry:.0f} s')
+                await stream.close()
                 barsback = 10
-                await asyncio.sleep(0)
+                await asyncio.sleep(retry)
+                retry = min(retry * 2, MAX_RETRY_SECONDS)
                 continue
-            for line in res.iter_lines():
+            retry = RETRY_SECONDS
+            async for line in stream.iter_lines(idle_timeout=REQUEST_TIMEOUT):
                 #await asyncio.sleep(0)
                 #logger.info(f"Ticker: {ticker} Line: {line}")
-                print(f"Ticker: {ticker} Line: {line}")
+                received = time.time()
+                log_line("Stream line", ticker=ticker, line=line)
+                last_lines[ticker] = time.monotonic()
+                if (binary or snapshots) and fp is not None:
+                    # Heartbeats keep the flush_ms part of the group commit going
+                    fp.maybe_flush()
                 if line:
                     if line is None or len(line) == 0:
                         continue
@@ -169,24 +285,37 @@ async def stream_bars(ts: TS_Auth, ticker: str, logger: Logger) -> None:
                     if 'Heartbeat' in bar_json:
                         continue
                       
-                    bar_json['time_received'] = dt.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+                    bar_json['time_received'] = dt.fromtimestamp(received).strftime("%Y-%m-%d %H:%M:%S.%f")
+                    if latency is not None and bar_json['BarStatus'] == 'Closed':
+                        # The TimeStamp of a bar is its end, only known to have passed once it is closed
+                        closed_at = dt.strptime(bar_json['TimeStamp'], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
+                        latency.record('exchange_to_receipt', received - closed_at.timestamp(), ticker)
                     del bar_json['Epoch']
                     del bar_json['IsEndOfHistory']
                     del bar_json['OpenInterest']
                     del bar_json['IsRealtime']
                     
                     # Get the file pointer and write the bar data
-                    log_filename, fp = get_file(ticker, log_filename, fp)
-                    logger.info(f"Writing bar to {log_filename}")
-                    fp.write(f"{json.dumps(bar_json)}\n")
-                    fp.flush()
+                    log_filename, fp = get_file(ticker, log_filename, fp, binary, snapshots)
+                    files[ticker] = fp
+                    log_bar("Writing bar", ticker=ticker, file=log_filename)
+                    if binary or snapshots:
+                        fp.write(bar_json)
+                    else:
+                        fp.write(f"{json.dumps(bar_json)}\n")
+                        fp.flush()
+                    if bus is not None:
+                        bus.publish(ticker, bar_json)
+                    if latency is not None:
+                        latency.record('receipt_to_write', time.time() - received, ticker)
                     
-                #
-                await asyncio.sleep(0)
+            await stream.close()
             await asyncio.sleep(0)
         except Exception as e:
             print(f"Exception in stream_bars: {e}")
             logger.error(f"Exception in stream_bars: {e}")
+            if stream is not None:
+                await stream.close()
             await asyncio.sleep(0)
             continue
                     
@@ -194,19 +323,22 @@ async def stream_bars(ts: TS_Auth, ticker: str, logger: Logger) -> None:
                     
         
 if __name__ == "__main__":
-    ts = TS_Auth(API_KEY, API_SECRET_KEY)
-    ts.start_auth0()
 
-    access_token = ts.get_access_token()
-    
-    tickers = 'ESH24,NQH24,YMH24'
-    #tickers = 'NQH24,YMH24'
-    
-    #tickers = sys.argv[1]
-    tickers = 'ESH24'
-    
-    task_args = {'tickers' : tickers}
-    
-    
-    #main(task_args)
-    Processes.daemonize(main, task_args, os.path.basename(__file__), os.getcwd(), False)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Streams bars from TradeStation to the bars/<date> files.')
+    parser.add_argument('tickers', nargs='?', default='ESH24', help='Comma separated tickers')
+    parser.add_argument('-n', '--no_daemon', action='store_true', help='Do not \
+                            make this process a daemon, e.g. when it is run by \
+                            the supervisor.')
+    parser.add_argument('-b', '--binary', action='store_true', help='Write binary bar journals')
+    parser.add_argument('-s', '--snapshots', action='store_true', help='Write delta encoded snapshot files')
+    parser.add_argument('-m', '--shared_memory', action='store_true', help='Also publish the bars \
+                            to the shared memory bar bus of the strategies on this host')
+    args = parser.parse_args()
+
+    task_args = {'tickers' : args.tickers, 'binary' : args.binary, 'snapshots' : args.snapshots,
+                 'shared_memory' : args.shared_memory}
+
+    if args.no_daemon:
+        main(task_args)
+    else:
+        Processes.daemonize(main, task_args, os.path.basename(__file__), os.getcwd(), False)
\ No newline at end of file
@@ -12,10 +12,16 @@ import requests
 import asyncio
 from config import *
 import queue
+import heapq
+import threading
 from urllib.parse import quote_plus
 import json
 
 from event import MarketEvent
+from utils.bar_buffer import BarRingBuffer, BAR_COLUMNS
+from utils.bar_cache import BarCache, interval_dir
+from utils.shm_bus import BarBusReader, BUS_NAME
+from database.aggregation import table_name
 
 
 class DataHandler(object):
@@ -209,7 +215,8 @@ class RealtimeData(DataHandler):
 class HistoricalDbData(DataHandler):
     """Class for handling historic data from a MySQL database."""
 
-    def __init__(self, events, ticker_list, start_date, end_date, max_rows=10000):
+    def __init__(self, events, ticker_list, start_date, end_date, max_rows=10000,
+                 chunk_size=10000, cache_dir=None, interval='1min'):
         """
         Initialises the historic data handler by requesting
         a list of symbols.
@@ -220,126 +227,325 @@ class HistoricalDbData(DataHandler):
         start_date - The start date of the historical data.
         end_date - The end date of the historical data.
         max_rows - The maximum number of rows keep in latest list.
+        chunk_size - The number of rows fetched from the database at a time.
+        cache_dir - If not None, bars are read through a BarCache in this
+            directory instead of straight from the database.
+        interval - The bar interval, '1min' or one of the materialized
+            intervals of database.aggregation, e.g. '5min' or '1day'.
         """
 
         super(HistoricalDbData, self).__init__(events, ticker_list, max_rows)
 
         self.start_date = start_date
         self.end_date = end_date
-        self.db_data = {}
+        self.chunk_size = chunk_size
+        self.interval = interval
+        self.table = table_name(interval)
+        self.bar_generators = {}
+        self.bar_heap = []
 
         # Create the database engine
         url = f'mysql://{DB_USER}:{quote_plus(DB_PASS)}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
         #print(url)
         self.engine = sqlalchemy.create_engine(url)
+        if cache_dir is not None:
+            # Each interval is cached in its own directory
+            cache_dir = interval_dir(cache_dir, interval)
+        self.cache = BarCache(self.engine, cache_dir, self.table) if cache_dir is not None else None
     
+    def _fetch_chunks(self, ticker, chunks):
+        """
+        Reads the bars for the ticker with an unbuffered server side
+        cursor and puts them on the chunks queue as DataFrames of at
+        most chunk_size rows. Runs in its own thread so the next chunk
+        is fetched while the current one is replayed. None marks the
+        end of the data, an exception is passed on to the reader.
+        """
+        try:
+            query, params = self._bars_query(ticker)
+            with self.engine.connect() as conn:
+                conn = conn.execution_options(stream_results=True,
+                                              max_row_buffer=self.chunk_size)
+                for df in pd.read_sql(query, con = conn, params=params,
+                                      chunksize=self.chunk_size):
+                    chunks.put(df)
+        except Exception as ex:
+            chunks.put(ex)
+        chunks.put(None)
+
     def _get_new_bar(self, ticker):
-        """Gets the latest bar from the data read from the database."""
-        for b in self.db_data[ticker]:
-            yield b
+        """
+        Gets the bars read from the database one at a time as
+        (datetime, open, high, low, close, volume, open_interest) tuples.
+        At most one chunk is replayed and one prefetched, so memory
+        is bounded regardless of the length of the date range.
+        With a cache the bars are read from memory-mapped day partitions.
+        """
+        if self.cache is not None:
+            for day in self.cache.iter_days(ticker, self.start_date, self.end_date):
+                yield from zip(day['datetime'], *(day[col] for col in BAR_COLUMNS))
+            return
+
+        chunks = queue.Queue(maxsize=1)
+        fetcher = threading.Thread(target=self._fetch_chunks, args=(ticker, chunks),
+                                   daemon=True)
+        fetcher.start()
+        while True:
+            df = chunks.get()
+            if df is None:
+                break
+            if isinstance(df, Exception):
+                raise df
+            datetimes = df['datetime'].values.astype('datetime64[ns]')
+            columns = [df[col].to_numpy(dtype=np.float64, na_value=np.nan)
+                       for col in BAR_COLUMNS]
+            del df
+            yield from zip(datetimes, *columns)
+
+    def _push_next_bar(self, ticker_index):
+        """
+        Pushes the next bar of the ticker onto the merge heap, ordered
+        by datetime and then by position in the ticker list.
+        """
+        ticker = self.ticker_list[ticker_index]
+        try:
+            bar = next(self.bar_generators[ticker])
+        except StopIteration:
+            return
+        heapq.heappush(self.bar_heap, (bar[0], ticker_index, bar))
 
     def update_bars(self):
         """
-        Pushes the latest bar to the latest_data structure
-        for all symbols in the symbol list.
+        Pushes the bars of the next datetime to the latest_data structure
+        for the symbols that have a bar at that datetime, and puts one
+        MarketEvent for that time slice on the queue.
+        Tickers are merged in global datetime order with a heap, so each
+        bar costs O(log k) for k tickers and tickers with gaps stay aligned.
         This simulates a live bar stream from a brokerage.
         """
-        for s in self.ticker_list:
-            try:
-                bar = next(self._get_new_bar(s))
-            except StopIteration:
-                self.continue_backtest = False
-            else:
-                if bar is not None:
-                    self.latest_data[s].append(bar)
-                    if(len(self.latest_data[s]) > self.max_rows):
-                        self.latest_data[s].pop(0)
-        self.events.put(MarketEvent())
+        if len(self.bar_heap) == 0:
+            self.continue_backtest = False
+            return
+
+        slice_datetime = self.bar_heap[0][0]
+        tickers = []
+        while len(self.bar_heap) > 0 and self.bar_heap[0][0] == slice_datetime:
+            _, ticker_index, bar = heapq.heappop(self.bar_heap)
+            ticker = self.ticker_list[ticker_index]
+            self.latest_data[ticker].append(*bar)
+            tickers.append(ticker)
+            self._push_next_bar(ticker_index)
+        self.events.put(MarketEvent(datetime=slice_datetime, tickers=tickers))
+
+    def _get_buffer(self, symbol):
+        """Gets the ring buffer of latest bars for the symbol."""
+        try:
+            return self.latest_data[symbol]
+        except KeyError:
+            print("That symbol is not available in the historical data set.")
+            raise
 
     def get_latest_bars(self, symbol, N=1):
         """
         Returns the last N bars from the latest_symbol list,
-        or N-k if less available.
+        or N-k if less available, as a dict of column name to 
+        a read only NumPy view.
         """
-        try:
-            bars_list = self.latest_data[symbol]
-        except KeyError:
-            print("That symbol is not available in the historical data set.")
-            raise
-        else:
-            return bars_list[-N:]
+        return self._get_buffer(symbol).get_bars(N)
         
     def get_latest_bar_value(self, symbol, val_type):
         """
-        Returns one of the Open, High, Low, Close, Volume or OI
-        values from the pandas Bar series object.
+        Returns one of the open, high, low, close, volume or 
+        open_interest values from the last bar.
         """
-        try:
-            bars_list = self.latest_data[symbol]
-        except KeyError:
-            print("That symbol is not available in the historical data set.")
-            raise
-        else:
-            return getattr(bars_list[-1][1], val_type)
+        return self._get_buffer(symbol).get_last_value(val_type)
         
     def get_latest_bars_values(self, symbol, val_type, N=1):
         """
         Returns the last N bar values from the 
         latest_symbol list, or N-k if less available.
+        The result is a read only view, no copy is made.
         """
-        try:
-            bars_list = self.get_latest_bars(symbol, N)
-        except KeyError:
-            print("That symbol is not available in the historical data set.")
-            raise
-        else:
-            return np.array([getattr(b[1], val_type) for b in bars_list])
+        return self._get_buffer(symbol).get_values(val_type, N)
         
     def get_latest_bar_datetime(self, symbol):
         """
-        Returns a Python datetime object for the last bar.
+        Returns a numpy datetime64 object for the last bar.
         """
-        try:
-            bars_list = self.latest_data[symbol]
-        except KeyError:
-            print("That symbol is not available in the historical data set.")
-            raise
-        else:
-            return np.array([b[0] for b in bars_list])
+        return self._get_buffer(symbol).get_last_datetime()
         
     def get_latest_bars_datetimes(self, symbol, N=1):
         """
-        Returns a Python datetime object for the last bar.
+        Returns the numpy datetime64 values for the last N bars,
+        or N-k if less available.
         """
-        try:
-            bars_list = self.latest_data[symbol]
-        except KeyError:
-            print("That symbol is not available in the historical data set.")
-            raise
-        else:
-            return bars_list[-N][0]
+        return self._get_buffer(symbol).get_datetimes(N)
         
+    def _bars_query(self, ticker):
+        """Gets the query and its parameters selecting the bars for
+        the ticker between self.start_date and self.end_date."""
+        query  = "SELECT datetime, " + ", ".join(BAR_COLUMNS) + f" FROM {self.table} "
+        query += "WHERE ticker = %(ticker)s AND "
+        query += "datetime >= %(start_date)s AND "
+        query += "datetime <= %(end_date)s "
+        query += "ORDER BY datetime ASC"
+        params = {'ticker': ticker, 'start_date': self.start_date, 'end_date': self.end_date}
+        return query, params
+
     def read_from_dbase(self):
-        # Read the data from the database on row at a time starting with self.start_date
+        # Stream the data from the database one chunk at a time starting with self.start_date
+
+        if self.cache is not None:
+            # Warm the cache ahead of the replay, days still missing when
+            # the replay reaches them are read from the database directly
+            self.cache.fill_in_background(self.ticker_list, self.start_date, self.end_date)
 
         for ticker in self.ticker_list:
-            query  = f"SELECT * FROM bars_1min WHERE ticker='{ticker}' AND "
-            query += f"datetime >= '{self.start_date}' AND "
-            query += f"datetime <= '{self.end_date}' "
-            query += "ORDER BY datetime ASC"
-            #print(query)
-            #self.cursor.execute(query)
-            #df = pd.read_sql(query, con=self.db_con)
-            
+            # Create the bar generator once, update_bars() advances it
+            self.bar_generators[ticker] = self._get_new_bar(ticker)
+
+            # Set the latest data to an empty ring buffer for this ticker
+            self.latest_data[ticker] = BarRingBuffer(self.max_rows)
+
+        # Prime the merge heap with the first bar of every ticker
+        self.bar_heap = []
+        for ticker_index in range(len(self.ticker_list)):
+            self._push_next_bar(ticker_index)
 
+    def read_aligned_from_dbase(self):
+        """
+        Reads the whole [start_date, end_date] range for every ticker
+        into arrays aligned on a common datetime axis. This is the input
+        for the vectorized backtest, see vectorized.py.
+
+        Returns:
+        A dict with 'tickers' (the ticker list), 'datetime' (the sorted
+        union of all bar datetimes as datetime64) and one 2-D float array
+        of shape (tickers, datetimes) per column in BAR_COLUMNS. Minutes
+        where a ticker has no bar are NaN.
+        """
+        frames = []
+        for ticker in self.ticker_list:
+            if self.cache is not None:
+                frames.append(self.cache.get_df(ticker, self.start_date, self.end_date))
+                continue
+            query, params = self._bars_query(ticker)
             with self.engine.connect() as conn:
-                self.db_data[ticker] = pd.read_sql(query, con = conn)
-                self.db_data[ticker].set_index('datetime', inplace=True)
-                self.db_data[ticker].drop(['id', 'ticker'], axis=1, inplace=True)
-                self.db_data[ticker] = self.db_data[ticker].iterrows()
+                frames.append(pd.read_sql(query, con = conn, params=params))
+
+        datetimes = [df['datetime'].values.astype('datetime64[ns]') for df in frames]
+        all_datetimes = np.unique(np.concatenate(datetimes)) if len(datetimes) > 0 \
+            else np.array([], dtype='datetime64[ns]')
+
+        bars = {'tickers': list(self.ticker_list), 'datetime': all_datetimes}
+        for col in BAR_COLUMNS:
+            bars[col] = np.full((len(frames), len(all_datetimes)), np.nan)
+        for k, df in enumerate(frames):
+            idx = np.searchsorted(all_datetimes, datetimes[k])
+            for col in BAR_COLUMNS:
+                bars[col][k, idx] = df[col].to_numpy(dtype=np.float64, na_value=np.nan)
+        return bars
+
+class SharedMemoryData(DataHandler):
+    """Class for handling live bars from the shared memory bus of bars_daemon."""
+
+    def __init__(self, events, ticker_list, bus_name=BUS_NAME, max_rows=10000):
+        """
+        Initialises the live data handler by attaching to the bar bus
+        bars_daemon publishes to with -m.
+
+        Parameters:
+        events - The Event Queue.
+        ticker_list - A list of ticker strings, published by bars_daemon.
+        bus_name - The name of the shared memory segment of the bus.
+        max_rows - The maximum number of rows keep in latest list.
+        """
+        super(SharedMemoryData, self).__init__(events, ticker_list, max_rows)
+        self.reader = BarBusReader(bus_name)
+        self.latest_data = {ticker: BarRingBuffer(max_rows) for ticker in ticker_list}
+        self.latest_updates = {}
+        # Updates overwritten by bars_daemon while they were copied, dropped
+        self.overrun_updates = 0
 
-            # Set the latest data to Empty for this ticker
-            self.latest_data[ticker] = []
+    def update_bars(self):
+        """
+        Reads the bar updates published since the last call, without
+        waiting. The closed bars are appended to the latest_data of
+        their ticker, the last update of each ticker, open bar included,
+        is kept for get_latest_update(), and one MarketEvent is put on
+        the queue for the tickers updated. When bars_daemon is restarted
+        the reader moves to its new bus. A batch overwritten while it was
+        copied is dropped and counted in overrun_updates.
+        """
+        tickers = []
+        latest = None
+        while True:
+            records = self.reader.read()
+            if len(records) == 0:
+                break
+            batch = records.copy()
+            if self.reader.lapped(records):
+                self.overrun_updates += len(records)
+                continue
+            records = batch
+            # The tickers of the bus, a restarted bars_daemon may have others
+            indices = {self.reader.ticker_index(ticker): ticker for ticker in self.ticker_list
+                       if ticker in self.reader.tickers}
+            for index, ticker in indices.items():
+                updates = records[records['ticker'] == index]
+                if len(updates) == 0:
+                    continue
+                self.latest_updates[ticker] = updates[-1].copy()
+                for bar in updates[~updates['is_open']]:
+                    self.latest_data[ticker].append(bar['timestamp'], bar['open'], bar['high'], bar['low'],
+                                                    bar['close'], bar['total_volume'], np.nan)
+                if ticker not in tickers:
+                    tickers.append(ticker)
+            latest = records['timestamp'][-1]
+        if len(tickers) > 0:
+            self.events.put(MarketEvent(datetime=latest, tickers=tickers))
+
+    def get_latest_update(self, symbol):
+        """
+        Returns the last update of the symbol, a record of the
+        bar journal fields, None if there was none yet. The bar
+        is still open if its is_open field is True.
+        """
+        return self.latest_updates.get(symbol)
+
+    def get_latest_bars(self, symbol, N=1):
+        """
+        Returns the last N closed bars, or N-k if less available,
+        as a dict of column name to a read only NumPy view.
+        """
+        return self.latest_data[symbol].get_bars(N)
+
+    def get_latest_bar_value(self, symbol, val_type):
+        """
+        Returns one of the open, high, low, close, volume or 
+        open_interest values from the last closed bar.
+        """
+        return self.latest_data[symbol].get_last_value(val_type)
+
+    def get_latest_bars_values(self, symbol, val_type, N=1):
+        """
+        Returns the last N closed bar values, or N-k if less
+        available, as a read only view.
+        """
+        return self.latest_data[symbol].get_values(val_type, N)
+
+    def get_latest_bar_datetime(self, symbol):
+        """
+        Returns a numpy datetime64 object for the last closed bar.
+        """
+        return self.latest_data[symbol].get_last_datetime()
+
+    def get_latest_bars_datetimes(self, symbol, N=1):
+        """
+        Returns the numpy datetime64 values for the last N closed
+        bars, or N-k if less available.
+        """
+        return self.latest_data[symbol].get_datetimes(N)
 
 if __name__ == "__main__":
     events = queue.Queue()
@@ -3,13 +3,16 @@ import sys
 import time
 import asyncio
 import argparse
-import requests
 import json
 current = os.path.dirname(os.path.realpath(__file__))
 parent = os.path.dirname(current)
 sys.path.append(parent)
 from processes.processes import Processes
-from logger.logger import Logger
+from logger.logger import Logger, DEBUG, INFO
+from processes.supervisor import Heartbeat
+from utils.async_stream import open_stream
+from utils.redis_stream import BarPublisher, REDIS_HOST, REDIS_PORT
+from datetime import datetime as dt
 from ts_auth0 import TS_Auth
 from config import API_KEY, API_SECRET_KEY
 from config import API_BASE_URL, API_STREAM_BARCHARTS_URI
@@ -20,31 +23,47 @@ Command line arguments alow for starting the script as a daemon or not.
 """
 
 LOG_NAME = "trade_station_data_d"
+# Most stream lines logged per second and ticker, the others are counted
+# in the periodic summaries of the logger
+LINE_LOG_PER_SECOND = 1.0
 
-def _bar_to_redis_stream(ticker: str, bar: dict, logger: Logger) -> None:
+# Seconds before reopening a stream refused with an error status, doubled
+# on each refusal up to MAX_RETRY_SECONDS
+RETRY_SECONDS = 1.0
+MAX_RETRY_SECONDS = 60.0
+
+def _bar_to_redis_stream(ticker: str, bar: dict, publisher: BarPublisher, logger: Logger) -> None:
     """Send the bar to the redis stream.
     Args:
         ticker (str): The ticker
         bar (dict): The bar
+        publisher (BarPublisher): Publishes to the stream of each ticker
         logger (Logger): The logger object
     Returns:
         None
     """
-    logger.info(f"Ticker: {ticker} Bar: {bar}")
+    logger.call_site(f"{ticker} bar", level=DEBUG)("Bar", ticker=ticker, bar=bar)
 
-    #TODO: Send the bar to the redis stream 
-    pass
+    if 'Heartbeat' in bar:
+        return
+    # Stamped like the lines of the bar logs, so a strategy can make a Bar of it
+    bar['time_received'] = dt.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+    publisher.publish(ticker, bar)
 
-async def stream_bars(ts: TS_Auth, ticker: str, logger: Logger) -> None:
+async def stream_bars(ts: TS_Auth, ticker: str, publisher: BarPublisher, logger: Logger) -> None:
     """Stream bars for the given ticker.
     Args:
         ts (TS_Auth): The TS_Auth object
         ticker (str): The ticker
+        publisher (BarPublisher): Publishes the bars
         logger (Logger): The logger object
     Returns:
         None
     """
     barsback = 10
+    retry = RETRY_SECONDS
+    log_line = logger.call_site(f"{ticker} stream line", per_second=LINE_LOG_PER_SECOND, burst=5)
+    heartbeat = Heartbeat.from_environment()
 
     try:
         while True:
@@ -60,18 +79,21 @@ async def stream_bars(ts: TS_Auth, ticker: str, logger: Logger) -> None:
             count += 1
             logger.info(f"Ticker: {ticker} Count: {count}")
 
-            res = requests.get(url = url, headers=headers, stream=True)
-            if res.status_code != 200: 
-                logger.warn(f'Status code from bar stream for {ticker}: {res.status_code}')
-                barsback = 10
-                continue
-            for line in res.iter_lines():
-                await asyncio.sleep(0)
-                if line:
-                    logger.info(f"Ticker: {ticker} Count: {count} Line: {line}")
-                    bar_json = json.loads(line)
-                    _bar_to_redis_stream(ticker, bar_json, logger)
-                    count += 1
+            async with await open_stream(url, headers=headers) as stream:
+                if stream.status != 200: 
+                    logger.warn(f'Status code from bar stream for {ticker}: {stream.status}, retrying in {retry:.0f} s')
+                    barsback = 10
+                    await asyncio.sleep(retry)
+                    retry = min(retry * 2, MAX_RETRY_SECONDS)
+                    continue
+                retry = RETRY_SECONDS
+                async for line in stream.iter_lines():
+                    if line:
+                        log_line("Stream line", ticker=ticker, count=count, line=line)
+                        heartbeat.beat()
+                        bar_json = json.loads(line)
+                        _bar_to_redis_stream(ticker, bar_json, publisher, logger)
+                        count += 1
     except Exception as ex:
         logger.error(f"Exception in stream_bars for {ticker}: {ex}")
         await asyncio.sleep(5)
@@ -80,31 +102,41 @@ async def stream_bars(ts: TS_Auth, ticker: str, logger: Logger) -> None:
     logger.warn(f"Exiting stream_bars for {ticker}")
     
 
-async def loop(ts: TS_Auth, tickers: list, logger: Logger) -> None:
+async def loop(ts: TS_Auth, tickers: list, redis_host: str, redis_port: int, logger: Logger) -> None:
     """Create and start the tasks for each ticker.
     Args:
         ts (TS_Auth): The TS_Auth object
         tickers (list): The list of tickers
+        redis_host (str): The Redis host
+        redis_port (int): The Redis port
         logger (Logger): The logger object
     Returns:
         None
     """
 
     logger.info(f"Starting loop for {tickers}")
+    publisher = BarPublisher(redis_host, redis_port)
+    publisher.start()
     tasks = []
     for ticker in tickers:
-        tasks.append(stream_bars(ts, ticker, logger))
-    await asyncio.gather(*tasks)
+        tasks.append(stream_bars(ts, ticker, publisher, logger))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        await publisher.close()
+        logger.info(f"Published {publisher.published} bars, dropped {publisher.dropped}")
 
 def main(args):
     """Kicks off starting all the tasks and waits for them to finish.
     Args:
         args (dict): a dict containing the comma separaterd tickers 
-                    passed to the script
+                    passed to the script and the redis host:port
     Returns:
         None
     """
-    logger = Logger(LOG_NAME)
+    logger = Logger(LOG_NAME, queued=True)
+    # The bars are logged at debug level, only enable them when debugging
+    logger.set_level(INFO)
 
     tickers = args['tickers'].split(',')
     logger.info(f"Starting for {args['tickers']}")
@@ -113,7 +145,8 @@ def main(args):
     ts.start_auth0()
 
     run_loop = asyncio.get_event_loop()
-    run_loop.run_until_complete(loop(ts, tickers, logger))
+    redis_host, _, redis_port = args['redis'].partition(':')
+    run_loop.run_until_complete(loop(ts, tickers, redis_host, int(redis_port or REDIS_PORT), logger))
     run_loop.close()
 
 if __name__ == "__main__":
@@ -124,9 +157,11 @@ if __name__ == "__main__":
     parser.add_argument('-n', '--no_daemon', action='store_true', help='Do not \
                             make this process a daemon. Defaults to turning \
                             this process into a daemon.')
+    parser.add_argument('-r', '--redis', default=f"{REDIS_HOST}:{REDIS_PORT}", help='The \
+                            redis host:port to publish to.')
     
     tickers = parser.parse_args().tickers
-    task_args = {'tickers' : tickers}
+    task_args = {'tickers' : tickers, 'redis': parser.parse_args().redis}
 
     args = parser.parse_args()
     if args.no_daemon:
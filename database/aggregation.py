@@ -0,0 +1,243 @@
+# Materialized higher timeframe bars aggregated from bars_1min
+import datetime
+import numpy as np
+import pandas as pd
+from database.coverage import SessionCalendar, calendar_for
+from utils.bar_cache import CACHE_DIR, invalidate_days
+
+"""
+Keeps a bars_<interval> table per supported interval, with the same columns
+as bars_1min, aggregated from the 1 minute bars:
+
+    open            the open of the first minute of the bucket
+    high, low       the highest high and the lowest low
+    close           the close of the last minute
+    volume          the sum of the volumes
+    open_interest   the open interest of the last minute
+
+A bar is labelled with the start of its bucket, like the minutes it is made
+of. Intraday buckets are aligned on UTC, a daily bar is one trading day of
+the ticker's session calendar labelled with its date at 00:00, so a futures
+session opening at 18:00 ET counts towards the next day.
+
+The tables are updated incrementally: only the minutes from the start of the
+last materialized bucket onward, or from a given time after a backfill, are
+read and the buckets they fall into are upserted. The last bucket of a table
+may be partial until its minutes have all arrived, it is rewritten by the
+next update.
+"""
+
+# Minutes per bar of each supported interval, with its table
+INTERVALS = {
+    '5min': 5,
+    '15min': 15,
+    '60min': 60,
+    '1day': 24 * 60,
+}
+MAX_DAYS_PER_QUERY = 31
+_COLUMNS = ('open', 'high', 'low', 'close', 'volume', 'open_interest')
+
+def table_name(interval: str) -> str:
+    """Get the table of an interval, '1min' or one of INTERVALS"""
+    if interval != '1min' and interval not in INTERVALS:
+        raise ValueError(f"Unsupported interval {interval}, use 1min or one of {', '.join(INTERVALS)}")
+    return f"bars_{interval}"
+
+def bucket_starts(datetimes: np.ndarray, interval: str, calendar: SessionCalendar) -> np.ndarray:
+    """Get the start of the bucket of each minute.
+    Args:
+        datetimes (np.ndarray): Naive UTC datetime64 of the minutes
+        interval (str): One of INTERVALS
+        calendar (SessionCalendar): The session calendar for daily buckets
+    Returns:
+        np.ndarray: datetime64[m] bucket starts
+    """
+    minutes = datetimes.astype('datetime64[m]')
+    if INTERVALS[interval] < 24 * 60:
+        step = np.timedelta64(INTERVALS[interval], 'm')
+        return minutes - (minutes - np.datetime64(0, 'm')) % step
+    # The trading date, shifting evening sessions to the next day
+    local = pd.DatetimeIndex(minutes).tz_localize('UTC').tz_convert(calendar.timezone.zone).tz_localize(None)
+    if calendar.open_time > calendar.close_time:
+        opened = datetime.datetime.combine(datetime.date.min, calendar.open_time) - datetime.datetime.min
+        local = local + (pd.Timedelta(days=1) - pd.Timedelta(opened))
+    return local.values.astype('datetime64[D]').astype('datetime64[m]')
+
+def aggregate(columns: dict, starts: np.ndarray) -> dict:
+    """Aggregate minute bars into the buckets given by their starts.
+    Args:
+        columns (dict): Column arrays of the minutes in time order, see BarCache
+        starts (np.ndarray): The bucket start of each minute, non decreasing
+    Returns:
+        dict: Column arrays with one row per bucket, 'datetime' is the start
+    """
+    if len(starts) == 0:
+        return {name: np.empty(0) for name in ('datetime',) + _COLUMNS}
+    first = np.flatnonzero(np.r_[True, starts[1:] != starts[:-1]])
+    last = np.r_[first[1:], len(starts)] - 1
+    return {
+        'datetime': starts[first],
+        'open': columns['open'][first],
+        'high': np.fmax.reduceat(columns['high'], first),
+        'low': np.fmin.reduceat(columns['low'], first),
+        'close': columns['close'][last],
+        'volume': np.add.reduceat(np.nan_to_num(columns['volume']), first),
+        'open_interest': columns['open_interest'][last],
+    }
+
+class BarAggregator:
+    """Updates the bars_<interval> tables of INTERVALS from bars_1min."""
+
+    def __init__(self, db_conn, intervals: tuple = tuple(INTERVALS), cache_dir: str = CACHE_DIR):
+        """Constructor
+        Args:
+            db_conn: The MySQLdb database connection
+            intervals (tuple): The intervals to maintain
+            cache_dir (str): The BarCache directory of which the days
+                written are invalidated
+        """
+        self.db_conn = db_conn
+        self.intervals = tuple(intervals)
+        self.cache_dir = cache_dir
+        for interval in self.intervals:
+            table_name(interval)
+
+    def create_tables(self) -> None:
+        """Create the interval tables that do not exist, like bars_1min"""
+        cur = self.db_conn.cursor()
+        for interval in self.intervals:
+            cur.execute(f"CREATE TABLE IF NOT EXISTS {table_name(interval)} LIKE bars_1min")
+        self.db_conn.commit()
+
+    def _last_bucket(self, ticker: str, interval: str):
+        """The start of the last materialized bucket, None if there is none"""
+        cur = self.db_conn.cursor()
+        cur.execute(f"SELECT MAX(datetime) FROM {table_name(interval)} WHERE ticker = %s", (ticker,))
+        return cur.fetchone()[0]
+
+    def _read_minutes(self, ticker: str, start: datetime.datetime, end: datetime.datetime) -> dict:
+        """Read the minutes in [start, end) as a dict of column arrays"""
+        cur = self.db_conn.cursor()
+        cur.execute("SELECT datetime, " + ", ".join(_COLUMNS) + " FROM bars_1min "
+                    "WHERE ticker = %s AND datetime >= %s AND datetime < %s ORDER BY datetime ASC",
+                    (ticker, start, end))
+        rows = cur.fetchall()
+        columns = {'datetime': np.array([row[0] for row in rows], dtype='datetime64[ns]')}
+        for i, name in enumerate(_COLUMNS):
+            columns[name] = np.array([np.nan if row[i + 1] is None else float(row[i + 1]) for row in rows],
+                                     dtype=np.float64)
+        return columns
+
+    def _write(self, ticker: str, interval: str, bars: dict) -> int:
+        """Upsert the aggregated bars of an interval"""
+        if len(bars['datetime']) == 0:
+            return 0
+        values = [[ticker, str(bars['datetime'][i]).replace('T', ' ')] +
+                  [None if np.isnan(bars[name][i]) else float(bars[name][i]) for name in _COLUMNS]
+                  for i in range(len(bars['datetime']))]
+        query  = f"INSERT INTO {table_name(interval)} (ticker, datetime, " + ", ".join(_COLUMNS) + ") "
+        query += "VALUES (" + ", ".join(["%s"] * 8) + ") "
+        query += "ON DUPLICATE KEY UPDATE " + ", ".join(f"{name} = VALUES({name})" for name in _COLUMNS)
+        cur = self.db_conn.cursor()
+        cur.executemany(query, values)
+        return len(values)
+
+    def update(self, ticker: str, since: datetime.datetime = None) -> dict:
+        """Aggregate the new minutes of a ticker into every interval table.
+        Args:
+            ticker (str): The ticker
+            since (datetime.datetime): Also rebuild the buckets from this
+                naive UTC time, e.g. the start of a backfilled window. None
+                to continue from the last materialized buckets.
+        Returns:
+            dict: The number of bars written per interval
+        """
+        calendar = calendar_for(ticker)
+        starts = []
+        for interval in self.intervals:
+            last = self._last_bucket(ticker, interval)
+            if last is None:
+                cur = self.db_conn.cursor()
+                cur.execute("SELECT MIN(datetime) FROM bars_1min WHERE ticker = %s", (ticker,))
+                last = cur.fetchone()[0]
+                if last is None:
+                    return {interval: 0 for interval in self.intervals}
+            starts.append(last)
+        start = min(starts) if since is None else min(starts + [since])
+        # A daily bucket begins up to a day before its label, so the minutes
+        # are read from a day before the first bucket rewritten
+        first_bucket = np.datetime64(pd.Timestamp(start).floor('D') - pd.Timedelta(days=1), 'm')
+        start = pd.Timestamp(first_bucket).to_pydatetime() - datetime.timedelta(days=1)
+        now = datetime.datetime.utcnow()
+
+        written = {interval: 0 for interval in self.intervals}
+        days = MAX_DAYS_PER_QUERY
+        while start <= now:
+            end = start + datetime.timedelta(days=days)
+            columns = self._read_minutes(ticker, start, end)
+            if len(columns['datetime']) == 0:
+                start = end
+                continue
+            buckets = {interval: bucket_starts(columns['datetime'], interval, calendar)
+                       for interval in self.intervals}
+            keep = len(columns['datetime'])
+            next_start = end
+            if end <= now:
+                # The last buckets may continue in the next chunk, which
+                # starts with the minutes of the earliest of them
+                next_start = min(columns['datetime'][np.searchsorted(starts_, starts_[-1])]
+                                 for starts_ in buckets.values())
+                keep = np.searchsorted(columns['datetime'], next_start)
+                if keep == 0:
+                    # The chunk is all one bucket, read a longer one
+                    days *= 2
+                    continue
+            changed = {}
+            for interval, starts_ in buckets.items():
+                bars = aggregate({name: values[:keep] for name, values in columns.items()}, starts_[:keep])
+                new = bars['datetime'] >= first_bucket
+                written[interval] += self._write(ticker, interval, {name: values[new] for name, values in bars.items()})
+                changed[interval] = bars['datetime'][new]
+            self.db_conn.commit()
+            for interval, datetimes in changed.items():
+                invalidate_days(ticker, datetimes.astype('datetime64[D]').astype(object), self.cache_dir, interval)
+            start = pd.Timestamp(next_start).to_pydatetime()
+            days = MAX_DAYS_PER_QUERY
+        return written
+
+
+if __name__ == "__main__":
+
+    # Check the aggregation against pandas resampling of random minutes
+    # with gaps, and the trading days of the futures and equities calendars
+    from database.coverage import CME_FUTURES, US_EQUITIES
+
+    rng = np.random.default_rng(1)
+    minutes = pd.date_range("2023-06-01", "2023-07-01", freq="1min", inclusive="left")
+    minutes = minutes[rng.random(len(minutes)) < 0.7]
+    close = 4400 + np.cumsum(rng.normal(0, 0.5, len(minutes)))
+    columns = {'datetime': minutes.values,
+               'open': close + rng.normal(0, 0.25, len(minutes)),
+               'high': close + 1.0, 'low': close - 1.0, 'close': close,
+               'volume': rng.integers(0, 500, len(minutes)).astype(np.float64),
+               'open_interest': rng.integers(0, 10, len(minutes)).astype(np.float64)}
+    df = pd.DataFrame(columns).set_index('datetime')
+    rules = {'open': 'first', 'high': 'max', 'low': 'min', 'close': 'last', 'volume': 'sum',
+             'open_interest': 'last'}
+
+    for interval in ('5min', '15min', '60min'):
+        bars = aggregate(columns, bucket_starts(columns['datetime'], interval, CME_FUTURES))
+        expected = df.resample(f"{INTERVALS[interval]}min").agg(rules).dropna(subset=['open'])
+        same = all(np.array_equal(bars[name], expected[name].values) for name in rules)
+        same = same and np.array_equal(bars['datetime'], expected.index.values.astype('datetime64[m]'))
+        print(f"{interval}: {len(bars['datetime'])} bars, same as pandas: {same}")
+
+    for calendar, name in ((CME_FUTURES, "futures"), (US_EQUITIES, "equities")):
+        bars = aggregate(columns, bucket_starts(columns['datetime'], '1day', calendar))
+        local = df.tz_localize('UTC').tz_convert('America/New_York').tz_localize(None)
+        if calendar.open_time > calendar.close_time:
+            local.index = local.index + pd.Timedelta(hours=6)
+        expected = local.resample('1D').agg(rules).dropna(subset=['open'])
+        same = all(np.array_equal(bars[name], expected[name].values) for name in rules)
+        same = same and np.array_equal(bars['datetime'], expected.index.values.astype('datetime64[m]'))
+        print(f"1day {name}: {len(bars['datetime'])} bars, same as pandas: {same}")
@@ -0,0 +1,329 @@
+# Concurrent backfill of bars_1min from the barcharts endpoint
+import os
+import time
+import queue
+import threading
+from datetime import datetime as dt
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+import requests
+
+"""
+Backfills 1 minute bars for many tickers and days at once.
+
+All the (ticker, day) windows of the range are planned up front, the ones
+already done in a previous run are skipped, and the rest are fetched by a
+bounded pool of worker threads sharing a per-host rate limit. Fetched bars
+go through a bounded queue to a single writer thread that inserts them in
+batches, so a slow database holds up the fetchers instead of filling memory.
+
+A window is appended to the state file only after its bars are committed,
+so after a failure or an interrupt the same command resumes with the
+windows that are not done. Windows that keep failing are reported and
+retried by the next run.
+"""
+
+STATE_FILE = "backfill_state.txt"
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+class RateLimiter:
+    """Token bucket rate limit per host, shared by the worker threads."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        """Constructor
+        Args:
+            rate (float): Requests per second allowed to each host
+            burst (int): Requests allowed at once after an idle period
+        """
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def acquire(self, url: str) -> None:
+        """Wait until a request to the host of url is allowed"""
+        host = urlsplit(url).netloc
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                tokens, last = self._buckets.get(host, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - last) * self.rate)
+                if tokens >= 1:
+                    self._buckets[host] = (tokens - 1, now)
+                    return
+                self._buckets[host] = (tokens, now)
+                wait = (1 - tokens) / self.rate
+            time.sleep(wait)
+
+def plan_windows(tickers: list, start_date: str, end_date: str) -> list:
+    """Split the range into one window per ticker and calendar day, like get_bars.
+    Args:
+        tickers (list): The tickers
+        start_date (str): The start in the format YYYY-MM-DDTHH:MM:SSZ
+        end_date (str): The end in the format YYYY-MM-DDTHH:MM:SSZ
+    Returns:
+        list: (ticker, first date, last date) tuples, dates as YYYY-MM-DDTHH:MM:SSZ
+    """
+    start_dt = dt.strptime(start_date, DATE_FORMAT)
+    end_dt = dt.strptime(end_date, DATE_FORMAT)
+    days = []
+    while start_dt <= end_dt:
+        end = min(start_dt.replace(hour=23, minute=59, second=59), end_dt)
+        days.append((start_dt.strftime(DATE_FORMAT), end.strftime(DATE_FORMAT)))
+        start_dt = start_dt.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    return [(ticker, start, end) for ticker in tickers for start, end in days]
+
+def bars_to_rows(ticker: str, bars: list) -> list:
+    """Convert the closed bars of a barcharts response to bars_1min rows
+    Args:
+        ticker (str): The ticker
+        bars (list): The 'Bars' of the response
+    Returns:
+        list: Lists of ticker, datetime, open, high, low, close, volume, open_interest
+    """
+    rows = []
+    for bar in bars:
+        if bar['BarStatus'] != 'Closed':
+            continue
+        rows.append([ticker, bar['TimeStamp'].replace('T', ' ').replace('Z', ''),
+                     bar['Open'], bar['High'], bar['Low'], bar['Close'],
+                     bar['TotalVolume'], bar['OpenInterest']])
+    return rows
+
+class Backfill:
+    """Fetches planned windows concurrently and writes them in batches."""
+
+    def __init__(self, base_url: str, get_access_token, write_rows, state_file: str = STATE_FILE,
+                 workers: int = 8, rate: float = 5.0, batch_rows: int = 5000,
+                 retries: int = 3, timeout: float = 30.0, on_done=None):
+        """Constructor
+        Args:
+            base_url (str): The barcharts URL, the ticker is appended to it
+            get_access_token (callable): Returns the current access token, it
+                is called for every request so a refreshed token is used
+            write_rows (callable): Inserts and commits a list of rows, see
+                bars_to_rows. Only called from the writer thread.
+            state_file (str): The file listing the windows done
+            workers (int): Number of concurrent requests
+            rate (float): Requests per second allowed to the host
+            batch_rows (int): Rows buffered before they are written
+            retries (int): Attempts of a window on timeouts, 429 and 5xx
+            timeout (float): Seconds allowed for each request
+            on_done (callable): Called from the writer thread with the list
+                of windows just written, e.g. to update a coverage index
+        """
+        self.base_url = base_url
+        self.get_access_token = get_access_token
+        self.write_rows = write_rows
+        self.state_file = state_file
+        self.workers = workers
+        self.rate_limiter = RateLimiter(rate, burst=workers)
+        self.batch_rows = batch_rows
+        self.retries = retries
+        self.timeout = timeout
+        self.on_done = on_done
+        self._local = threading.local()
+        self.num_bars = 0
+        self.num_windows = 0
+        self.failed = []
+        self._writer_error = None
+
+    def done_windows(self) -> set:
+        """Get the windows written by previous runs"""
+        if not os.path.exists(self.state_file):
+            return set()
+        with open(self.state_file, 'r') as f:
+            return {tuple(line.rstrip('\n').split('\t')) for line in f if line.strip()}
+
+    def _session(self) -> requests.Session:
+        """One HTTP session, and so one connection pool, per worker thread"""
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def fetch(self, window: tuple) -> list:
+        """Fetch the bars of a window. Timeouts, 429, 5xx and 200 responses
+        without bars are retried.
+        Returns:
+            list: The rows, None if the window failed
+        """
+        ticker, start, end = window
+        url = f"{self.base_url}/{ticker}?interval=1&unit=Minute&firstdate={start}&lastdate={end}"
+        for attempt in range(self.retries):
+            self.rate_limiter.acquire(url)
+            headers = {'Authorization': f'Bearer {self.get_access_token()}'}
+            try:
+                response = self._session().get(url, headers=headers, timeout=self.timeout)
+            except requests.exceptions.RequestException as ex:
+                print(f"Error getting bars for {ticker} on {start} - {end}: {ex}")
+            else:
+                if response.status_code == 200:
+                    # A 200 with an error body instead of the bars is retried
+                    try:
+                        return bars_to_rows(ticker, response.json()['Bars'])
+                    except (ValueError, KeyError, TypeError) as ex:
+                        print(f"Invalid response getting bars for {ticker} on {start} - {end}: {ex!r}")
+                else:
+                    print(f"Error {response.status_code} getting bars for {ticker} on {start} - {end}")
+                    if response.status_code != 429 and response.status_code < 500:
+                        return None
+            time.sleep(2 ** attempt)
+        return None
+
+    def _writer(self, results: queue.Queue) -> None:
+        """Write the fetched windows in batches and record them as done.
+        A None on the queue flushes and stops the writer. If writing fails
+        the error is kept for run() and the queue is drained so the
+        fetchers do not block."""
+        rows = []
+        windows = []
+        with open(self.state_file, 'a') as state:
+            while True:
+                item = results.get()
+                if self._writer_error is not None:
+                    if item is None:
+                        return
+                    continue
+                if item is not None:
+                    window, window_rows = item
+                    rows.extend(window_rows)
+                    windows.append(window)
+                if len(windows) > 0 and (item is None or len(rows) >= self.batch_rows):
+                    try:
+                        if len(rows) > 0:
+                            self.write_rows(rows)
+                    except Exception as ex:
+                        self._writer_error = ex
+                        if item is None:
+                            return
+                        continue
+                    state.write(''.join('\t'.join(window) + '\n' for window in windows))
+                    state.flush()
+                    if self.on_done is not None:
+                        self.on_done(windows)
+                    self.num_bars += len(rows)
+                    self.num_windows += len(windows)
+                    rows = []
+                    windows = []
+                if item is None:
+                    return
+
+    def run(self, windows: list, report_interval: float = 10.0) -> None:
+        """Backfill the windows not done yet, reporting the throughput.
+        Args:
+            windows (list): The windows from plan_windows
+            report_interval (float): Seconds between progress reports
+        """
+        done = self.done_windows()
+        todo = [window for window in windows if window not in done]
+        print(f"Backfilling {len(todo)} windows, {len(windows) - len(todo)} already done")
+        results = queue.Queue(maxsize=self.workers * 4)
+        writer = threading.Thread(target=self._writer, args=(results,), daemon=True)
+        writer.start()
+        start_time = time.monotonic()
+        last_report = start_time
+
+        def fetch_window(window):
+            rows = self.fetch(window)
+            if rows is None:
+                self.failed.append(window)
+            else:
+                results.put((window, rows))
+
+        # Submit in bounded slices so a long plan is not all queued at once
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                for i in range(0, len(todo), self.workers * 4):
+                    for future in [pool.submit(fetch_window, window) for window in todo[i:i + self.workers * 4]]:
+                        future.result()
+                    if self._writer_error is not None:
+                        break
+                    if time.monotonic() - last_report >= report_interval:
+                        last_report = time.monotonic()
+                        self.report(start_time)
+        finally:
+            results.put(None)
+            writer.join()
+        self.report(start_time)
+        if self._writer_error is not None:
+            raise self._writer_error
+        if len(self.failed) > 0:
+            print(f"{len(self.failed)} windows failed and will be retried by the next run: {self.failed}")
+
+    def report(self, start_time: float) -> None:
+        """Print the windows and bars written per second"""
+        elapsed = max(time.monotonic() - start_time, 1e-9)
+        print(f"{self.num_windows} windows, {self.num_bars} bars written in {elapsed:.1f} s: "
+              f"{self.num_windows / elapsed:.1f} windows/s, {self.num_bars / elapsed:.0f} bars/s")
+
+
+if __name__ == "__main__":
+
+    # Backfill from a local fake barcharts endpoint, which fails some
+    # requests, then interrupt a run and check the next one resumes
+    import json
+    import random
+    import tempfile
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    from urllib.parse import parse_qs
+
+    class FakeBarcharts(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            parts = urlsplit(self.path)
+            if random.random() < 0.1:
+                self.send_response(random.choice([429, 500, 503]))
+                self.end_headers()
+                return
+            query = parse_qs(parts.query)
+            first = dt.strptime(query['firstdate'][0], DATE_FORMAT)
+            last = dt.strptime(query['lastdate'][0], DATE_FORMAT)
+            bars = []
+            minute = first
+            while minute <= last:
+                bars.append({'TimeStamp': minute.strftime(DATE_FORMAT), 'Open': '1', 'High': '2',
+                             'Low': '0.5', 'Close': '1.5', 'TotalVolume': '10', 'OpenInterest': '0',
+                             'BarStatus': 'Closed'})
+                minute += timedelta(minutes=1)
+            body = json.dumps({'Bars': bars}).encode()
+            time.sleep(0.02)
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeBarcharts)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v3/marketdata/barcharts"
+    state_file = os.path.join(tempfile.mkdtemp(), STATE_FILE)
+    windows = plan_windows(['ESU23', 'NQU23', 'RTYU23', 'SPY'], "2023-06-01T00:00:00Z", "2023-06-30T12:00:00Z")
+
+    written = []
+    def write_rows(rows):
+        written.extend((row[0], row[1]) for row in rows)
+
+    # The first run is interrupted by the writer failing part way
+    def failing_write_rows(rows):
+        if len(written) > 40000:
+            raise RuntimeError("Database went away")
+        write_rows(rows)
+
+    random.seed(1)
+    first = Backfill(base_url, lambda: "token", failing_write_rows, state_file, workers=8, rate=200.0)
+    try:
+        first.run(windows)
+    except Exception as ex:
+        print(f"First run failed: {ex}")
+
+    while True:
+        backfill = Backfill(base_url, lambda: "token", write_rows, state_file, workers=8, rate=200.0)
+        backfill.run(windows, report_interval=1.0)
+        if len(backfill.failed) == 0:
+            break
+    expected = sum(1440 if not end.endswith("12:00:00Z") else 721 for _, _, end in windows)
+    print(f"Rows written: {len(written)}, unique: {len(set(written))}, expected: {expected}")
+    server.shutdown()
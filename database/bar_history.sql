@@ -10,4 +10,10 @@ CREATE TABLE `bars_1min` (
   `open_interest` int NULL,
   KEY (`id`),
   PRIMARY KEY (`ticker`, `datetime`)
-) ENGINE=InnoDB AUTO_INCREMENT=1 DEFAULT CHARSET=utf8;
\ No newline at end of file
+) ENGINE=InnoDB AUTO_INCREMENT=1 DEFAULT CHARSET=utf8;
+
+-- Higher timeframe bars, maintained from bars_1min by database/aggregation.py
+CREATE TABLE IF NOT EXISTS `bars_5min` LIKE `bars_1min`;
+CREATE TABLE IF NOT EXISTS `bars_15min` LIKE `bars_1min`;
+CREATE TABLE IF NOT EXISTS `bars_60min` LIKE `bars_1min`;
+CREATE TABLE IF NOT EXISTS `bars_1day` LIKE `bars_1min`;
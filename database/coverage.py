@@ -0,0 +1,280 @@
+# Coverage index of bars_1min, to fetch only the minutes that are missing
+import os
+import re
+import json
+import bisect
+import datetime
+import pytz
+
+"""
+Keeps, per ticker, the minutes of bars_1min that are known to be complete
+as a sorted list of disjoint [start, end) ranges of minutes since the epoch
+(UTC, like the datetime column). A minute is covered when it has a bar or
+when it was fetched from the API and had none, e.g. no trades.
+
+The minutes expected for a ticker come from its trading session calendar,
+so the missing windows are the expected minutes minus the covered ones.
+Only those are fetched, so a repair costs in proportion to the gaps rather
+than to the size of the history.
+
+The index is a small JSON file per ticker in COVERAGE_DIR. It is refreshed
+from the database incrementally: only rows at or after the last scanned
+minute are read, compressed into ranges by MySQL itself.
+"""
+
+COVERAGE_DIR = "coverage"
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+MINUTES_PER_DAY = 24 * 60
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+# Futures symbols are a root, a month code and a 2 digit year, e.g. ESU23
+FUTURES_SYMBOL = re.compile(r'^@?[A-Z]{1,3}[FGHJKMNQUVXZ]\d{2}$')
+
+def to_minute(value: datetime.datetime) -> int:
+    """Minutes since the epoch of a naive UTC datetime"""
+    return int((value - _EPOCH).total_seconds() // 60)
+
+def from_minute(minute: int) -> datetime.datetime:
+    """Naive UTC datetime of a number of minutes since the epoch"""
+    return _EPOCH + datetime.timedelta(minutes=minute)
+
+def union(a: list, b: list) -> list:
+    """Union of two sorted lists of disjoint [start, end) ranges"""
+    merged = []
+    for start, end in sorted(a + b):
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def subtract(a: list, b: list) -> list:
+    """Ranges of a that are not in b, both sorted lists of disjoint [start, end) ranges"""
+    result = []
+    j = 0
+    for start, end in a:
+        while j < len(b) and b[j][1] <= start:
+            j += 1
+        k = j
+        while k < len(b) and b[k][0] < end:
+            if b[k][0] > start:
+                result.append([start, b[k][0]])
+            start = max(start, b[k][1])
+            k += 1
+        if start < end:
+            result.append([start, end])
+    return result
+
+class SessionCalendar:
+    """Weekly trading sessions in an exchange time zone, with holidays."""
+
+    def __init__(self, timezone: str, open_time: datetime.time, close_time: datetime.time,
+                 weekdays: tuple = (0, 1, 2, 3, 4), holidays: tuple = ()):
+        """Constructor
+        Args:
+            timezone (str): The exchange time zone, e.g. 'America/New_York'
+            open_time (datetime.time): The session open. If it is after the
+                close the session opens the evening before the trading day.
+            close_time (datetime.time): The session close
+            weekdays (tuple): The trading days, Monday is 0
+            holidays (tuple): Dates, as datetime.date, with no session
+        """
+        self.timezone = pytz.timezone(timezone)
+        self.open_time = open_time
+        self.close_time = close_time
+        self.weekdays = weekdays
+        self.holidays = set(holidays)
+
+    def _to_minute(self, day: datetime.date, time: datetime.time) -> int:
+        local = self.timezone.localize(datetime.datetime.combine(day, time))
+        return to_minute(local.astimezone(pytz.utc).replace(tzinfo=None))
+
+    def sessions(self, start: int, end: int) -> list:
+        """Get the session minutes within [start, end).
+        Args:
+            start (int): The first minute since the epoch
+            end (int): The end minute since the epoch
+        Returns:
+            list: Sorted [start, end) ranges of minutes
+        """
+        ranges = []
+        day = from_minute(start).date() - datetime.timedelta(days=1)
+        last_day = from_minute(end).date() + datetime.timedelta(days=1)
+        while day <= last_day:
+            if day.weekday() in self.weekdays and day not in self.holidays:
+                open_day = day - datetime.timedelta(days=1) if self.open_time > self.close_time else day
+                session_start = max(self._to_minute(open_day, self.open_time), start)
+                session_end = min(self._to_minute(day, self.close_time), end)
+                if session_start < session_end:
+                    ranges.append([session_start, session_end])
+            day += datetime.timedelta(days=1)
+        return union(ranges, [])
+
+# CME Globex equity index futures trade from 18:00 the evening before to
+# 17:00 ET, US equities from 09:30 to 16:00 ET
+CME_FUTURES = SessionCalendar('America/New_York', datetime.time(18, 0), datetime.time(17, 0))
+US_EQUITIES = SessionCalendar('America/New_York', datetime.time(9, 30), datetime.time(16, 0))
+
+def calendar_for(ticker: str) -> SessionCalendar:
+    """Get the session calendar of a ticker from its symbol"""
+    return CME_FUTURES if FUTURES_SYMBOL.match(ticker) else US_EQUITIES
+
+class CoverageIndex:
+    """The covered minute ranges of one ticker."""
+
+    def __init__(self, ticker: str, coverage_dir: str = COVERAGE_DIR):
+        """Constructor, loads the index from its file if there is one
+        Args:
+            ticker (str): The ticker
+            coverage_dir (str): The directory of the index files
+        """
+        self.ticker = ticker
+        self.filename = os.path.join(coverage_dir, f"{ticker}.json")
+        self.covered = []
+        # The ranges fetched from the API, kept when the index is rebuilt
+        # as the minutes with no trades have no rows
+        self.checked = []
+        self.scanned_until = None
+        if os.path.exists(self.filename):
+            with open(self.filename, 'r') as f:
+                state = json.load(f)
+            self.covered = state['covered']
+            self.checked = state.get('checked', [])
+            self.scanned_until = state['scanned_until']
+
+    def save(self) -> None:
+        """Write the index, atomically"""
+        os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, 'w') as f:
+            json.dump({'ticker': self.ticker, 'covered': self.covered, 'checked': self.checked,
+                       'scanned_until': self.scanned_until}, f)
+        os.replace(tmp_filename, self.filename)
+
+    def add(self, start: int, end: int) -> None:
+        """Mark the minutes [start, end) as covered"""
+        i = bisect.bisect_left(self.covered, [start, start])
+        lo = max(i - 1, 0)
+        hi = i
+        while hi < len(self.covered) and self.covered[hi][0] <= end:
+            hi += 1
+        self.covered[lo:hi] = union(self.covered[lo:hi], [[start, end]])
+
+    def mark_checked(self, first_date: str, last_date: str) -> None:
+        """Mark a window fetched from the API as covered, whether or not it had bars.
+        Args:
+            first_date (str): The firstdate of the request, YYYY-MM-DDTHH:MM:SSZ
+            last_date (str): The lastdate of the request, included
+        """
+        start = to_minute(datetime.datetime.strptime(first_date, DATE_FORMAT))
+        end = to_minute(datetime.datetime.strptime(last_date, DATE_FORMAT)) + 1
+        self.add(start, end)
+        self.checked = union(self.checked, [[start, end]])
+
+    def refresh_from_db(self, db_conn, rebuild: bool = False) -> None:
+        """Add the rows at or after the last scanned minute. MySQL groups
+        consecutive minutes into ranges, only the ranges are transferred.
+        Args:
+            db_conn: The database connection
+            rebuild (bool): Scan the whole history of the ticker again,
+                the minutes checked with mark_checked stay covered
+        """
+        since = 0 if rebuild or self.scanned_until is None else self.scanned_until
+        query  = "SELECT MIN(minute), MAX(minute) + 1 FROM ("
+        query += "SELECT minute, minute - CAST(ROW_NUMBER() OVER (ORDER BY minute) AS SIGNED) AS island FROM ("
+        query += "SELECT TIMESTAMPDIFF(MINUTE, '1970-01-01 00:00:00', datetime) AS minute "
+        query += "FROM bars_1min WHERE ticker = %s AND datetime >= %s) AS minutes) AS islands "
+        query += "GROUP BY island ORDER BY 1"
+        cur = db_conn.cursor()
+        cur.execute(query, (self.ticker, from_minute(since).strftime("%Y-%m-%d %H:%M:%S")))
+        ranges = [[int(start), int(end)] for start, end in cur.fetchall()]
+        self.covered = union(self.checked, ranges) if rebuild else union(self.covered, ranges)
+        if len(ranges) > 0:
+            self.scanned_until = max(since, ranges[-1][1] - 1)
+
+    def missing(self, start: int, end: int, calendar: SessionCalendar = None) -> list:
+        """Get the expected minutes in [start, end) that are not covered
+        Args:
+            start (int): The first minute since the epoch
+            end (int): The end minute since the epoch
+            calendar (SessionCalendar): The sessions, from the ticker symbol if None
+        Returns:
+            list: Sorted [start, end) ranges of minutes
+        """
+        calendar = calendar or calendar_for(self.ticker)
+        return subtract(calendar.sessions(start, end), self.covered)
+
+    def missing_windows(self, start_date: str, end_date: str, calendar: SessionCalendar = None,
+                        merge_minutes: int = 30) -> list:
+        """Get the request windows that fetch the missing minutes of a range.
+        Gaps closer than merge_minutes are fetched with one request, and
+        windows are split at midnight UTC like the daily requests of get_bars.
+        The minutes that have not ended yet are not expected.
+        Args:
+            start_date (str): The start, YYYY-MM-DDTHH:MM:SSZ
+            end_date (str): The end, YYYY-MM-DDTHH:MM:SSZ
+            calendar (SessionCalendar): The sessions, from the ticker symbol if None
+            merge_minutes (int): Largest covered run between gaps fetched again
+                to save a request
+        Returns:
+            list: (ticker, firstdate, lastdate) windows, see backfill.plan_windows
+        """
+        start = to_minute(datetime.datetime.strptime(start_date, DATE_FORMAT))
+        end = min(to_minute(datetime.datetime.strptime(end_date, DATE_FORMAT)) + 1,
+                  to_minute(datetime.datetime.utcnow()))
+        gaps = []
+        for gap_start, gap_end in self.missing(start, end, calendar):
+            if len(gaps) > 0 and gap_start - gaps[-1][1] < merge_minutes \
+                    and gap_start // MINUTES_PER_DAY == gaps[-1][0] // MINUTES_PER_DAY:
+                gaps[-1][1] = gap_end
+            else:
+                gaps.append([gap_start, gap_end])
+        windows = []
+        for gap_start, gap_end in gaps:
+            while gap_start < gap_end:
+                window_end = min(gap_end, (gap_start // MINUTES_PER_DAY + 1) * MINUTES_PER_DAY)
+                windows.append((self.ticker, from_minute(gap_start).strftime(DATE_FORMAT),
+                                from_minute(window_end - 1).strftime(DATE_FORMAT)))
+                gap_start = window_end
+        return windows
+
+    def missing_minutes(self, start_date: str, end_date: str, calendar: SessionCalendar = None) -> int:
+        """Get the number of expected minutes of a range that are missing"""
+        start = to_minute(datetime.datetime.strptime(start_date, DATE_FORMAT))
+        end = to_minute(datetime.datetime.strptime(end_date, DATE_FORMAT)) + 1
+        return sum(gap_end - gap_start for gap_start, gap_end in self.missing(start, end, calendar))
+
+
+if __name__ == "__main__":
+
+    # Build an index of a week of ES bars with holes and show the windows to fetch
+    import tempfile
+
+    index = CoverageIndex('ESU23', tempfile.mkdtemp())
+    for start, end in CME_FUTURES.sessions(to_minute(datetime.datetime(2023, 7, 9)),
+                                           to_minute(datetime.datetime(2023, 7, 15))):
+        index.add(start, end)
+    # An outage, a failed day and a few minutes with no trades
+    holes = [[to_minute(datetime.datetime(2023, 7, 11, 14, 5)), to_minute(datetime.datetime(2023, 7, 11, 15, 40))],
+             [to_minute(datetime.datetime(2023, 7, 13, 0, 0)), to_minute(datetime.datetime(2023, 7, 14, 0, 0))],
+             [to_minute(datetime.datetime(2023, 7, 12, 3, 1)), to_minute(datetime.datetime(2023, 7, 12, 3, 3))],
+             [to_minute(datetime.datetime(2023, 7, 12, 3, 20)), to_minute(datetime.datetime(2023, 7, 12, 3, 21))]]
+    index.covered = subtract(index.covered, sorted(holes))
+    print(f"Covered ranges: {len(index.covered)}")
+    missing_minutes = index.missing_minutes('2023-07-09T00:00:00Z', '2023-07-15T00:00:00Z')
+    print(f"Missing minutes: {missing_minutes}")
+    # 95 minutes of outage, 2 and 1 with no trades and the 1380 of the
+    # session on the failed day, 21:00 to 22:00 is the daily break
+    assert missing_minutes == 95 + 2 + 1 + 1380
+    windows = index.missing_windows('2023-07-09T00:00:00Z', '2023-07-15T00:00:00Z')
+    for window in windows:
+        print(window)
+        index.mark_checked(window[1], window[2])
+    assert windows == [('ESU23', '2023-07-11T14:05:00Z', '2023-07-11T15:39:00Z'),
+                       ('ESU23', '2023-07-12T03:01:00Z', '2023-07-12T03:20:00Z'),
+                       ('ESU23', '2023-07-13T00:00:00Z', '2023-07-13T20:59:00Z'),
+                       ('ESU23', '2023-07-13T22:00:00Z', '2023-07-13T23:59:00Z')]
+    missing_minutes = index.missing_minutes('2023-07-09T00:00:00Z', '2023-07-15T00:00:00Z')
+    print(f"Missing after fetching the windows: {missing_minutes}")
+    assert missing_minutes == 0
+    index.save()
@@ -1,6 +1,9 @@
 #!/home/jrseti/jrbot2/jrbot2_venv/bin/python
 import os
 import sys
+import shutil
+import argparse
+import tempfile
 from datetime import datetime as dt
 from datetime import timedelta
 import requests
@@ -13,27 +16,26 @@ from config import API_BASE_URL, API_BARCHARTS_URI
 from config import API_KEY, API_SECRET_KEY
 from config import DB_HOST, DB_USER, DB_PASS, DB_NAME
 from utils.datetime_utils import *
+from database.backfill import Backfill, plan_windows, bars_to_rows, STATE_FILE
+from database.coverage import CoverageIndex
+from database.aggregation import BarAggregator
+from utils.bar_cache import invalidate_days
 
 #from ..config import *
 
 def toDb(db_conn, ticker, query_reqults):
 
-    values = []
-    for bar in query_reqults['Bars']:
-        #print(bar)
-        if(bar['BarStatus'] != 'Closed'):
-            continue
-        bar_values = []
-        bar_values.append(ticker)
-        bar_values.append(bar['TimeStamp'].replace('T',' ').replace('Z', ''))
-        bar_values.append(bar['Open'])
-        bar_values.append(bar['High'])
-        bar_values.append(bar['Low'])
-        bar_values.append(bar['Close'])
-        bar_values.append(bar['TotalVolume'])
-        bar_values.append(bar['OpenInterest'])
-        values.append(bar_values)
+    insert_rows(db_conn, bars_to_rows(ticker, query_reqults['Bars']), ticker)
 
+def insert_rows(db_conn, values, label="bars_1min"):
+    """Insert rows into bars_1min, rows already there are left as they are
+    so a window can be written again after an interrupted run. The days
+    written are removed from the bar cache, to be read again.
+    Args:
+        db_conn: The database connection
+        values (list): Rows from backfill.bars_to_rows
+        label (str): Name printed with the number of rows inserted
+    """
     # Create the insert strings
     column_str = (
         "ticker, datetime, open, high, "
@@ -41,7 +43,7 @@ def toDb(db_conn, ticker, query_reqults):
     )
 
     insert_str = ("%s, " * 8)[:-2]
-    final_str = "INSERT INTO bars_1min (%s) VALUES (%s)" % \
+    final_str = "INSERT IGNORE INTO bars_1min (%s) VALUES (%s)" % \
         (column_str, insert_str)
     
     #print(values)
@@ -51,8 +53,13 @@ def toDb(db_conn, ticker, query_reqults):
     cur = db_conn.cursor()
     result = cur.executemany(final_str, values)
     if result is not None:
-        print(f"{ticker}: Inserted {result} rows")
+        print(f"{label}: Inserted {result} rows")
     db_conn.commit()
+    days = {}
+    for row in values:
+        days.setdefault(row[0], set()).add(dt.strptime(row[1][:10], "%Y-%m-%d").date())
+    for ticker, ticker_days in days.items():
+        invalidate_days(ticker, ticker_days)
 
 def to_dbase_since_last(db_conn, access_token, ticker):
     """Get the bars for the given ticker and time period. Puth them in the database
@@ -73,6 +80,7 @@ def to_dbase_since_last(db_conn, access_token, ticker):
     #print(start_date)
     end_date = dt.now().strftime("%Y-%m-%dT%H:%M:%SZ")
     get_bars(access_token, ticker, start_date, end_date)
+    aggregate(db_conn, [ticker])
 
     
 
@@ -134,32 +142,154 @@ def get_bars(access_token, ticker, start_date, end_date):
 
         #print(f"end of while loop, start_dt={start_dt}")
 
-print("Starting")
-# open the database connection
-db_host = DB_HOST
-db_user = DB_USER
-db_pass = DB_PASS
-db_name = DB_NAME
-con = mdb.connect(host=db_host, user=db_user, passwd=db_pass, db=db_name)
+def aggregate(db_conn, tickers, since=None):
+    """Update the higher timeframe tables of the tickers from bars_1min
+    Args:
+        db_conn: The database connection
+        tickers (list): The tickers
+        since (dict): Optional ticker to the naive UTC datetime from which
+            the buckets are rebuilt, e.g. after a backfill
+    """
+    aggregator = BarAggregator(db_conn)
+    aggregator.create_tables()
+    for ticker in tickers:
+        written = aggregator.update(ticker, None if since is None else since.get(ticker))
+        print(f"{ticker}: Aggregated {written}")
 
-ts = TS_Auth(API_KEY, API_SECRET_KEY)
-ts.start_auth0()
+def _earliest_windows(windows):
+    """Get the earliest start of the windows written for each ticker"""
+    since = {}
+    for ticker, first_date, _ in windows:
+        first = dt.strptime(first_date, "%Y-%m-%dT%H:%M:%SZ")
+        since[ticker] = min(since.get(ticker, first), first)
+    return since
 
-access_token = ts.get_access_token()
+def backfill(db_conn, ts, tickers, start_date, end_date, workers=8, rate=5.0,
+             state_file=STATE_FILE):
+    """Backfill the tickers over [start_date, end_date] concurrently, resuming
+    the windows not done by a previous run with the same state file.
+    Args:
+        db_conn: The database connection, used by the writer thread only
+        ts (TS_Auth): The authenticated TS_Auth object
+        tickers (list): The tickers
+        start_date (str): The start in the format YYYY-MM-DDTHH:MM:SSZ
+        end_date (str): The end in the format YYYY-MM-DDTHH:MM:SSZ
+        workers (int): Number of concurrent requests
+        rate (float): Requests per second
+        state_file (str): The file recording the windows done
+    """
+    base_url = f"{API_BASE_URL.replace('sim-','')}/{API_BARCHARTS_URI}"
+    written = []
+    runner = Backfill(base_url, ts.get_access_token, lambda rows: insert_rows(db_conn, rows),
+                      state_file, workers=workers, rate=rate, on_done=written.extend)
+    runner.run(plan_windows(tickers, start_date, end_date))
+    if len(written) > 0:
+        aggregate(db_conn, tickers, _earliest_windows(written))
+
+def repair(db_conn, ts, tickers, start_date, end_date, workers=8, rate=5.0, rebuild=False):
+    """Fetch only the minutes of [start_date, end_date] missing from bars_1min,
+    using the coverage index of each ticker. The index is the only record of
+    what was fetched, the Backfill state file of a repair is thrown away.
+    Args:
+        db_conn: The database connection
+        ts (TS_Auth): The authenticated TS_Auth object
+        tickers (list): The tickers
+        start_date (str): The start in the format YYYY-MM-DDTHH:MM:SSZ
+        end_date (str): The end in the format YYYY-MM-DDTHH:MM:SSZ
+        workers (int): Number of concurrent requests
+        rate (float): Requests per second
+        rebuild (bool): Rebuild the coverage indexes from the whole table
+    """
+    indexes = {}
+    windows = []
+    for ticker in tickers:
+        index = CoverageIndex(ticker)
+        index.refresh_from_db(db_conn, rebuild=rebuild)
+        index.save()
+        indexes[ticker] = index
+        ticker_windows = index.missing_windows(start_date, end_date)
+        print(f"{ticker}: {index.missing_minutes(start_date, end_date)} minutes missing in {len(ticker_windows)} windows")
+        windows += ticker_windows
+    if len(windows) == 0:
+        return
 
-#TICKER = "RTYU23"
-TICKERS = ['RTYU23', 'SPY','$DJX.X']
-#TICKERS = ['RTYU23']
-TICKERS = [ 'RTYU23','SPY', 'ESU23']
+    written = []
+    def on_done(done_windows):
+        written.extend(done_windows)
+        # Fetched windows are covered even where the API had no bars
+        for ticker, first_date, last_date in done_windows:
+            indexes[ticker].mark_checked(first_date, last_date)
+        for ticker in {window[0] for window in done_windows}:
+            indexes[ticker].save()
 
-start_date = "2023-06-24T00:00:00Z"
-#start_date = "2023-01-01T00:00:00Z"
-#start_date = "2023-07-11T00:00:00Z"
-end_date = dt.now().strftime("%Y-%m-%dT%H:%M:%SZ")
-#get_bars(access_token, TICKER, start_date, end_date)
-for ticker in TICKERS:
-    #get_bars(access_token, ticker, start_date, end_date)
-    to_dbase_since_last(con, access_token, ticker)
+    base_url = f"{API_BASE_URL.replace('sim-','')}/{API_BARCHARTS_URI}"
+    state_dir = tempfile.mkdtemp()
+    try:
+        runner = Backfill(base_url, ts.get_access_token, lambda rows: insert_rows(db_conn, rows),
+                          os.path.join(state_dir, STATE_FILE), workers=workers, rate=rate, on_done=on_done)
+        runner.run(windows)
+    finally:
+        shutil.rmtree(state_dir)
+    if len(written) > 0:
+        aggregate(db_conn, tickers, _earliest_windows(written))
 
 
-   
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Feeds bars_1min from the barcharts API.')
+    parser.add_argument('-t', '--tickers', nargs='+', help='The tickers, defaults to TICKERS')
+    parser.add_argument('-b', '--backfill', nargs=2, metavar=('START', 'END'),
+                        help='Backfill concurrently from START to END, YYYY-MM-DDTHH:MM:SSZ. \
+                            Run it again to resume after a failure.')
+    parser.add_argument('-w', '--workers', type=int, default=8, help='Concurrent requests of a backfill')
+    parser.add_argument('-r', '--rate', type=float, default=5.0, help='Requests per second of a backfill')
+    parser.add_argument('-s', '--state_file', default=STATE_FILE, help='The backfill state file')
+    parser.add_argument('--repair', nargs=2, metavar=('START', 'END'),
+                        help='Fetch only the minutes missing from START to END, \
+                            YYYY-MM-DDTHH:MM:SSZ, using the coverage index.')
+    parser.add_argument('--rebuild', action='store_true', help='Rebuild the coverage \
+                            index from the whole table before a repair')
+    parser.add_argument('-a', '--aggregate', action='store_true', help='Only update the \
+                            higher timeframe tables, e.g. bars_5min, from bars_1min')
+    args = parser.parse_args()
+
+    print("Starting")
+    # open the database connection
+    db_host = DB_HOST
+    db_user = DB_USER
+    db_pass = DB_PASS
+    db_name = DB_NAME
+    con = mdb.connect(host=db_host, user=db_user, passwd=db_pass, db=db_name)
+
+    ts = TS_Auth(API_KEY, API_SECRET_KEY)
+    ts.start_auth0()
+
+    access_token = ts.get_access_token()
+
+    #TICKER = "RTYU23"
+    TICKERS = ['RTYU23', 'SPY','$DJX.X']
+    #TICKERS = ['RTYU23']
+    TICKERS = [ 'RTYU23','SPY', 'ESU23']
+    if args.tickers is not None:
+        TICKERS = args.tickers
+
+    if args.backfill is not None:
+        backfill(con, ts, TICKERS, args.backfill[0], args.backfill[1],
+                 workers=args.workers, rate=args.rate, state_file=args.state_file)
+        sys.exit(0)
+    if args.aggregate:
+        aggregate(con, TICKERS)
+        sys.exit(0)
+    if args.repair is not None:
+        repair(con, ts, TICKERS, args.repair[0], args.repair[1],
+               workers=args.workers, rate=args.rate, rebuild=args.rebuild)
+        sys.exit(0)
+
+    start_date = "2023-06-24T00:00:00Z"
+    #start_date = "2023-01-01T00:00:00Z"
+    #start_date = "2023-07-11T00:00:00Z"
+    end_date = dt.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+    #get_bars(access_token, TICKER, start_date, end_date)
+    for ticker in TICKERS:
+        #get_bars(access_token, ticker, start_date, end_date)
+        to_dbase_since_last(con, access_token, ticker)
@@ -0,0 +1,214 @@
+# dispatcher.py
+
+import queue
+from collections import deque
+from event import MarketEvent, SignalEvent
+
+
+class EventDispatcher(object):
+    """
+    Holds the pending events and routes each one to the handlers
+    registered for its class.
+
+    In a backtest everything runs in one thread, so the events are kept
+    in a collections.deque and put/get take no lock. In live mode events
+    are put by other threads, e.g. the data streams, and a queue.Queue is
+    used so get can block until an event arrives.
+
+    put, get, empty and qsize behave like queue.Queue, so the dispatcher
+    can be passed as the events queue of a DataHandler or Strategy.
+    """
+
+    def __init__(self, live=False):
+        """
+        Initialises the dispatcher.
+
+        Parameters:
+        live - True to use a thread safe queue.Queue, False for a deque.
+        """
+        self.live = live
+        self.handlers = {}
+        self._resolved = {}
+        if live:
+            self._queue = queue.Queue()
+            self.put = self._queue.put
+        else:
+            self._queue = deque()
+            self.put = self._queue.append
+
+    def register(self, event_class, handler):
+        """
+        Registers a handler, called with each event of event_class or
+        of a subclass of it, in registration order.
+
+        Parameters:
+        event_class - The Event subclass, e.g. MarketEvent.
+        handler - A callable taking the event.
+        """
+        self.handlers.setdefault(event_class, []).append(handler)
+        self._resolved.clear()
+
+    def _handlers_for(self, event_class):
+        """
+        Gets the handlers of an event class, including those registered
+        for its base classes. The lookup is cached per class.
+        """
+        handlers = self._resolved.get(event_class)
+        if handlers is None:
+            handlers = [handler for cls in event_class.__mro__
+                        for handler in self.handlers.get(cls, ())]
+            self._resolved[event_class] = handlers
+        return handlers
+
+    def get(self, block=True, timeout=None):
+        """
+        Removes and returns the next event. Raises queue.Empty if
+        there is none, a backtest never blocks.
+        """
+        if self.live:
+            return self._queue.get(block, timeout)
+        try:
+            return self._queue.popleft()
+        except IndexError:
+            raise queue.Empty
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def qsize(self):
+        return self._queue.qsize() if self.live else len(self._queue)
+
+    def dispatch(self, event):
+        """
+        Calls the handlers of an event.
+        """
+        for handler in self._resolved.get(event.__class__) or self._handlers_for(event.__class__):
+            handler(event)
+
+    def dispatch_pending(self):
+        """
+        Dispatches events until there are none left, including those
+        put by the handlers.
+
+        Returns:
+        The number of events dispatched.
+        """
+        count = 0
+        if self.live:
+            get = self._queue.get_nowait
+            while True:
+                try:
+                    event = get()
+                except queue.Empty:
+                    return count
+                self.dispatch(event)
+                count += 1
+        pending = self._queue
+        popleft = pending.popleft
+        resolved = self._resolved
+        while pending:
+            event = popleft()
+            for handler in resolved.get(event.__class__) or self._handlers_for(event.__class__):
+                handler(event)
+            count += 1
+        return count
+
+    def run_live(self, timeout=1.0, keep_running=lambda: True):
+        """
+        Waits for events and dispatches them while keep_running() is True.
+        Only for live mode.
+
+        Parameters:
+        timeout - Seconds to wait for an event before checking keep_running.
+        keep_running - A callable returning False to stop.
+        """
+        while keep_running():
+            try:
+                event = self._queue.get(True, timeout)
+            except queue.Empty:
+                continue
+            self.dispatch(event)
+
+
+if __name__ == "__main__":
+
+    # Benchmark: events per second through each mode, and through a
+    # queue.Queue dispatched on the type strings as before
+    import time
+    import threading
+
+    NUM_EVENTS = 500000
+    market_events = [MarketEvent('ES') for _ in range(NUM_EVENTS)]
+
+    def run_backtest(live):
+        dispatcher = EventDispatcher(live=live)
+        counts = {'market': 0, 'signal': 0}
+
+        def on_market(event):
+            counts['market'] += 1
+            if counts['market'] % 10 == 0:
+                dispatcher.put(SignalEvent('bench', event.ticker, None, 'LONG', 1.0))
+
+        def on_signal(event):
+            counts['signal'] += 1
+
+        dispatcher.register(MarketEvent, on_market)
+        dispatcher.register(SignalEvent, on_signal)
+        start = time.perf_counter()
+        for event in market_events:
+            dispatcher.put(event)
+            dispatcher.dispatch_pending()
+        elapsed = time.perf_counter() - start
+        total = counts['market'] + counts['signal']
+        return total, elapsed
+
+    def run_legacy():
+        events = queue.Queue()
+        counts = {'market': 0, 'signal': 0}
+        start = time.perf_counter()
+        for event in market_events:
+            events.put(event)
+            while True:
+                try:
+                    event = events.get(False)
+                except queue.Empty:
+                    break
+                if event.type == 'MARKET':
+                    counts['market'] += 1
+                    if counts['market'] % 10 == 0:
+                        events.put(SignalEvent('bench', event.ticker, None, 'LONG', 1.0))
+                elif event.type == 'SIGNAL':
+                    counts['signal'] += 1
+        elapsed = time.perf_counter() - start
+        return counts['market'] + counts['signal'], elapsed
+
+    def run_live_threaded():
+        # A producer thread puts the events while run_live dispatches them
+        dispatcher = EventDispatcher(live=True)
+        received = [0]
+        done = threading.Event()
+
+        def on_market(event):
+            received[0] += 1
+            if received[0] == NUM_EVENTS:
+                done.set()
+
+        dispatcher.register(MarketEvent, on_market)
+
+        def produce():
+            for event in market_events:
+                dispatcher.put(event)
+
+        start = time.perf_counter()
+        producer = threading.Thread(target=produce)
+        producer.start()
+        dispatcher.run_live(timeout=0.1, keep_running=lambda: not done.is_set())
+        producer.join()
+        return received[0], time.perf_counter() - start
+
+    for name, run in (("queue.Queue + type strings", run_legacy),
+                      ("EventDispatcher backtest (deque)", lambda: run_backtest(False)),
+                      ("EventDispatcher live (queue.Queue)", lambda: run_backtest(True)),
+                      ("EventDispatcher live, producer thread", run_live_threaded)):
+        total, elapsed = run()
+        print(f"{name}: {total} events in {elapsed:.2f} s, {total / elapsed:,.0f} events/s")
@@ -11,7 +11,11 @@ from email import encoders
 
 from config import EMAIL_FROM, EMAIL_PASSWD, EMAIL_RECIPIENTS
 
-def send_email(to_addr: str, subject: str, body: str, filename: str = None) -> None:
+SMTP_HOST = 'smtp.gmail.com'
+SMTP_PORT = 587
+
+def build_message(to_addr: str, subject: str, body: str, filename: str = None) -> MIMEMultipart:
+    """Build the email, with the file attached if there is one"""
 
     fromaddr = EMAIL_FROM
 
@@ -48,17 +52,34 @@ def send_email(to_addr: str, subject: str, body: str, filename: str = None) -> N
         # attach the instance 'p' to instance 'msg' 
         msg.attach(p) 
 
+    return msg
+
+def open_session(host: str = SMTP_HOST, port: int = SMTP_PORT, starttls: bool = True,
+                 user: str = EMAIL_FROM, password: str = EMAIL_PASSWD, timeout: float = 30.0) -> smtplib.SMTP:
+    """Open an SMTP session, with STARTTLS and a login unless user is None"""
+
     # creates SMTP session 
-    s = smtplib.SMTP('smtp.gmail.com', 587) 
+    s = smtplib.SMTP(host, port, timeout=timeout) 
 
     # start TLS for security 
-    s.starttls() 
+    if starttls:
+        s.starttls() 
 
     # Authentication 
-    s.login(EMAIL_FROM, EMAIL_PASSWD)
+    if user is not None:
+        s.login(user, password)
+
+    return s
+
+def send_email(to_addr: str, subject: str, body: str, filename: str = None) -> None:
+    """Send one email in its own SMTP session. Blocks for the whole
+    exchange, use notifier.TradeNotifier from a trading loop."""
+
+    # creates SMTP session 
+    s = open_session()
 
     # Converts the Multipart msg into a string 
-    text = msg.as_string() 
+    text = build_message(to_addr, subject, body, filename).as_string() 
 
     # sending the mail 
     s.sendmail(EMAIL_FROM, to_addr, text) 
@@ -5,21 +5,36 @@ class Event(object):
     Event is base class providing an interface for all subsequent 
     (inherited) events, that will trigger further events in the 
     trading infrastructure.   
+
+    Events are compact __slots__ objects. The type string is a class
+    attribute, dispatcher.EventDispatcher routes on the class itself.
     """
-    pass
+    __slots__ = ()
+    type = None
 
 class MarketEvent(Event):
     """
     Handles the event of receiving a new market update with 
     corresponding bars.
     """
+    __slots__ = ('ticker', 'datetime', 'tickers')
+    type = 'MARKET'
 
-    def __init__(self, ticker):
+    def __init__(self, ticker=None, datetime=None, tickers=None):
         """
         Initialises the MarketEvent.
+
+        Parameters:
+        ticker - The ticker with a new bar, if only one.
+        datetime - The datetime of the new bars, if known.
+        tickers - The list of tickers with a new bar at datetime. 
+            Defaults to [ticker].
         """
-        self.type = 'MARKET'
         self.ticker = ticker
+        self.datetime = datetime
+        if tickers is None:
+            tickers = [ticker] if ticker is not None else []
+        self.tickers = tickers
 
 
 class SignalEvent(Event):
@@ -27,7 +42,9 @@ class SignalEvent(Event):
     Handles the event of sending a Signal from a Strategy object.
     This is received by a Portfolio object and acted upon.
     """
-    
+    __slots__ = ('strategy_id', 'ticker', 'datetime', 'signal_type', 'strength')
+    type = 'SIGNAL'
+
     def __init__(self, strategy_id, ticker, datetime, signal_type, strength):
         """
         Initialises the SignalEvent.
@@ -41,7 +58,6 @@ class SignalEvent(Event):
             quantity at the portfolio level. Useful for pairs strategies.
         """
         self.strategy_id = strategy_id
-        self.type = 'SIGNAL'
         self.ticker = ticker
         self.datetime = datetime
         self.signal_type = signal_type
@@ -54,6 +70,8 @@ class OrderEvent(Event):
     The order contains a symbol (e.g. GOOG), a type (market or limit),
     quantity and a direction.
     """
+    __slots__ = ('symbol', 'order_type', 'quantity', 'direction')
+    type = 'ORDER'
 
     def __init__(self, symbol, order_type, quantity, direction):
         """
@@ -68,7 +86,6 @@ class OrderEvent(Event):
         quantity - Non-negative integer for quantity.
         direction - 'BUY' or 'SELL' for long or short.
         """
-        self.type = 'ORDER'
         self.symbol = symbol
         self.order_type = order_type
         self.quantity = self._check_set_quantity_positive(quantity)
@@ -99,6 +116,9 @@ class FillEvent(Event):
     actually filled and at what price. In addition, stores
     the commission of the trade from the brokerage.
     """
+    __slots__ = ('timeindex', 'symbol', 'exchange', 'quantity', 'direction',
+                 'fill_cost', 'commission')
+    type = 'FILL'
 
     def __init__(self, timeindex, symbol, exchange, quantity, 
                  direction, fill_cost, commission=None):
@@ -120,7 +140,6 @@ class FillEvent(Event):
         fill_cost - The holdings value in dollars.
         commission - An optional commission.
         """
-        self.type = 'FILL'
         self.timeindex = timeindex
         self.symbol = symbol
         self.exchange = exchange
@@ -1,7 +1,10 @@
 import sys
 import os
 import time
-from datetime import datetime
+import atexit
+import queue
+import threading
+from datetime import datetime, timedelta
 import logging, logging.handlers
 from logging import DEBUG, INFO, WARNING, ERROR, CRITICAL
 current = os.path.dirname(os.path.realpath(__file__))
@@ -9,37 +12,217 @@ parent = os.path.dirname(current)
 sys.path.append(parent)
 from config import LOG_MESSAGE_FORMAT, LOG_DIRECTORY
 
+# Most records the writer thread of a queued Logger formats and writes at once
+MAX_BATCH = 1000
+# Seconds between the summaries of the messages suppressed by the call sites
+SUMMARY_INTERVAL = 60.0
+
+def _format_fields(message, args, fields):
+    """Format a message with its % args and append the fields as key=value"""
+    if args:
+        message = message % args
+    if fields:
+        message += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+    return message
+
+class CallSite():
+    """A rate limited and sampled log call site of a Logger, see
+    Logger.call_site. Create it once and call it on the hot path."""
+
+    def __init__(self, logger, name, level, per_second, burst, sample_every):
+        self.logger = logger
+        self.name = name
+        self.level = level
+        self.per_second = per_second
+        self.burst = burst
+        self.sample_every = sample_every
+        self.suppressed = 0
+        self._count = 0
+        self._tokens = burst
+        self._last = time.monotonic()
+
+    def __call__(self, message, *args, **fields):
+        """Log the message, formatted with args and fields only when it is
+        written, unless the level, the sampling or the rate suppresses it."""
+        logger = self.logger
+        if self.level < logger.level:
+            return
+        now = time.monotonic()
+        if logger._next_summary <= now:
+            logger.summarize()
+        self._count += 1
+        if self.sample_every > 1 and self._count % self.sample_every != 1:
+            self.suppressed += 1
+            return
+        if self.per_second is not None:
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.per_second)
+            self._last = now
+            if self._tokens < 1:
+                self.suppressed += 1
+                return
+            self._tokens -= 1
+        logger._log(self.level, message, args, fields)
+
 class Logger():
 
-    def __init__(self, name):
+    def __init__(self, name, queued=False):
+        """Constructor
+        Arguments:
+            name {str} -- the logger name, also the log file name
+            Keyword Arguments:
+                queued {bool} -- only put the messages on a queue, a background
+                    thread makes the records, formats them, writes them in
+                    batches and rolls the log over (default: {False})
+        """
         self.name = name
+        self.queued = queued
         timed_handler = MyTimedRotatingFileHandler(name + ".log", whenTo="MIDNIGHT", intervals=1)
         messageFormatter = logging.Formatter(LOG_MESSAGE_FORMAT)
         timed_handler.setFormatter(messageFormatter)
-        self.get_logger().addHandler(timed_handler)
+        self.handler = timed_handler
+        self._logger = logging.getLogger(self.name)
+        self._logger.setLevel(DEBUG)
+        self.level = DEBUG
+        self._sites = {}
+        self._next_summary = time.monotonic() + SUMMARY_INTERVAL
+        if queued:
+            self._queue = queue.SimpleQueue()
+            self._writer = threading.Thread(target=self._write_records, name=f"{name}_log_writer",
+                                            daemon=True)
+            self._writer.start()
+            atexit.register(self.close)
+        else:
+            self._logger.addHandler(timed_handler)
 
     def get_logger(self):
-        logger = logging.getLogger(self.name)
-        logger.setLevel(DEBUG)
-        return logger
+        return self._logger
+
+    def set_level(self, level):
+        """Messages below the level are dropped before anything is formatted"""
+        self.level = level
+
+    def call_site(self, name, level=INFO, per_second=None, burst=1, sample_every=1):
+        """Get a rate limited and sampled call site, e.g. for a message
+        logged for every bar:
 
-    def info(self, message):
-        self.get_logger().log(INFO, message)
+            log_bar = logger.call_site("bar", per_second=1.0, sample_every=10)
+            ...
+            log_bar("Writing bar", ticker=ticker, file=log_filename)
 
-    def warn(self, message):
-        self.get_logger().log(WARNING, message)
+        The suppressed messages of every call site are counted and logged
+        in a summary every SUMMARY_INTERVAL seconds.
+        Arguments:
+            name {str} -- the call site name, used in the summary
+            Keyword Arguments:
+                level {int} -- the level of the messages (default: {INFO})
+                per_second {float} -- most messages a second, on average,
+                    None for no rate limit (default: {None})
+                burst {int} -- most messages at once after a quiet period (default: {1})
+                sample_every {int} -- only consider one of every sample_every
+                    messages for logging (default: {1})
+        """
+        site = self._sites.get(name)
+        if site is None:
+            site = CallSite(self, name, level, per_second, burst, sample_every)
+            self._sites[name] = site
+        return site
+
+    def summarize(self):
+        """Log the number of messages suppressed by each call site since
+        the last summary"""
+        self._next_summary = time.monotonic() + SUMMARY_INTERVAL
+        for site in list(self._sites.values()):
+            if site.suppressed > 0:
+                suppressed = site.suppressed
+                site.suppressed = 0
+                self._log(INFO, "Suppressed %d %s messages in the last %.0f s",
+                          (suppressed, site.name, SUMMARY_INTERVAL), {}, stacklevel=2)
+
+    def _log(self, level, message, args=(), fields=None, stacklevel=3):
+        if level < self.level:
+            return
+        if self.queued:
+            # Only what the record needs later, the caller is kept for the format
+            frame = sys._getframe(stacklevel - 1)
+            self._queue.put((level, message, args, fields, time.time(), frame.f_code.co_filename,
+                             frame.f_lineno, frame.f_code.co_name, threading.current_thread().name))
+        elif fields:
+            self._logger.log(level, "%s", _format_fields(message, args, fields), stacklevel=stacklevel)
+        else:
+            self._logger.log(level, message, *args, stacklevel=stacklevel)
 
-    def error(self, message):
-        self.get_logger().log(ERROR, message)
+    def info(self, message, *args, **fields):
+        """Log a message, formatted with the % args and the fields as
+        key=value only when it is written"""
+        self._log(INFO, message, args, fields)
 
-    def debug(self, message):
-        self.get_logger().log(DEBUG, message)
+    def warn(self, message, *args, **fields):
+        self._log(WARNING, message, args, fields)
 
-    def critical(self, message):      
-        self.get_logger().log(CRITICAL, message)
+    def error(self, message, *args, **fields):
+        self._log(ERROR, message, args, fields)
+
+    def debug(self, message, *args, **fields):
+        self._log(DEBUG, message, args, fields)
+
+    def critical(self, message, *args, **fields):
+        self._log(CRITICAL, message, args, fields)
+
+    def _make_record(self, item):
+        """Make the LogRecord of a queued message, with the message and the
+        args not formatted yet, and get the fields of the message"""
+        level, message, args, fields, created, pathname, lineno, func, thread_name = item
+        record = self._logger.makeRecord(self.name, level, pathname, lineno, message, args, None, func)
+        record.created = created
+        record.msecs = (created - int(created)) * 1000
+        record.relativeCreated = (created - logging._startTime) * 1000
+        record.threadName = thread_name
+        return record, fields
+
+    def _write_records(self):
+        """Writer thread of a queued Logger. Takes the queued messages in
+        batches of up to MAX_BATCH and writes each batch with one write. A
+        None on the queue stops it."""
+        handler = self.handler
+        while True:
+            items = [self._queue.get()]
+            while len(items) < MAX_BATCH:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            stop = False
+            for item in items:
+                if item is None:
+                    stop = True
+                    continue
+                record, fields = self._make_record(item)
+                try:
+                    # A message that does not format is reported like with
+                    # synchronous logging, and the writer goes on
+                    record.msg, record.args = _format_fields(record.msg, record.args, fields), None
+                    if handler.shouldRollover(record):
+                        handler.stream.write(''.join(lines))
+                        lines = []
+                        handler.doRollover()
+                    lines.append(handler.format(record) + handler.terminator)
+                except Exception:
+                    handler.handleError(record)
+            if len(lines) > 0:
+                handler.stream.write(''.join(lines))
+                handler.flush()
+            if stop:
+                return
+
+    def close(self):
+        """Write the queued messages and stop the writer thread"""
+        if self.queued and self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
 
 class MyTimedRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
-    """Class to handle log rotation. Based on TimedRotatingFileHandler and 
+    """Class to handle log rotation. Based on TimedRotatingFileHandler and
     modified to create a new directory for each rollover period"""
 
     def __init__(self, log_title, whenTo="midnight", intervals=1):
@@ -65,7 +248,8 @@ class MyTimedRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
         if self.when == "MIDNIGHT" or self.when == "D":
             self.extStyle = "%Y%m%d"
 
-        self.dir_log = os.path.abspath(os.path.join(self.log_file_path, datetime.now().strftime(self.extStyle)))
+        now = datetime.now()
+        self.dir_log = os.path.abspath(os.path.join(self.log_file_path, now.strftime(self.extStyle)))
         if not os.path.isdir(self.dir_log):
             os.mkdir(self.dir_log)
         self.title = log_title
@@ -73,60 +257,45 @@ class MyTimedRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
         logging.handlers.TimedRotatingFileHandler.__init__(self, filename, when=whenTo, interval=self.inter, backupCount=0)
         self._header = ""
         self._log = None
-        self._counter = 0 
-        self._last_rollover_time_item = -1
+        self._counter = 0
+        # The start of the next period, a record at or after it rolls over
+        self._period_start = now
+        self._next_period_at = self._next_period(now).timestamp()
 
+    def _next_period(self, now):
+        """Get the start of the period after the one of now, local time"""
+        if self.when == "S":
+            return now.replace(microsecond=0) + timedelta(seconds=1)
+        if self.when == "M":
+            return now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        if self.when == "H":
+            return now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+        return now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
 
     def shouldRollover(self, record):
         """Determine if rollover should occur.
-            Basically, see if the time of the record shoulf cause a rollover to occur.
-            If it does, then call doRollover()
+            Basically, see if the time of the record is in a later period
+            than the current log directory. Only compares the record time
+            with the precomputed start of the next period.
         Arguments:
             record {LogRecord} -- The record to be logged
         Returns:
             1 -- if rollover should occur
             0 -- if rollover should not occur
         """
-        global log_server_config
-
-        datetime_of_record = datetime.fromtimestamp(record.created)
-
-        if self.when == "S":
-            second_now = datetime_of_record.second
-            if second_now != self._last_rollover_time_item:
-                self._last_rollover_time_item = second_now
-                #print("Forcing rollover")
-                return 1
-        if self.when == "M":
-            minute_now = datetime_of_record.minute
-            if minute_now != self._last_rollover_time_item:
-                self._last_rollover_time_item = minute_now
-                #print("Forcing rollover")
-                return 1
-        if self.when == "H":
-            hour_now = datetime_of_record.hour
-            if hour_now != self._last_rollover_time_item:
-                self._last_rollover_time_item = hour_now
-                #print("Forcing rollover")
-                return 1
-        if self.when == "MIDNIGHT" or self.when == "D":
-            day_now = datetime_of_record.day
-            if day_now != self._last_rollover_time_item:
-                self._last_rollover_time_item = day_now
-                #print("Forcing rollover")
-                return 1
-
-        return 0
+        if record.created < self._next_period_at:
+            return 0
+        self._period_start = datetime.fromtimestamp(record.created)
+        self._next_period_at = self._next_period(self._period_start).timestamp()
+        return 1
 
     def doRollover(self):
-        """Roll over the current log file to a new file."""
+        """Roll over the current log file to a new file, in the directory
+        of the period of the record that caused it."""
         print("LOG ROLLOVER")
         self.stream.close()
-        # get the time that this sequence started at and make it a TimeTuple
-        t = self.rolloverAt - self.interval
-        timeTuple = time.localtime(t)
 
-        self.new_dir = os.path.abspath(os.path.join(self.log_file_path, datetime.now().strftime(self.extStyle)))
+        self.new_dir = os.path.abspath(os.path.join(self.log_file_path, self._period_start.strftime(self.extStyle)))
 
         if not os.path.isdir(self.new_dir):
             os.mkdir(self.new_dir)
@@ -145,3 +314,49 @@ if __name__ == "__main__":
     logger = Logger("test_logger")
     logger.warn('This is a test message 1')
     logger.error('This is a test message 2')
+
+    # A message with bad % args is reported on stderr and does not stop the
+    # writer thread of a queued logger
+    checked_logger = Logger("test_checked_logger", queued=True)
+    checked_logger.info("Bad %d", "x")
+    checked_logger.info("Written after the bad message %d", 1, ticker="ESH24")
+    checked_logger.close()
+    with open(checked_logger.handler.baseFilename, 'r') as f:
+        assert "Written after the bad message 1 ticker=ESH24" in f.read()
+    print("Queued logger survives a bad message: True")
+
+    # Benchmark: cost per call of a message like the ones bars_daemon logs
+    # for every bar, written synchronously and queued. The messages come in
+    # bursts with pauses, like the bars of a stream, and only the time spent
+    # in the calls is counted
+    NUM_BURSTS = 100
+    BURST = 1000
+    queued_logger = Logger("test_queued_logger", queued=True)
+    for name, bench_logger in (("Synchronous", logger), ("Queued", queued_logger)):
+        elapsed = 0.0
+        for burst in range(NUM_BURSTS):
+            start = time.perf_counter()
+            for i in range(BURST):
+                bench_logger.info(f"Writing bar to bars/20240214/ESH24.log {burst} {i}")
+            elapsed += time.perf_counter() - start
+            time.sleep(0.02)
+        print(f"{name}: {elapsed / (NUM_BURSTS * BURST) * 1e6:.2f} us per call")
+
+    # A message of every bar through a call site sampling one in 10 with at
+    # most 5 a second, and a debug message dropped by the level
+    sampled_logger = Logger("test_sampled_logger", queued=True)
+    sampled_logger.set_level(INFO)
+    log_bar = sampled_logger.call_site("bar", per_second=5.0, burst=5, sample_every=10)
+    for name, log in (("Sampled call site", lambda burst, i: log_bar("Writing bar", ticker="ESH24", burst=burst, i=i)),
+                      ("Below the level", lambda burst, i: sampled_logger.debug("Bar %d %d", burst, i))):
+        elapsed = 0.0
+        for burst in range(NUM_BURSTS):
+            start = time.perf_counter()
+            for i in range(BURST):
+                log(burst, i)
+            elapsed += time.perf_counter() - start
+            time.sleep(0.02)
+        print(f"{name}: {elapsed / (NUM_BURSTS * BURST) * 1e6:.2f} us per call")
+    sampled_logger.summarize()
+    queued_logger.close()
+    sampled_logger.close()
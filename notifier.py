@@ -0,0 +1,375 @@
+# Trade alerts emailed from a background thread
+import time
+import queue
+import smtplib
+import threading
+import email_trades
+from utils.latency import LatencyRecorder
+from config import EMAIL_FROM, EMAIL_PASSWD
+
+"""
+Sends the trade alerts of a strategy without blocking it. notify() only
+puts the alert on a queue, a writer thread emails it.
+
+The thread keeps its SMTP session open between alerts, so STARTTLS and the
+login are paid once instead of for every alert and recipient, and closes it
+after idle_timeout seconds without alerts. Alerts arriving within
+coalesce_seconds of the first are sent as one email. At most max_per_minute
+emails are sent, counting one per recipient, alerts arriving while the limit
+is reached are held and coalesced into the next email. A failed send is retried on a new session
+after a backoff that doubles up to max_backoff, then the email is given up.
+When the queue is full, e.g. the mail server is down for long, new alerts
+are dropped and counted rather than blocking the caller.
+"""
+
+_STOP = object()
+
+class TradeNotifier:
+    """Emails trade alerts from a background thread."""
+
+    def __init__(self, recipients: list, host: str = email_trades.SMTP_HOST, port: int = email_trades.SMTP_PORT,
+                 user: str = EMAIL_FROM, password: str = EMAIL_PASSWD, starttls: bool = True,
+                 coalesce_seconds: float = 2.0, max_per_minute: int = 20, retries: int = 5,
+                 initial_backoff: float = 1.0, max_backoff: float = 60.0, idle_timeout: float = 60.0,
+                 max_queue: int = 1000, timeout: float = 30.0, latency: LatencyRecorder = None):
+        """Constructor, starts the thread
+        Args:
+            recipients (list): The email addresses to send the alerts to
+            host (str): The SMTP server
+            port (int): The SMTP port
+            user (str): The login and the sender, no login if None
+            password (str): The password of the login
+            starttls (bool): Start TLS before the login
+            coalesce_seconds (float): Seconds to wait for more alerts to
+                send with the first one
+            max_per_minute (int): Most emails sent per minute, an alert
+                sent to each recipient counts as one email per recipient
+            retries (int): Sends of an email after the first before it is given up
+            initial_backoff (float): Seconds before the first retry
+            max_backoff (float): Most seconds between retries
+            idle_timeout (float): Seconds without alerts before the session is closed
+            max_queue (int): Most alerts waiting, later ones are dropped
+            timeout (float): Seconds of the SMTP socket operations
+            latency (LatencyRecorder): Records the time from notify() to
+                the alert sent to the first recipient, as decision_to_alert
+        """
+        self.recipients = list(recipients)
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.starttls = starttls
+        self.coalesce_seconds = coalesce_seconds
+        self.max_per_minute = max_per_minute
+        self.retries = retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.latency = latency
+        self.stats = {'alerts': 0, 'sent': 0, 'coalesced': 0, 'retried': 0, 'failed': 0, 'dropped': 0,
+                      'connections': 0}
+        self._queue = queue.Queue(max_queue)
+        self._closing = threading.Event()
+        self._session = None
+        self._last_used = 0.0
+        self._tokens = float(max_per_minute)
+        self._tokens_at = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="TradeNotifier", daemon=True)
+        self._thread.start()
+
+    def notify(self, subject: str, body: str) -> bool:
+        """Queue an alert, never blocks
+        Args:
+            subject (str): The subject of the alert
+            body (str): The text of the alert
+        Returns:
+            bool: False if the queue is full and the alert was dropped
+        """
+        try:
+            self._queue.put_nowait((subject, body, time.time()))
+        except queue.Full:
+            self.stats['dropped'] += 1
+            return False
+        return True
+
+    def close(self, timeout: float = 30.0) -> None:
+        """Send the queued alerts, without waiting for the rate limit or
+        backoffs, and stop the thread"""
+        self._closing.set()
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+
+    def _take_tokens(self, count: int) -> float:
+        """Take emails from the rate limit, at most a minute of them
+        Args:
+            count (int): The number of emails
+        Returns:
+            float: 0.0 if taken, else the seconds until they are available
+        """
+        count = min(count, self.max_per_minute)
+        now = time.monotonic()
+        self._tokens = min(float(self.max_per_minute),
+                           self._tokens + (now - self._tokens_at) * self.max_per_minute / 60.0)
+        self._tokens_at = now
+        if self._tokens >= count:
+            self._tokens -= count
+            return 0.0
+        return (count - self._tokens) * 60.0 / self.max_per_minute
+
+    def _collect(self, alerts: list, seconds: float) -> bool:
+        """Add the alerts arriving within seconds to alerts
+        Returns:
+            bool: False once close() was called
+        """
+        deadline = time.monotonic() + seconds
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    item = self._queue.get_nowait()
+                else:
+                    item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                return True
+            if item is _STOP:
+                return False
+            alerts.append(item)
+
+    def _run(self) -> None:
+        running = True
+        while running:
+            try:
+                item = self._queue.get(timeout=self._idle_wait())
+            except queue.Empty:
+                self._close_session()
+                continue
+            if item is _STOP:
+                break
+            alerts = [item]
+            running = self._collect(alerts, self.coalesce_seconds)
+            while running:
+                # One email per recipient
+                wait = self._take_tokens(len(self.recipients))
+                if wait == 0.0:
+                    break
+                running = self._collect(alerts, wait)
+            self._send_alerts(alerts)
+        # Flush what is left after close()
+        alerts = []
+        self._collect(alerts, 0.0)
+        if len(alerts) > 0:
+            self._send_alerts(alerts)
+        self._close_session()
+
+    def _idle_wait(self) -> float:
+        """Seconds to wait for an alert before the idle session is closed"""
+        if self._session is None:
+            return None
+        return max(0.0, self._last_used + self.idle_timeout - time.monotonic())
+
+    @staticmethod
+    def _message(alerts: list) -> tuple:
+        """The subject and body of the email of the alerts"""
+        if len(alerts) == 1:
+            return alerts[0][:2]
+        subject = f"{len(alerts)} trade alerts: " + ", ".join(subject for subject, _, _ in alerts)
+        return subject, "\n\n".join(body for _, body, _ in alerts)
+
+    def _send_alerts(self, alerts: list) -> None:
+        """Email the alerts to each recipient, retrying with backoff"""
+        self.stats['alerts'] += len(alerts)
+        self.stats['coalesced'] += len(alerts) - 1
+        subject, body = self._message(alerts)
+        pending = list(self.recipients)
+        backoff = self.initial_backoff
+        for attempt in range(self.retries + 1):
+            try:
+                while len(pending) > 0:
+                    self._send(pending[0], subject, body)
+                    if self.latency is not None and len(pending) == len(self.recipients):
+                        sent_at = time.time()
+                        for _, _, queued_at in alerts:
+                            self.latency.record('decision_to_alert', sent_at - queued_at)
+                    pending.pop(0)
+                    self.stats['sent'] += 1
+                return
+            except smtplib.SMTPRecipientsRefused as e:
+                print(f"TradeNotifier: {pending.pop(0)} refused: {e.recipients}")
+                self.stats['failed'] += 1
+            except (smtplib.SMTPException, OSError) as e:
+                self._close_session()
+                if attempt == self.retries:
+                    break
+                print(f"TradeNotifier: sending failed ({e!r}), retrying in {backoff:.1f} s")
+                self.stats['retried'] += 1
+                if not self._closing.is_set():
+                    self._closing.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+        if len(pending) > 0:
+            print(f"TradeNotifier: gave up sending '{subject}' to {', '.join(pending)}")
+            self.stats['failed'] += len(pending)
+
+    def _send(self, to_addr: str, subject: str, body: str) -> None:
+        """Send one email on the open session, opening one if needed"""
+        text = email_trades.build_message(to_addr, subject, body).as_string()
+        sender = EMAIL_FROM if self.user is None else self.user
+        if self._session is not None:
+            try:
+                self._session.sendmail(sender, to_addr, text)
+                self._last_used = time.monotonic()
+                return
+            except smtplib.SMTPServerDisconnected:
+                # The server closed the idle session, open a new one
+                self._session = None
+        self._session = email_trades.open_session(self.host, self.port, self.starttls, self.user,
+                                                  self.password, self.timeout)
+        self.stats['connections'] += 1
+        self._session.sendmail(sender, to_addr, text)
+        self._last_used = time.monotonic()
+
+    def _close_session(self) -> None:
+        if self._session is None:
+            return
+        try:
+            self._session.quit()
+        except (smtplib.SMTPException, OSError):
+            self._session.close()
+        self._session = None
+
+
+if __name__ == "__main__":
+
+    # Send alerts through a local SMTP stand-in that drops the connection
+    # and fails some sends, and time notify() against a blocking send_email
+    import socketserver
+
+    class _SMTPHandler(socketserver.StreamRequestHandler):
+        """Just enough SMTP for smtplib, without TLS or login"""
+
+        def handle(self):
+            server = self.server
+            server.connections += 1
+            self.wfile.write(b"220 localhost stand-in\r\n")
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                command = line.decode().strip().upper()
+                if command.startswith(("EHLO", "HELO")):
+                    self.wfile.write(b"250 localhost\r\n")
+                elif command.startswith("MAIL"):
+                    if server.fail_next > 0:
+                        server.fail_next -= 1
+                        self.wfile.write(b"421 try again later\r\n")
+                        return
+                    self.wfile.write(b"250 OK\r\n")
+                elif command.startswith(("RCPT", "RSET", "NOOP")):
+                    self.wfile.write(b"250 OK\r\n")
+                elif command.startswith("DATA"):
+                    self.wfile.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                    lines = []
+                    while True:
+                        data = self.rfile.readline()
+                        if data in (b".\r\n", b""):
+                            break
+                        lines.append(data.decode())
+                    server.messages.append("".join(lines))
+                    self.wfile.write(b"250 OK\r\n")
+                    if server.disconnect_after_data:
+                        server.disconnect_after_data = False
+                        return
+                elif command.startswith("QUIT"):
+                    self.wfile.write(b"221 Bye\r\n")
+                    return
+                else:
+                    self.wfile.write(b"502 Not implemented\r\n")
+
+    class _SMTPServer(socketserver.ThreadingTCPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    server = _SMTPServer(("127.0.0.1", 0), _SMTPHandler)
+    server.messages = []
+    server.connections = 0
+    server.fail_next = 0
+    server.disconnect_after_data = False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+
+    def wait_for(condition, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    notifier = TradeNotifier(['a@example.com', 'b@example.com'], "127.0.0.1", port, user=None,
+                             starttls=False, coalesce_seconds=0.2, max_per_minute=600,
+                             initial_backoff=0.05, idle_timeout=5.0)
+    start = time.perf_counter()
+    for i in range(5):
+        notifier.notify("Buy", f"**BUY alert {i}")
+    print(f"5 notify() calls took {(time.perf_counter() - start) * 1e6:.0f} us")
+    wait_for(lambda: len(server.messages) == 2)
+    time.sleep(0.2)
+    # One email per recipient with the 5 alerts, on one session
+    assert len(server.messages) == 2 and server.connections == 1
+    assert all(f"alert {i}" in message for message in server.messages for i in range(5))
+    print(f"Burst: {len(server.messages)} emails on {server.connections} connections, coalesced 5 alerts")
+
+    # The server drops the session after the next email, then refuses two sends
+    server.disconnect_after_data = True
+    notifier.notify("Sell", "**SELL alert 5")
+    wait_for(lambda: len(server.messages) == 4)
+    server.fail_next = 2
+    notifier.notify("Buy", "**BUY alert 6")
+    wait_for(lambda: len(server.messages) == 6)
+    time.sleep(0.2)
+    # A new session after the disconnect, and one for each refused send
+    assert len(server.messages) == 6 and server.connections == 4
+    assert "alert 5" in server.messages[2] and "alert 6" in server.messages[5]
+    assert notifier.stats == {'alerts': 7, 'sent': 6, 'coalesced': 4, 'retried': 2, 'failed': 0,
+                              'dropped': 0, 'connections': 4}
+    print(f"After a disconnect and two failures: {len(server.messages)} emails on "
+          f"{server.connections} connections, stats {notifier.stats}")
+
+    # Rate limit of 2 emails per minute, the held alerts go in the last email
+    limited = TradeNotifier(['a@example.com'], "127.0.0.1", port, user=None, starttls=False,
+                            coalesce_seconds=0.0, max_per_minute=2)
+    before = len(server.messages)
+    for i in range(10):
+        limited.notify("Buy", f"**BUY limited {i}")
+        time.sleep(0.05)
+    time.sleep(0.5)
+    limited.close()
+    # Two emails within the rate, the last with the 8 held alerts
+    assert len(server.messages) - before == 3
+    assert all(f"limited {i}" in server.messages[-1] for i in range(2, 10))
+    assert limited.stats['sent'] == 3 and limited.stats['coalesced'] == 7
+    print(f"Rate limited: 10 alerts sent as {len(server.messages) - before} emails, stats {limited.stats}")
+
+    # With two recipients the first alert uses the 2 emails of the minute
+    limited = TradeNotifier(['a@example.com', 'b@example.com'], "127.0.0.1", port, user=None,
+                            starttls=False, coalesce_seconds=0.0, max_per_minute=2)
+    before = len(server.messages)
+    for i in range(10):
+        limited.notify("Buy", f"**BUY recipients {i}")
+        time.sleep(0.05)
+    time.sleep(0.5)
+    limited.close()
+    assert len(server.messages) - before == 4
+    assert all(f"recipients {i}" in server.messages[-1] for i in range(1, 10))
+    print(f"Rate limited, 2 recipients: 10 alerts sent as {len(server.messages) - before} emails")
+    notifier.close()
+
+    # What the strategy loop paid per alert before, one session per email
+    start = time.perf_counter()
+    session = email_trades.open_session("127.0.0.1", port, starttls=False, user=None)
+    session.sendmail(EMAIL_FROM, 'a@example.com',
+                     email_trades.build_message('a@example.com', "Buy", "**BUY blocking").as_string())
+    session.quit()
+    print(f"One blocking send on a new local session took {(time.perf_counter() - start) * 1e6:.0f} us, "
+          f"without the TLS handshake and login of a real server")
+    server.shutdown()
@@ -1,14 +1,15 @@
 import os
 import sys
 import time
-from filelock import FileLock
+import signal
 import psutil
 import daemon
 import argparse
 current = os.path.dirname(os.path.realpath(__file__))
 parent = os.path.dirname(current)
-sys.path.append(parent)
-from config import PID_LOCK_FILE, PID_FILE
+# First, so processes is the package when this file is run as a script
+sys.path.insert(0, parent)
+from processes.registry import ProcessRegistry
 
 
 class Processes:
@@ -28,52 +29,31 @@ class Processes:
             return -1
 
     @staticmethod
-    def add_process_to_pid_list(pid: int, name: str) -> None:
-        """Add the current process to the pid file.
-        First we read the pid file to get the list of processes. Then we clean the
-        list by removing any processes that are no longer running. Finally we add
-        the current process to the list and write the list back to the pid file.
+    def add_process_to_pid_list(pid: int, name: str, role: str = None) -> None:
+        """Add a process to the process registry.
+        The entries of processes that are no longer running are removed first.
         Args:
             pid (int): The process id
             name (str): The process name
+            role (str): What the process is, e.g. 'daemon' or 'supervised'
         Note: If pid is < 0 or name is empty, the process is not added to the list.
         This effectively cleans the list of any dead processes."""
-
-        pid_info = []
+        registry = ProcessRegistry()
         try:
-            # Get a lock on the pid file
-            with FileLock(PID_LOCK_FILE, timeout=10):
-                # Read in the pid,name tuple list from the file
-                # use with to open config['PID_FILE'] only if the file exists
-                if os.path.exists(PID_FILE):
-                    with open(PID_FILE, 'r') as f:
-                        lines = f.read().splitlines()
-                        for line in lines:
-                            parts = line.split()
-                            pid_info.append((int(parts[0]), parts[1]))
-            # Remove any entries where the process does not exist
-            pid_info = [(pid, name) for pid, name in pid_info if psutil.pid_exists(pid)]
-
-            # Add the new entry. If pid < 0 or name is empty, do not add the entry.
-            # This is for cleaning the list of dead processes.
-            if pid >= 0:
-                pid_info.append((pid, name))
-
-            # Write the list back to the file
-            with open(PID_FILE, 'w') as f:
-                for pid, name in pid_info:
-                    f.write(f"{pid} {name}\n")
-        except Exception as e:
-            # Ignore the error if the pid file does not exist. Return an empty list.
-            pass
+            registry.clean()
+            if pid >= 0 and name:
+                registry.register(pid, name, role)
+        finally:
+            registry.close()
 
     @staticmethod
-    def add_this_process_to_pid_list(name: str) -> None:
-        """Add the current process to the pid file.
+    def add_this_process_to_pid_list(name: str, role: str = None) -> None:
+        """Add the current process to the process registry.
         Args:
             name (str): The process name
+            role (str): What the process is, e.g. 'daemon'
         """
-        Processes.add_process_to_pid_list(os.getpid(), name)    
+        Processes.add_process_to_pid_list(os.getpid(), name, role)
 
     @staticmethod
     def remove_process_from_list(process_name: str) -> None:
@@ -82,67 +62,56 @@ class Processes:
             name (str): The process name
         
         """
-        pid_info = []
+        registry = ProcessRegistry()
+        try:
+            registry.unregister_name(process_name)
+            registry.clean()
+        finally:
+            registry.close()
+
+    @staticmethod
+    def record_heartbeat(pid: int, when: float = None) -> None:
+        """Record the time of the last heartbeat of a process
+        Args:
+            pid (int): The process id
+            when (float): The time of the heartbeat, now if None
+        """
+        registry = ProcessRegistry()
+        try:
+            registry.heartbeat(pid, when)
+        finally:
+            registry.close()
+
+    @staticmethod
+    def get_processes(name: str = None) -> list:
+        """Get the registered processes that are running, sampled in one pass
+        Args:
+            name (str): Only the processes with this name, all if None
+        Returns:
+            list: A dict per process with pid, name, role, started_at,
+                last_heartbeat and memory in MB
+        """
+        registry = ProcessRegistry()
         try:
-            # Get a lock on the pid file
-            with FileLock(PID_LOCK_FILE, timeout=10):
-                # Read in the pid,name tuple list from the file
-                # use with to open config['PID_FILE'] only if the file exists
-                if os.path.exists(PID_FILE):
-                    with open(PID_FILE, 'r') as f:
-                        lines = f.read().splitlines()
-                        for line in lines:
-                            parts = line.split()
-                            pid_info.append((int(parts[0]), parts[1]))
-            # Remove any entries where the process does not exist
-            print(process_name)
-            print(f"pid_info: {pid_info}")
-            pid_info = [(pid, name) for pid, name in pid_info if psutil.pid_exists(pid) and name != process_name]
-
-            print(f"pid_info: {pid_info}")
-
-            # Write the list back to the file
-            with open(PID_FILE, 'w') as f:
-                for pid, name in pid_info:
-                    f.write(f"{pid} {name}\n")
-        except Exception as e:
-            # Ignore the error if the pid file does not exist. Return an empty list.
-            pass
+            return registry.sample(name)[0]
+        finally:
+            registry.close()
 
     @staticmethod
-    def get_pids() -> None:
-        """Get the process ids from the pid file
+    def get_pids() -> list:
+        """Get the process ids from the process registry
         Returns:
             list: A list of tuples containing the process id, name and 
                 memory usage in MB
-        Note: The pid file is a text file with one line per process. Each line
-        contains the process id and the name of the process. The name is used
-        to identify the process. The memory usage is obtained from the process
-        id.
+        Note: Only the processes that are running are returned, their memory
+        usage is sampled in the same pass that checks they are running.
         """
-        pids_info = []
-        try:
-            with FileLock(PID_LOCK_FILE, timeout=10):
-                # use with to open config['PID_FILE'] only if the file exists
-                if os.path.exists(PID_FILE):
-                    with open(PID_FILE, 'r') as f:
-                        lines = f.read().splitlines()
-                        for line in lines:
-                            parts = line.split()
-                            pid = int(parts[0])
-                            if psutil.pid_exists(pid):
-                                name = parts[1]
-                                pids_info.append((pid, name, Processes.get_process_memory(pid)))
-            
-        except Exception as e:
-            # Ignore the error if the pid file does not exist. Return an empty list.
-            pass
-
-        return pids_info 
+        return [(process['pid'], process['name'], process['memory'])
+                for process in Processes.get_processes()]
 
     @staticmethod
     def clean() -> None:
-        """Clean the pid file by removing any dead processes. Processes are not killed."""
+        """Clean the process registry by removing any dead processes. Processes are not killed."""
         Processes.add_process_to_pid_list(-1, None)
 
     @staticmethod
@@ -180,6 +149,36 @@ class Processes:
 
         return None
 
+    @staticmethod
+    def stop_process(name: str, timeout: float = 60.0, silent: bool = False) -> None:
+        """Stop the processes of a name with SIGTERM, so they can clean up,
+        and kill the ones still running after timeout seconds
+        Args:
+            name (str): The process name
+            timeout (float): Seconds given to the processes to exit
+            silent (bool): If True, do not print any messages. Default is False.
+        """
+        pids = [pid for pid, pname, _ in Processes.get_pids() if pname == name]
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                continue
+            if not silent:
+                print(f"Stopping process {pid}, {name}")
+        deadline = time.monotonic() + timeout
+        for pid in pids:
+            while psutil.pid_exists(pid) and time.monotonic() < deadline:
+                time.sleep(0.1)
+            if psutil.pid_exists(pid):
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    continue
+                if not silent:
+                    print(f"Killed process {pid}, {name}, it did not exit on SIGTERM")
+        Processes.clean()
+
     @staticmethod
     def daemonize(task, task_args: dict, name: str, working_dir: str, kill_existing: str) -> None:
         """Daemonize the current process.
@@ -198,7 +197,7 @@ class Processes:
         if kill_existing:
             Processes.kill_process(name, True)
         with daemon.DaemonContext():
-            Processes.add_this_process_to_pid_list(name)
+            Processes.add_this_process_to_pid_list(name, 'daemon')
             if working_dir is not None:
                 os.chdir(working_dir)
             task(task_args)
@@ -232,10 +231,14 @@ if __name__ == "__main__":
         else:
             Processes.kill_process(args.kill)
     elif args.list:
-        pids_info = Processes.get_pids()
-        if len(pids_info) == 0:
+        processes_info = Processes.get_processes()
+        if len(processes_info) == 0:
             print('No processes are in the list of PIDs')
-        for pid, name, mem in pids_info:
-            print(f'{pid}, {name}, {mem:.2f} MB')
+        now = time.time()
+        for process in processes_info:
+            heartbeat = '' if process['last_heartbeat'] is None else \
+                f", heartbeat {now - process['last_heartbeat']:.0f} s ago"
+            print(f"{process['pid']}, {process['name']}, {process['memory']:.2f} MB, "
+                  f"{process['role'] or '-'}, up {now - process['started_at']:.0f} s{heartbeat}")
     else:
         parser.print_help()
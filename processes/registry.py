@@ -0,0 +1,203 @@
+import os
+import sys
+import time
+import sqlite3
+import psutil
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+# First, so processes is the package when this file is run as a script
+sys.path.insert(0, parent)
+from config import PID_FILE
+
+"""
+Registry of the jrbot processes in a small SQLite database next to the pid
+file, replacing the locked rewrite of the whole pid file on every change.
+
+Each process is a row keyed by pid with its name, role, start time, the
+psutil create time that tells it from a later process reusing the pid, and
+the time of its last heartbeat. Changes are single transactions, readers do
+not block the writers in WAL mode, and lookups by name use an index.
+
+Whether the processes are alive, and their memory, is sampled in one pass:
+the pids of the system are listed once and only the registered ones that
+are in it are read.
+"""
+
+REGISTRY_FILE = os.path.splitext(PID_FILE)[0] + ".db"
+BUSY_TIMEOUT_MS = 10000
+
+class ProcessRegistry:
+    """Transactional registry of the running jrbot processes."""
+
+    def __init__(self, filename: str = REGISTRY_FILE):
+        """Constructor, creates the database if needed and imports the
+        entries of the old pid file the first time
+        Args:
+            filename (str): The SQLite database file
+        """
+        self.filename = filename
+        is_new = not os.path.exists(filename)
+        self.conn = sqlite3.connect(filename, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS processes ("
+                              "pid INTEGER PRIMARY KEY, "
+                              "name TEXT NOT NULL, "
+                              "role TEXT, "
+                              "started_at REAL NOT NULL, "
+                              "create_time REAL, "
+                              "last_heartbeat REAL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS processes_name ON processes (name)")
+        if is_new and os.path.exists(PID_FILE):
+            self._import_pid_file(PID_FILE)
+
+    def _import_pid_file(self, pid_file: str) -> None:
+        """Register the processes of a pid file of 'pid name' lines"""
+        with open(pid_file, 'r') as f:
+            for line in f.read().splitlines():
+                parts = line.split()
+                if len(parts) >= 2:
+                    self.register(int(parts[0]), parts[1])
+
+    @staticmethod
+    def _create_time(pid: int) -> float:
+        """The psutil create time of a process, None if it does not exist"""
+        try:
+            return psutil.Process(pid).create_time()
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            return None
+
+    def register(self, pid: int, name: str, role: str = None) -> None:
+        """Register a process, replacing an entry with the same pid
+        Args:
+            pid (int): The process id
+            name (str): The process name
+            role (str): What the process is, e.g. 'daemon' or 'supervised'
+        """
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO processes (pid, name, role, started_at, create_time) "
+                              "VALUES (?, ?, ?, ?, ?)", (pid, name, role, time.time(), self._create_time(pid)))
+
+    def unregister(self, pid: int) -> None:
+        """Remove the entry of a process"""
+        with self.conn:
+            self.conn.execute("DELETE FROM processes WHERE pid = ?", (pid,))
+
+    def unregister_name(self, name: str) -> None:
+        """Remove the entries of every process with the name"""
+        with self.conn:
+            self.conn.execute("DELETE FROM processes WHERE name = ?", (name,))
+
+    def heartbeat(self, pid: int, when: float = None) -> None:
+        """Record a heartbeat of a process
+        Args:
+            pid (int): The process id
+            when (float): The time of the heartbeat, now if None
+        """
+        with self.conn:
+            self.conn.execute("UPDATE processes SET last_heartbeat = ? WHERE pid = ?",
+                              (time.time() if when is None else when, pid))
+
+    def entries(self, name: str = None) -> list:
+        """Get the registered entries, alive or not
+        Args:
+            name (str): Only the entries with this name, all if None
+        Returns:
+            list: Tuples of pid, name, role, started_at, create_time and last_heartbeat
+        """
+        query = "SELECT pid, name, role, started_at, create_time, last_heartbeat FROM processes"
+        if name is None:
+            return self.conn.execute(query + " ORDER BY started_at").fetchall()
+        return self.conn.execute(query + " WHERE name = ? ORDER BY started_at", (name,)).fetchall()
+
+    def sample(self, name: str = None) -> tuple:
+        """Sample the registered processes in one pass.
+        Args:
+            name (str): Only the processes with this name, all if None
+        Returns:
+            tuple: The alive processes as a list of dicts with the registry
+                columns and 'memory' in MB, and the list of pids of the
+                entries whose process is gone
+        """
+        system_pids = set(psutil.pids())
+        alive = []
+        dead = []
+        for pid, pname, role, started_at, create_time, last_heartbeat in self.entries(name):
+            if pid not in system_pids:
+                dead.append(pid)
+                continue
+            try:
+                process = psutil.Process(pid)
+                with process.oneshot():
+                    if create_time is not None and process.create_time() != create_time:
+                        # The pid was reused by another process
+                        dead.append(pid)
+                        continue
+                    memory = process.memory_info().rss / 1024 / 1024
+            except psutil.NoSuchProcess:
+                dead.append(pid)
+                continue
+            except psutil.AccessDenied:
+                memory = -1
+            alive.append({'pid': pid, 'name': pname, 'role': role, 'started_at': started_at,
+                          'last_heartbeat': last_heartbeat, 'memory': memory})
+        return alive, dead
+
+    def clean(self) -> int:
+        """Remove the entries of the processes that are gone
+        Returns:
+            int: The number of entries removed
+        """
+        _, dead = self.sample()
+        if len(dead) > 0:
+            with self.conn:
+                self.conn.executemany("DELETE FROM processes WHERE pid = ?", [(pid,) for pid in dead])
+        return len(dead)
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+if __name__ == "__main__":
+
+    # Time listing and sampling hundreds of registered processes, and many
+    # processes registering at once
+    import tempfile
+    import multiprocessing
+
+    import subprocess
+
+    # Half of the entries are sleeping child processes, the others are gone
+    NUM_PROCESSES = 500
+    filename = os.path.join(tempfile.mkdtemp(), "pid.db")
+    registry = ProcessRegistry(filename)
+    children = [subprocess.Popen(['sleep', '60']) for _ in range(NUM_PROCESSES // 2)]
+    start = time.perf_counter()
+    for i in range(NUM_PROCESSES):
+        registry.register(children[i // 2].pid if i % 2 == 0 else 10000000 + i, f"shard_{i}", 'daemon')
+    print(f"Registered {NUM_PROCESSES} processes in {time.perf_counter() - start:.3f} s")
+    start = time.perf_counter()
+    alive, dead = registry.sample()
+    print(f"Sampled {len(alive)} alive and {len(dead)} gone in {time.perf_counter() - start:.3f} s")
+    start = time.perf_counter()
+    print(f"Lookup by name: {registry.entries('shard_250')[0][:2]} in {(time.perf_counter() - start) * 1000:.2f} ms")
+    print(f"Cleaned {registry.clean()} entries, {len(registry.entries())} left")
+    for child in children:
+        child.kill()
+        child.wait()
+    print(f"Cleaned {registry.clean()} entries after killing the children, {len(registry.entries())} left")
+
+    def register_many(first):
+        process_registry = ProcessRegistry(filename)
+        for i in range(first, first + 50):
+            process_registry.register(20000000 + i, f"worker_{i}", 'daemon')
+        process_registry.close()
+
+    start = time.perf_counter()
+    workers = [multiprocessing.Process(target=register_many, args=(i * 50,)) for i in range(8)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    print(f"8 processes registered {len(registry.entries())} entries at once in {time.perf_counter() - start:.3f} s")
@@ -0,0 +1,284 @@
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import subprocess
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+# First, so processes is the package when this file is run as a script
+sys.path.insert(0, parent)
+from processes.processes import Processes
+
+"""
+Supervisor of the jrbot daemons.
+
+The supervisor starts each registered daemon as a child process and watches
+it. A daemon that calls Heartbeat.beat() regularly touches a small file, the
+name of which is passed in the JRBOT_HEARTBEAT_FILE environment variable. A
+child that exits, or whose heartbeat is older than its stall_seconds, e.g.
+bars_daemon stuck on a dead HTTP stream, is stopped and started again after
+a backoff that doubles with each failure and is reset once the child has
+been healthy for a while.
+
+The restarts, the last failure and the downtime of each daemon, from the
+failure to the first heartbeat after the restart, are kept in a JSON state
+file, see --status.
+
+The daemons are read from a JSON file like:
+
+    {
+        "bars_daemon": {
+            "command": ["python3", "bars_daemon.py", "ESH24,NQH24", "-n"],
+            "stall_seconds": 60
+        }
+    }
+"""
+
+HEARTBEAT_DIR = "heartbeats"
+HEARTBEAT_ENV = "JRBOT_HEARTBEAT_FILE"
+STATE_FILE = "supervisor_state.json"
+NAME = "supervisor"
+
+class Heartbeat:
+    """Heartbeat of a supervised daemon, the modification time of a file."""
+
+    def __init__(self, filename: str, min_interval: float = 1.0):
+        """Constructor
+        Args:
+            filename (str): The heartbeat file, None for a heartbeat that does nothing
+            min_interval (float): Seconds between touches of the file, beats
+                in between only cost a clock read
+        """
+        self.filename = filename
+        self.min_interval = min_interval
+        self._last = float('-inf')
+
+    @staticmethod
+    def from_environment(min_interval: float = 1.0) -> 'Heartbeat':
+        """Get the heartbeat the supervisor passed to this process, one that
+        does nothing if the process is not supervised"""
+        return Heartbeat(os.environ.get(HEARTBEAT_ENV), min_interval)
+
+    def beat(self) -> None:
+        """Tell the supervisor this process is making progress"""
+        if self.filename is None:
+            return
+        now = time.monotonic()
+        if now - self._last < self.min_interval:
+            return
+        self._last = now
+        try:
+            os.utime(self.filename)
+        except FileNotFoundError:
+            with open(self.filename, 'a'):
+                pass
+
+class _Child:
+    """The state of one supervised daemon"""
+
+    def __init__(self, name: str, command: list, stall_seconds: float = None, cwd: str = None):
+        self.name = name
+        self.command = command
+        self.stall_seconds = stall_seconds
+        self.cwd = cwd
+        self.process = None
+        self.started_at = None
+        self.next_start_at = 0.0
+        self.backoff = None
+        self.restarts = 0
+        self.downtime = 0.0
+        self.down_since = None
+        self.last_failure = None
+        self.recorded_beat = None
+
+class Supervisor:
+    """Starts the daemons and restarts them when they die or stall."""
+
+    def __init__(self, daemons: dict, heartbeat_dir: str = HEARTBEAT_DIR, state_file: str = STATE_FILE,
+                 initial_backoff: float = 1.0, max_backoff: float = 300.0, healthy_after: float = 600.0,
+                 poll_interval: float = 1.0, stop_timeout: float = 10.0):
+        """Constructor
+        Args:
+            daemons (dict): Name to a dict with the command list, and optionally
+                stall_seconds, None to only restart a daemon that exits, and cwd
+            heartbeat_dir (str): The directory of the heartbeat files
+            state_file (str): The JSON file of the restart counts and downtimes
+            initial_backoff (float): Seconds before the first restart
+            max_backoff (float): Most seconds between restarts
+            healthy_after (float): Seconds a child must run before the backoff is reset
+            poll_interval (float): Seconds between checks of the children
+            stop_timeout (float): Seconds a child is given to exit on SIGTERM
+                before it is killed
+        """
+        self.heartbeat_dir = heartbeat_dir
+        self.state_file = state_file
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.healthy_after = healthy_after
+        self.poll_interval = poll_interval
+        self.stop_timeout = stop_timeout
+        self.children = [_Child(name, spec['command'], spec.get('stall_seconds'), spec.get('cwd'))
+                         for name, spec in daemons.items()]
+        for child in self.children:
+            child.backoff = initial_backoff
+        self._running = True
+        os.makedirs(heartbeat_dir, exist_ok=True)
+
+    def _heartbeat_file(self, child: _Child) -> str:
+        return os.path.abspath(os.path.join(self.heartbeat_dir, f"{child.name}.hb"))
+
+    def _last_beat(self, child: _Child) -> float:
+        """The time of the last heartbeat of a child, None if it never beat"""
+        try:
+            return os.stat(self._heartbeat_file(child)).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def _start(self, child: _Child) -> None:
+        env = dict(os.environ)
+        env[HEARTBEAT_ENV] = self._heartbeat_file(child)
+        child.started_at = time.time()
+        child.process = subprocess.Popen(child.command, cwd=child.cwd, env=env, start_new_session=True)
+        Processes.add_process_to_pid_list(child.process.pid, child.name, 'supervised')
+        print(f"Started {child.name}, pid {child.process.pid}")
+
+    def _stop(self, child: _Child) -> None:
+        """Stop a child with SIGTERM, then SIGKILL if it does not exit"""
+        if child.process.poll() is None:
+            child.process.terminate()
+            try:
+                child.process.wait(self.stop_timeout)
+            except subprocess.TimeoutExpired:
+                child.process.kill()
+                child.process.wait()
+        Processes.clean()
+
+    def check(self, child: _Child, now: float) -> None:
+        """Start, or restart if it died or stalled, one child"""
+        if child.process is None:
+            if now >= child.next_start_at:
+                self._start(child)
+                if child.stall_seconds is None and child.down_since is not None:
+                    # Without heartbeats a child is up once it is started
+                    child.downtime += now - child.down_since
+                    child.down_since = None
+            return
+
+        last_beat = self._last_beat(child)
+        if last_beat is not None and last_beat != child.recorded_beat and last_beat >= child.started_at:
+            Processes.record_heartbeat(child.process.pid, last_beat)
+            child.recorded_beat = last_beat
+        if child.down_since is not None and last_beat is not None and last_beat >= child.started_at:
+            # Up again, the downtime ends at its first heartbeat
+            child.downtime += last_beat - child.down_since
+            child.down_since = None
+            self.save_state()
+
+        code = child.process.poll()
+        if code is not None:
+            failure = f"exited with code {code}"
+        elif child.stall_seconds is not None and \
+                now - max(last_beat or 0.0, child.started_at) > child.stall_seconds:
+            failure = f"no heartbeat for {child.stall_seconds} s"
+            self._stop(child)
+        else:
+            if now - child.started_at >= self.healthy_after:
+                child.backoff = self.initial_backoff
+            return
+
+        if child.down_since is None:
+            child.down_since = now
+        child.restarts += 1
+        child.last_failure = f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now))} {failure}"
+        child.process = None
+        child.next_start_at = now + child.backoff
+        print(f"{child.name} {failure}, restarting in {child.backoff:.1f} s")
+        child.backoff = min(child.backoff * 2, self.max_backoff)
+        Processes.clean()
+        self.save_state()
+
+    def save_state(self) -> None:
+        """Write the restart counts and downtimes to the state file"""
+        now = time.time()
+        state = {child.name: {'pid': None if child.process is None else child.process.pid,
+                              'restarts': child.restarts,
+                              'downtime_seconds': round(child.downtime + (0.0 if child.down_since is None
+                                                                          else now - child.down_since), 1),
+                              'down': child.down_since is not None,
+                              'last_failure': child.last_failure}
+                 for child in self.children}
+        tmp_filename = self.state_file + ".tmp"
+        with open(tmp_filename, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_filename, self.state_file)
+
+    def stop(self, *args) -> None:
+        """Make run() return, also a signal handler"""
+        self._running = False
+
+    def run(self) -> None:
+        """Supervise the children until stop() or SIGTERM, then stop them"""
+        signal.signal(signal.SIGTERM, self.stop)
+        self.save_state()
+        try:
+            while self._running:
+                now = time.time()
+                for child in self.children:
+                    self.check(child, now)
+                time.sleep(self.poll_interval)
+        finally:
+            for child in self.children:
+                if child.process is not None:
+                    self._stop(child)
+                    child.process = None
+            self.save_state()
+
+def main(args: dict) -> None:
+    """Supervise the daemons of a JSON file
+    Args:
+        args (dict): {'daemons': <the daemons JSON file>}
+    """
+    with open(args['daemons'], 'r') as f:
+        daemons = json.load(f)
+    Supervisor(daemons).run()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Starts the jrbot daemons and restarts \
+                                     them when they exit or stop sending heartbeats.')
+    parser.add_argument('daemons', nargs='?', help='The JSON file of the daemons to supervise')
+    parser.add_argument('-n', '--no_daemon', action='store_true', help='Do not \
+                            make this process a daemon.')
+    parser.add_argument('-s', '--status', action='store_true', help='Print the \
+                            restarts and downtime of each daemon and exit')
+    args = parser.parse_args()
+
+    if args.status:
+        if not os.path.exists(STATE_FILE):
+            print("The supervisor has not run")
+            sys.exit(0)
+        with open(STATE_FILE, 'r') as f:
+            for name, state in json.load(f).items():
+                print(f"{name}: pid {state['pid']}, {state['restarts']} restarts, "
+                      f"{state['downtime_seconds']:.0f} s down{' (down now)' if state['down'] else ''}, "
+                      f"last failure: {state['last_failure']}")
+        sys.exit(0)
+    if args.daemons is None:
+        parser.print_help()
+        sys.exit(1)
+
+    task_args = {'daemons': os.path.abspath(args.daemons)}
+    # A running supervisor is stopped with SIGTERM so it stops its children,
+    # they run in their own sessions and would be left running otherwise.
+    # Children left by a supervisor that had to be killed are stopped too.
+    Processes.stop_process(NAME, silent=True)
+    for process in Processes.get_processes():
+        if process['role'] == 'supervised':
+            Processes.stop_process(process['name'], silent=True)
+    if args.no_daemon:
+        main(task_args)
+    else:
+        Processes.daemonize(main, task_args, NAME, os.getcwd(), False)
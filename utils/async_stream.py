@@ -0,0 +1,208 @@
+# Non-blocking HTTP streaming client built on asyncio streams
+import ssl
+import asyncio
+from urllib.parse import urlsplit
+
+"""
+A small HTTP/1.1 client for long lived streaming responses, such as the
+TradeStation barcharts stream, that never blocks the event loop. Many
+streams, one per ticker, can be held open in a single event loop.
+
+Backpressure is per stream: the socket is only read when the consumer
+asks for the next line, and the asyncio StreamReader pauses the transport
+once `limit` bytes are buffered, so a slow consumer of one ticker does not
+hold up the others.
+"""
+
+DEFAULT_LIMIT = 2 ** 16
+
+class HttpStreamError(Exception):
+    """Raised when the server response cannot be parsed."""
+    pass
+
+class HttpStream:
+    """An open streaming HTTP response."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 status: int, headers: dict):
+        """Constructor
+        Args:
+            reader (asyncio.StreamReader): Reader positioned at the start of the body
+            writer (asyncio.StreamWriter): The writer of the connection
+            status (int): The HTTP status code
+            headers (dict): The response headers, lower case names
+        """
+        self.reader = reader
+        self.writer = writer
+        self.status = status
+        self.headers = headers
+
+    async def _read(self, coro, idle_timeout: float):
+        """Await a read, raising asyncio.TimeoutError after idle_timeout seconds"""
+        if idle_timeout is None:
+            return await coro
+        return await asyncio.wait_for(coro, idle_timeout)
+
+    async def iter_chunks(self, idle_timeout: float = None):
+        """Generate the body as it arrives, decoding chunked transfer encoding.
+        Args:
+            idle_timeout (float): Seconds to wait for data before raising
+                asyncio.TimeoutError, None to wait forever
+        """
+        if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size_line = await self._read(self.reader.readline(), idle_timeout)
+                if not size_line:
+                    return
+                try:
+                    size = int(size_line.split(b';')[0].strip(), 16)
+                except ValueError:
+                    raise HttpStreamError(f"Invalid chunk size line: {size_line}")
+                if size == 0:
+                    return
+                chunk = await self._read(self.reader.readexactly(size + 2), idle_timeout)
+                yield chunk[:-2]
+        else:
+            remaining = int(self.headers.get('content-length', -1))
+            while remaining != 0:
+                chunk = await self._read(self.reader.read(DEFAULT_LIMIT if remaining < 0
+                                                          else min(remaining, DEFAULT_LIMIT)),
+                                         idle_timeout)
+                if not chunk:
+                    return
+                if remaining > 0:
+                    remaining -= len(chunk)
+                yield chunk
+
+    async def iter_lines(self, idle_timeout: float = None):
+        """Generate the lines of the body, without the line endings,
+        like requests.Response.iter_lines().
+        Args:
+            idle_timeout (float): Seconds to wait for data before raising
+                asyncio.TimeoutError, None to wait forever
+        """
+        pending = b''
+        async for chunk in self.iter_chunks(idle_timeout):
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line.rstrip(b'\r')
+        if pending:
+            yield pending.rstrip(b'\r')
+
+    async def close(self) -> None:
+        """Close the connection"""
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except Exception:
+            pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+async def open_stream(url: str, headers: dict = None, timeout: float = 10.0,
+                      limit: int = DEFAULT_LIMIT) -> HttpStream:
+    """Send a GET request and return the response once its headers are read.
+    Args:
+        url (str): The http or https URL
+        headers (dict): Extra request headers
+        timeout (float): Seconds allowed to connect and read the response headers
+        limit (int): Bytes buffered per stream before reading from the socket pauses
+    Returns:
+        HttpStream: The open response, use it with "async with" to close it
+    """
+    parts = urlsplit(url)
+    is_https = parts.scheme == 'https'
+    port = parts.port or (443 if is_https else 80)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(parts.hostname, port,
+                                ssl=ssl.create_default_context() if is_https else None,
+                                limit=limit),
+        timeout)
+    try:
+        request = f"GET {path} HTTP/1.1\r\nHost: {parts.netloc}\r\n"
+        request += "Accept-Encoding: identity\r\nConnection: close\r\n"
+        for name, value in (headers or {}).items():
+            request += f"{name}: {value}\r\n"
+        writer.write((request + "\r\n").encode('latin-1'))
+        await writer.drain()
+
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        try:
+            status = int(status_line.split()[1])
+        except (IndexError, ValueError):
+            raise HttpStreamError(f"Invalid status line: {status_line}")
+
+        response_headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+    except BaseException:
+        writer.close()
+        raise
+    return HttpStream(reader, writer, status, response_headers)
+
+
+if __name__ == "__main__":
+
+    # Check the client against a local fake chunked HTTP server streaming
+    # to 50 tickers at once, one of which is never read from.
+    import time
+    import json
+
+    NUM_TICKERS = 50
+    NUM_BARS = 200
+
+    async def fake_barcharts(reader, writer):
+        request = await reader.readuntil(b'\r\n\r\n')
+        ticker = request.split(b' ')[1].decode().rsplit('/', 1)[1].split('?')[0]
+        writer.write(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n")
+        for i in range(NUM_BARS):
+            # Split the lines across chunks the way a real stream may
+            line = json.dumps({'Ticker': ticker, 'Close': str(i)}).encode() + b'\r\n'
+            for part in (line[:7], line[7:]):
+                writer.write(f"{len(part):x}\r\n".encode() + part + b"\r\n")
+            await writer.drain()
+            await asyncio.sleep(0.001)
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        writer.close()
+
+    async def read_ticker(port, ticker):
+        async with await open_stream(f"http://127.0.0.1:{port}/stream/barcharts/{ticker}?interval=1") as stream:
+            assert stream.status == 200
+            count = 0
+            async for line in stream.iter_lines(idle_timeout=5):
+                if line:
+                    assert json.loads(line)['Close'] == str(count)
+                    count += 1
+            return count
+
+    async def stalled_ticker(port):
+        # Opens a stream but never reads it, the others must not be blocked
+        stream = await open_stream(f"http://127.0.0.1:{port}/stream/barcharts/STALLED")
+        await asyncio.sleep(3600)
+
+    async def main():
+        server = await asyncio.start_server(fake_barcharts, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        stalled = asyncio.ensure_future(stalled_ticker(port))
+        start = time.time()
+        counts = await asyncio.gather(*[read_ticker(port, f"T{i}") for i in range(NUM_TICKERS)])
+        print(f"{NUM_TICKERS} streams, {sum(counts)} lines in {time.time() - start:.2f} seconds")
+        assert counts == [NUM_BARS] * NUM_TICKERS
+        stalled.cancel()
+        server.close()
+
+    asyncio.run(main())
@@ -0,0 +1,110 @@
+# Fixed capacity, NumPy backed ring buffer of OHLCV bars
+import numpy as np
+
+BAR_COLUMNS = ('open', 'high', 'low', 'close', 'volume', 'open_interest')
+
+class BarRingBuffer:
+    """Fixed capacity columnar store for the most recent bars of one ticker.
+
+    Each column is kept in its own NumPy array that is twice the capacity.
+    Every value is written both at its slot and at slot + capacity, so the
+    last N values (N <= capacity) always sit in one contiguous run of memory
+    and can be returned as a view without copying. Appending is O(1).
+    """
+
+    def __init__(self, capacity: int, columns: tuple = BAR_COLUMNS):
+        """Constructor
+        Args:
+            capacity (int): The maximum number of bars kept
+            columns (tuple): The names of the float columns, in addition
+                to the datetime column
+        """
+        if capacity <= 0:
+            raise ValueError("Ring buffer capacity must be a positive integer")
+        self.capacity = capacity
+        self.columns = columns
+        self.datetime = np.zeros(2 * capacity, dtype='datetime64[ns]')
+        self.data = {col: np.zeros(2 * capacity, dtype=np.float64) for col in columns}
+        self._pos = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, datetime, *values) -> None:
+        """Append one bar to the buffer, overwriting the oldest when full.
+        Args:
+            datetime: The bar datetime, anything np.datetime64 accepts
+            values: One value per column, in the order of self.columns
+        Returns:
+            None
+        """
+        pos = self._pos
+        mirror = pos + self.capacity
+        self.datetime[pos] = self.datetime[mirror] = datetime
+        for col, value in zip(self.columns, values):
+            arr = self.data[col]
+            arr[pos] = arr[mirror] = value
+        self._pos = pos + 1 if pos + 1 < self.capacity else 0
+        if self._count < self.capacity:
+            self._count += 1
+
+    def _window(self, N: int) -> slice:
+        """Get the slice of the doubled arrays holding the last N bars"""
+        N = min(N, self._count)
+        end = self._pos + self.capacity
+        return slice(end - N, end)
+
+    def get_values(self, column: str, N: int = 1) -> np.ndarray:
+        """Get a read only view of the last N values of a column.
+        Args:
+            column (str): The column name, e.g. 'close'
+            N (int): The number of bars
+        Returns:
+            np.ndarray: A view of the last N values, or fewer if fewer
+                bars are available
+        """
+        view = self.data[column][self._window(N)]
+        view.flags.writeable = False
+        return view
+
+    def get_datetimes(self, N: int = 1) -> np.ndarray:
+        """Get a read only view of the last N datetimes."""
+        view = self.datetime[self._window(N)]
+        view.flags.writeable = False
+        return view
+
+    def get_bars(self, N: int = 1) -> dict:
+        """Get the last N bars as a dict of column name to view,
+        including the 'datetime' column."""
+        window = self._window(N)
+        bars = {'datetime': self.datetime[window]}
+        for col in self.columns:
+            bars[col] = self.data[col][window]
+        for view in bars.values():
+            view.flags.writeable = False
+        return bars
+
+    def get_last_value(self, column: str):
+        """Get the value of a column for the most recent bar."""
+        if self._count == 0:
+            raise IndexError("No bars in the buffer")
+        return self.data[column][self._pos + self.capacity - 1]
+
+    def get_last_datetime(self) -> np.datetime64:
+        """Get the datetime of the most recent bar."""
+        if self._count == 0:
+            raise IndexError("No bars in the buffer")
+        return self.datetime[self._pos + self.capacity - 1]
+
+
+if __name__ == "__main__":
+
+    # Test the ring buffer wraps and keeps the last N contiguous
+    buf = BarRingBuffer(4)
+    for i in range(10):
+        buf.append(np.datetime64('2024-02-14T15:49') + np.timedelta64(i, 'm'), i, i + 1, i - 1, i + 0.5, 100 * i, 0)
+    print(buf.get_values('open', 3))
+    print(buf.get_datetimes(4))
+    print(buf.get_last_value('close'))
+    print(buf.get_values('open', 3).base is buf.data['open'])
@@ -0,0 +1,238 @@
+# Local on disk cache of 1 minute bars
+import os
+import shutil
+import tempfile
+import threading
+import datetime
+import numpy as np
+import pandas as pd
+from utils.bar_buffer import BAR_COLUMNS
+
+"""
+Cache of the bars_1min table in a compact binary columnar format.
+The cache is partitioned by ticker and trading day:
+
+    <cache_dir>/<ticker>/<YYYYMMDD>/datetime.npy
+    <cache_dir>/<ticker>/<YYYYMMDD>/open.npy
+    ...
+
+Each column is a plain .npy file that is memory-mapped when read. Only
+days before today (UTC) are cached since the current day is still being
+filled. A day partition is written to a temporary directory and renamed
+into place, so a partition that exists is always complete.
+
+Rows can still be written for a past day, by a late feeder run, a repair or
+the aggregation of the higher timeframe tables. The writers remove the
+partitions of the days they wrote with invalidate_days, and the days are
+read from the database again on their next use. The higher timeframe tables
+are cached in <cache_dir>/<interval>, see interval_dir.
+"""
+
+CACHE_DIR = "bar_cache"
+MAX_DAYS_PER_QUERY = 31
+
+def to_datetime64(value) -> np.datetime64:
+    """Convert a date string, e.g. '2023-08-09T04:00:00Z', or a datetime to
+    a naive UTC np.datetime64[ns], which is how bars_1min stores datetimes."""
+    ts = pd.Timestamp(value)
+    if ts.tzinfo is not None:
+        ts = ts.tz_convert(None)
+    return ts.to_datetime64().astype('datetime64[ns]')
+
+def interval_dir(cache_dir: str, interval: str) -> str:
+    """Get the cache directory of the bars of an interval, '1min' or one of
+    the intervals of database.aggregation"""
+    return cache_dir if interval == '1min' else os.path.join(cache_dir, interval)
+
+def invalidate_days(ticker: str, days, cache_dir: str = CACHE_DIR, interval: str = '1min') -> None:
+    """Remove the cached partitions of days a writer has written rows for.
+    A partition is renamed away first, so a reader sees it whole or not at all.
+    Args:
+        ticker (str): The ticker
+        days: The days, as datetime.date
+        cache_dir (str): The root directory of the cache
+        interval (str): The interval of the rows written
+    """
+    ticker_dir = os.path.join(interval_dir(cache_dir, interval), ticker)
+    if not os.path.isdir(ticker_dir):
+        return
+    for day in set(days):
+        stale_dir = tempfile.mkdtemp(prefix=".tmp", dir=ticker_dir)
+        try:
+            os.rename(os.path.join(ticker_dir, day.strftime("%Y%m%d")), stale_dir)
+        except FileNotFoundError:
+            pass
+        shutil.rmtree(stale_dir, ignore_errors=True)
+
+class BarCache:
+    """Memory-mapped, per ticker and day, columnar cache of bars_1min."""
+
+    def __init__(self, engine, cache_dir: str = CACHE_DIR, table: str = "bars_1min"):
+        """Constructor
+        Args:
+            engine (sqlalchemy.Engine): The engine used to read bars_1min
+            cache_dir (str): The root directory of the cache
+            table (str): The table cached, e.g. bars_5min for 5 minute bars.
+                Each table needs its own cache_dir.
+        """
+        self.engine = engine
+        self.cache_dir = cache_dir
+        self.table = table
+
+    def _day_dir(self, ticker: str, day: datetime.date) -> str:
+        """Get the partition directory for a ticker and day"""
+        return os.path.join(self.cache_dir, ticker, day.strftime("%Y%m%d"))
+
+    @staticmethod
+    def _is_cacheable(day: datetime.date) -> bool:
+        """Only complete days, before today in UTC, are cached"""
+        return day < datetime.datetime.utcnow().date()
+
+    @staticmethod
+    def _days(start, end) -> list:
+        """Get the list of days covering the range [start, end]"""
+        first = pd.Timestamp(to_datetime64(start)).date()
+        last = pd.Timestamp(to_datetime64(end)).date()
+        return [first + datetime.timedelta(days=i) for i in range((last - first).days + 1)]
+
+    def has_day(self, ticker: str, day: datetime.date) -> bool:
+        """Determine if the day is in the cache"""
+        return os.path.isdir(self._day_dir(ticker, day))
+
+    def missing_days(self, ticker: str, start, end) -> list:
+        """Get the cacheable days in [start, end] that are not cached yet"""
+        return [day for day in self._days(start, end)
+                if self._is_cacheable(day) and not self.has_day(ticker, day)]
+
+    def _query(self, ticker: str, start: np.datetime64, end: np.datetime64) -> dict:
+        """Read the bars in [start, end) from the database as a dict of column arrays"""
+        query  = "SELECT datetime, " + ", ".join(BAR_COLUMNS) + f" FROM {self.table} "
+        query += "WHERE ticker = %(ticker)s AND "
+        query += "datetime >= %(start)s AND datetime < %(end)s "
+        query += "ORDER BY datetime ASC"
+        params = {'ticker': ticker,
+                  'start': str(start.astype('datetime64[s]')).replace('T', ' '),
+                  'end': str(end.astype('datetime64[s]')).replace('T', ' ')}
+        with self.engine.connect() as conn:
+            df = pd.read_sql(query, con = conn, params=params)
+        columns = {'datetime': df['datetime'].values.astype('datetime64[ns]')}
+        for col in BAR_COLUMNS:
+            columns[col] = df[col].to_numpy(dtype=np.float64, na_value=np.nan)
+        return columns
+
+    def _write_day(self, ticker: str, day: datetime.date, columns: dict) -> None:
+        """Atomically write the partition for one day"""
+        ticker_dir = os.path.join(self.cache_dir, ticker)
+        os.makedirs(ticker_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp", dir=ticker_dir)
+        for name, values in columns.items():
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), values)
+        try:
+            os.rename(tmp_dir, self._day_dir(ticker, day))
+        except OSError:
+            # Another writer got there first, the partitions are identical
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _fetch_days(self, ticker: str, days: list) -> dict:
+        """Read the days, which must be consecutive, from the database
+        and cache the cacheable ones.
+        Returns:
+            dict: A dict of day to a dict of column arrays
+        """
+        start = np.datetime64(days[0], 'ns')
+        end = np.datetime64(days[-1] + datetime.timedelta(days=1), 'ns')
+        columns = self._query(ticker, start, end)
+        bar_days = columns['datetime'].astype('datetime64[D]')
+        fetched = {}
+        for day in days:
+            lo, hi = np.searchsorted(bar_days, [np.datetime64(day, 'D'), np.datetime64(day, 'D') + 1])
+            fetched[day] = {name: values[lo:hi] for name, values in columns.items()}
+            if self._is_cacheable(day):
+                self._write_day(ticker, day, fetched[day])
+        return fetched
+
+    def fill(self, ticker: str, start, end) -> int:
+        """Fetch the missing days in [start, end] from the database into the cache.
+        Consecutive missing days are read with one query, at most
+        MAX_DAYS_PER_QUERY days at a time.
+        Returns:
+            int: The number of days fetched
+        """
+        missing = self.missing_days(ticker, start, end)
+        run = []
+        for day in missing:
+            if len(run) > 0 and (day - run[-1]).days != 1 or len(run) == MAX_DAYS_PER_QUERY:
+                self._fetch_days(ticker, run)
+                run = []
+            run.append(day)
+        if len(run) > 0:
+            self._fetch_days(ticker, run)
+        return len(missing)
+
+    def fill_in_background(self, tickers: list, start, end) -> threading.Thread:
+        """Fill the cache for the tickers in a background thread.
+        Returns:
+            threading.Thread: The started thread
+        """
+        def _fill():
+            for ticker in tickers:
+                try:
+                    self.fill(ticker, start, end)
+                except Exception as ex:
+                    print(f"Unable to fill the bar cache for {ticker}: {ex}")
+        thread = threading.Thread(target=_fill, daemon=True)
+        thread.start()
+        return thread
+
+    @staticmethod
+    def _load_column(filename: str) -> np.ndarray:
+        """Memory-map a column, empty columns cannot be mapped and are read"""
+        try:
+            return np.load(filename, mmap_mode='r')
+        except ValueError:
+            return np.load(filename)
+
+    def load_day(self, ticker: str, day: datetime.date) -> dict:
+        """Get the memory-mapped columns of a cached day.
+        Returns:
+            dict: A dict of column name to array, including 'datetime'
+        """
+        day_dir = self._day_dir(ticker, day)
+        return {name: self._load_column(os.path.join(day_dir, f"{name}.npy"))
+                for name in ('datetime',) + BAR_COLUMNS}
+
+    def iter_days(self, ticker: str, start, end):
+        """Generate the bars in [start, end] one day at a time, each as a
+        dict of column arrays. Cached days are memory-mapped, the others are
+        read from the database and cached if the day is complete.
+        """
+        start64 = to_datetime64(start)
+        end64 = to_datetime64(end)
+        days = self._days(start, end)
+        fetched = {}
+        for i, day in enumerate(days):
+            if day in fetched:
+                columns = fetched.pop(day)
+            elif self.has_day(ticker, day):
+                columns = self.load_day(ticker, day)
+            else:
+                # Fetch this day and the uncached days following it in one query
+                run = [day]
+                for next_day in days[i + 1:]:
+                    if self.has_day(ticker, next_day) or len(run) == MAX_DAYS_PER_QUERY:
+                        break
+                    run.append(next_day)
+                fetched = self._fetch_days(ticker, run)
+                columns = fetched.pop(day)
+            lo = np.searchsorted(columns['datetime'], start64, side='left')
+            hi = np.searchsorted(columns['datetime'], end64, side='right')
+            yield {name: values[lo:hi] for name, values in columns.items()}
+
+    def get_df(self, ticker: str, start, end) -> pd.DataFrame:
+        """Get the bars in [start, end] as a DataFrame with the columns
+        datetime, open, high, low, close, volume and open_interest."""
+        days = list(self.iter_days(ticker, start, end))
+        if len(days) == 0:
+            return pd.DataFrame(columns=('datetime',) + BAR_COLUMNS)
+        return pd.DataFrame({name: np.concatenate([day[name] for day in days])
+                             for name in ('datetime',) + BAR_COLUMNS})
@@ -0,0 +1,241 @@
+# Compact binary append-only journal of bars
+import os
+import sys
+import time
+import json
+import struct
+import datetime
+import numpy as np
+from utils.bar_loader import BAR_DTYPE, JSON_KEYS
+
+"""
+A fixed-width binary alternative to the JSON lines bar logs written by
+bars_daemon. A journal file is a 16 byte header followed by records of
+JOURNAL_DTYPE:
+
+    header: magic b'JRBJ', schema version (uint16), header size (uint16),
+            record size (uint32), 4 bytes reserved. All little endian.
+
+Records are fixed width so a reader can memory-map the file and seek by
+record index. Writes are buffered and group committed: the buffer is
+flushed every flush_records records or flush_ms milliseconds, whichever
+comes first.
+"""
+
+MAGIC = b'JRBJ'
+SCHEMA_VERSION = 1
+HEADER = struct.Struct('<4sHHI4x')
+
+# The exchange bar timestamp, then the fields of a _Bar
+JOURNAL_DTYPE = np.dtype([('timestamp', '<M8[s]')] +
+                         [(name, BAR_DTYPE[name].newbyteorder('<')) for name in BAR_DTYPE.names])
+
+_STRUCT_CODES = {'M': 'q', 'b': '?', 'f': 'd', 'i': 'q'}
+RECORD = struct.Struct('<' + ''.join(_STRUCT_CODES[JOURNAL_DTYPE[name].kind]
+                                     for name in JOURNAL_DTYPE.names))
+assert RECORD.size == JOURNAL_DTYPE.itemsize
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_ONE_SECOND = datetime.timedelta(seconds=1)
+_ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+_PRICE_FIELDS = ('open', 'high', 'low', 'close')
+
+def pack_bar(bar: dict) -> bytes:
+    """Pack a bar, as written to the JSON lines logs, into a record"""
+    timestamp = datetime.datetime.strptime(bar['TimeStamp'], "%Y-%m-%dT%H:%M:%SZ")
+    time_received = datetime.datetime.fromisoformat(bar['time_received'])
+    return RECORD.pack((timestamp - _EPOCH) // _ONE_SECOND,
+                       (time_received - _EPOCH) // _ONE_MICROSECOND,
+                       bar['BarStatus'] == 'Open',
+                       *(float(bar[key]) if name in _PRICE_FIELDS else int(bar[key])
+                         for name, key in JSON_KEYS.items()))
+
+def _format_number(value) -> str:
+    """Format a price the way the API sends it, without a trailing .0"""
+    text = repr(float(value))
+    return text[:-2] if text.endswith('.0') else text
+
+def record_to_bar(record) -> dict:
+    """Convert a journal record back to the dict written to the JSON lines logs"""
+    return {
+        'High': _format_number(record['high']),
+        'Low': _format_number(record['low']),
+        'Open': _format_number(record['open']),
+        'Close': _format_number(record['close']),
+        'TimeStamp': str(record['timestamp']) + 'Z',
+        'TotalVolume': str(int(record['total_volume'])),
+        'DownTicks': int(record['down_ticks']),
+        'DownVolume': int(record['down_volume']),
+        'TotalTicks': int(record['total_ticks']),
+        'UnchangedTicks': int(record['unchanged_ticks']),
+        'UnchangedVolume': int(record['unchanged_volume']),
+        'UpTicks': int(record['up_ticks']),
+        'UpVolume': int(record['up_volume']),
+        'BarStatus': 'Open' if record['is_open'] else 'Closed',
+        'time_received': record['datetime'].astype(datetime.datetime).strftime("%Y-%m-%d %H:%M:%S.%f"),
+    }
+
+class BarJournalWriter:
+    """Appends bars to a journal file with group commit."""
+
+    def __init__(self, filename: str, flush_records: int = 100, flush_ms: float = 250.0):
+        """Constructor
+        Args:
+            filename (str): The journal file, created with a header if new
+            flush_records (int): Flush once this many records are buffered
+            flush_ms (float): Flush once the oldest buffered record is this old
+        """
+        self.filename = filename
+        self.flush_records = flush_records
+        self.flush_ms = flush_ms
+        self._buffer = bytearray()
+        self._num_buffered = 0
+        self._first_buffered_time = 0.0
+        is_new = not os.path.exists(filename) or os.path.getsize(filename) == 0
+        if not is_new:
+            _check_header(filename)
+            # Drop a partially written last record before appending
+            size = os.path.getsize(filename)
+            end = HEADER.size + (size - HEADER.size) // RECORD.size * RECORD.size
+            if end != size:
+                with open(filename, 'r+b') as f:
+                    f.truncate(end)
+        self._fp = open(filename, 'ab')
+        if is_new:
+            self._fp.write(HEADER.pack(MAGIC, SCHEMA_VERSION, HEADER.size, RECORD.size))
+            self._fp.flush()
+
+    def write(self, bar: dict) -> None:
+        """Append a bar, as written to the JSON lines logs.
+        Args:
+            bar (dict): The bar
+        Returns:
+            None
+        """
+        self.write_record(pack_bar(bar))
+
+    def write_record(self, record: bytes) -> None:
+        """Append a packed record, flushing if the group commit policy says so"""
+        if self._num_buffered == 0:
+            self._first_buffered_time = time.monotonic()
+        self._buffer += record
+        self._num_buffered += 1
+        self.maybe_flush()
+
+    def maybe_flush(self) -> None:
+        """Flush if flush_records are buffered or the oldest is flush_ms old.
+        Call this periodically when bars may stop arriving."""
+        if self._num_buffered == 0:
+            return
+        if self._num_buffered >= self.flush_records or \
+                (time.monotonic() - self._first_buffered_time) * 1000.0 >= self.flush_ms:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the buffered records to the file"""
+        if self._num_buffered > 0:
+            self._fp.write(self._buffer)
+            self._fp.flush()
+            self._buffer = bytearray()
+            self._num_buffered = 0
+
+    def close(self) -> None:
+        """Flush and close the file"""
+        self.flush()
+        self._fp.close()
+
+def _check_header(filename: str) -> None:
+    """Check the journal header, raising ValueError if it is not supported"""
+    with open(filename, 'rb') as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise ValueError(f"{filename} is too short to be a bar journal")
+    magic, version, header_size, record_size = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError(f"{filename} is not a bar journal")
+    if version != SCHEMA_VERSION or header_size != HEADER.size or record_size != RECORD.size:
+        raise ValueError(f"{filename} has unsupported schema version {version}")
+
+def read_journal(filename: str) -> np.ndarray:
+    """Memory-map the records of a journal. A partially written last
+    record is ignored.
+    Args:
+        filename (str): The journal file
+    Returns:
+        np.ndarray: A read only array of JOURNAL_DTYPE records
+    """
+    _check_header(filename)
+    num_records = (os.path.getsize(filename) - HEADER.size) // RECORD.size
+    if num_records == 0:
+        return np.empty(0, dtype=JOURNAL_DTYPE)
+    return np.memmap(filename, dtype=JOURNAL_DTYPE, mode='r', offset=HEADER.size,
+                     shape=(num_records,))
+
+def jsonl_to_journal(jsonl_filename: str, journal_filename: str) -> int:
+    """Convert a JSON lines bar log to a journal.
+    Returns:
+        int: The number of bars converted
+    """
+    writer = BarJournalWriter(journal_filename, flush_records=10000, flush_ms=float('inf'))
+    count = 0
+    with open(jsonl_filename, 'r') as f:
+        for line in f:
+            if line.strip():
+                bar = json.loads(line)
+                if 'Heartbeat' in bar:
+                    continue
+                writer.write(bar)
+                count += 1
+    writer.close()
+    return count
+
+def journal_to_jsonl(journal_filename: str, jsonl_filename: str) -> int:
+    """Convert a journal to a JSON lines bar log.
+    Returns:
+        int: The number of bars converted
+    """
+    records = read_journal(journal_filename)
+    with open(jsonl_filename, 'w') as f:
+        for record in records:
+            f.write(f"{json.dumps(record_to_bar(record))}\n")
+    return len(records)
+
+
+if __name__ == "__main__":
+
+    # Convert between the formats: bar_journal.py <input> <output>
+    # The direction is chosen from the input file extension.
+    if len(sys.argv) == 3:
+        if sys.argv[1].endswith('.bin'):
+            print(f"Converted {journal_to_jsonl(sys.argv[1], sys.argv[2])} bars")
+        else:
+            print(f"Converted {jsonl_to_journal(sys.argv[1], sys.argv[2])} bars")
+        sys.exit(0)
+
+    import tempfile
+
+    # Round trip of bars, and appending after a torn last record drops it
+    journal_filename = os.path.join(tempfile.mkdtemp(), "ES.bin")
+    bars = []
+    for minute in range(20):
+        close = 5000.0 + minute * 0.25
+        bars.append({'High': close + 0.5, 'Low': close - 0.5, 'Open': close, 'Close': close,
+                     'TotalVolume': 100 + minute, 'DownTicks': 3, 'DownVolume': 30, 'TotalTicks': 10,
+                     'UnchangedTicks': 2, 'UnchangedVolume': 20, 'UpTicks': 5, 'UpVolume': 50 + minute,
+                     'TimeStamp': f"2024-02-14T14:{31 + minute}:00Z", 'BarStatus': 'Closed',
+                     'time_received': f"2024-02-14 14:{31 + minute}:00.250000"})
+    writer = BarJournalWriter(journal_filename)
+    for bar in bars[:10]:
+        writer.write(bar)
+    writer.close()
+    with open(journal_filename, 'ab') as f:
+        f.write(b'\xff' * 10)
+    writer = BarJournalWriter(journal_filename)
+    for bar in bars[10:]:
+        writer.write(bar)
+    writer.close()
+    assert os.path.getsize(journal_filename) == HEADER.size + len(bars) * RECORD.size
+    records = read_journal(journal_filename)
+    assert [record_to_bar(record)['Close'] for record in records] == [_format_number(bar['Close']) for bar in bars]
+    assert [record_to_bar(record)['TimeStamp'] for record in records] == [bar['TimeStamp'] for bar in bars]
+    print(f"Appended after a torn record: {len(records)} bars, last close {records[-1]['close']}")
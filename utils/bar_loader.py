@@ -0,0 +1,235 @@
+# Bulk loading of the bar logs written by bars_daemon
+import os
+import json
+from multiprocessing import Pool
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from utils.bars import Bar
+
+"""
+Parses whole bars/<date>/<ticker>.log files, or byte ranges of them, into
+NumPy structured arrays with the same fields as utils.bars._Bar.
+
+bars_daemon writes every line with json.dumps and the same key order, so the
+fast path works on the raw bytes with NumPy: it finds every '": ' separator,
+gathers the values into a fixed width byte array and converts each column
+with one vectorized cast, instead of a json.loads, a strptime and 13 int/float
+conversions per line. Buffers that do not have that layout fall back to
+json.loads per line.
+"""
+
+BAR_DTYPE = np.dtype([
+    ('datetime', 'datetime64[us]'),
+    ('is_open', '?'),
+    ('open', 'f8'),
+    ('high', 'f8'),
+    ('low', 'f8'),
+    ('close', 'f8'),
+    ('total_volume', 'i8'),
+    ('up_volume', 'i8'),
+    ('down_volume', 'i8'),
+    ('total_ticks', 'i8'),
+    ('up_ticks', 'i8'),
+    ('down_ticks', 'i8'),
+    ('unchanged_ticks', 'i8'),
+    ('unchanged_volume', 'i8'),
+])
+
+# The JSON key of each numeric field in the log lines
+JSON_KEYS = {
+    'open': 'Open',
+    'high': 'High',
+    'low': 'Low',
+    'close': 'Close',
+    'total_volume': 'TotalVolume',
+    'up_volume': 'UpVolume',
+    'down_volume': 'DownVolume',
+    'total_ticks': 'TotalTicks',
+    'up_ticks': 'UpTicks',
+    'down_ticks': 'DownTicks',
+    'unchanged_ticks': 'UnchangedTicks',
+    'unchanged_volume': 'UnchangedVolume',
+}
+
+# Bytes before the ': ' separator used to check every line has the same keys
+KEY_SIGNATURE_BYTES = 8
+# Longest value the fast path handles, time_received is 26 bytes
+MAX_VALUE_BYTES = 64
+
+def _read_range(filename: str, start: int = 0, end: int = None) -> bytes:
+    """Read the lines of a file that start in the byte range [start, end).
+    A line crossing start belongs to the previous range and a line
+    crossing end is read to its end, so consecutive ranges split a file
+    into whole lines with none lost or repeated.
+    """
+    with open(filename, 'rb') as f:
+        if start > 0:
+            f.seek(start - 1)
+            if f.read(1) != b'\n':
+                f.readline()
+        begin = f.tell()
+        if end is None:
+            return f.read()
+        if begin >= end:
+            return b''
+        buffer = f.read(end - begin)
+        if not buffer.endswith(b'\n'):
+            buffer += f.readline()
+        return buffer
+
+def _parse_slow(lines: list) -> np.ndarray:
+    """Parse the lines one at a time with json.loads, used when a line
+    does not have the layout the fast path expects."""
+    bars = []
+    for line in lines:
+        bar = json.loads(line)
+        if 'Heartbeat' in bar:
+            continue
+        bars.append((np.datetime64(bar['time_received'].replace(' ', 'T'), 'us'),
+                     bar['BarStatus'] == 'Open') +
+                    tuple(float(bar[key]) if name in ('open', 'high', 'low', 'close')
+                          else int(bar[key])
+                          for name, key in JSON_KEYS.items()))
+    return np.array(bars, dtype=BAR_DTYPE)
+
+def _parse_fast(buffer: bytes) -> np.ndarray:
+    """Parse lines that all have the key layout of the first line, see the
+    module docstring. Returns None if the buffer does not have that layout."""
+    first_line = buffer[:buffer.find(b'\n')] if b'\n' in buffer else buffer
+    keys = list(json.loads(first_line).keys())
+    columns = {key: i for i, key in enumerate(keys)}
+    if any(key not in columns for key in list(JSON_KEYS.values()) + ['BarStatus', 'time_received']):
+        return None
+
+    raw = np.frombuffer(b'\n' + buffer.rstrip() + b'\n' + bytes(MAX_VALUE_BYTES), dtype=np.uint8)
+    line_ends = np.flatnonzero((raw[:-1] == ord('\n')) & (raw[1:] == ord('{')))[1:] - 1
+    line_ends = np.append(line_ends, len(raw) - MAX_VALUE_BYTES - 2)
+    quotes = raw == ord('"')
+    separators = np.flatnonzero(quotes[:-2] & (raw[1:-1] == ord(':')) & (raw[2:] == ord(' ')))
+    if len(separators) != len(line_ends) * len(keys) or (raw[line_ends] != ord('}')).any():
+        return None
+    separators = separators.reshape(len(line_ends), len(keys))
+
+    # Every line must have the keys of the first line in the same order
+    windows = sliding_window_view(raw, KEY_SIGNATURE_BYTES)
+    signatures = windows[np.maximum(separators - KEY_SIGNATURE_BYTES + 1, 0)]
+    if not (signatures == signatures[0]).all():
+        return None
+
+    def column_values(key):
+        # A value starts after the separator and an optional quote. It ends
+        # at the ', "' before the next key, or at the closing brace
+        column = columns[key]
+        starts = separators[:, column] + 3
+        quoted = quotes[starts]
+        starts += quoted
+        if column + 1 < len(keys):
+            ends = separators[:, column + 1] - len(keys[column + 1]) - 3
+            if (raw[ends] != ord(',')).any():
+                raise ValueError(f"Unexpected separator after {key}")
+        else:
+            ends = line_ends
+        ends -= quoted
+        lengths = ends - starts
+        width = max(int(lengths.max()), 1)
+        if width > MAX_VALUE_BYTES:
+            raise ValueError(f"Value of {key} is too long")
+        values = sliding_window_view(raw, width)[starts]
+        values = np.where(np.arange(width) < lengths[:, None], values, 0).astype(np.uint8)
+        return values.view(f'S{width}').ravel()
+
+    bars = np.empty(len(line_ends), dtype=BAR_DTYPE)
+    bars['datetime'] = column_values('time_received').astype('datetime64[us]')
+    bars['is_open'] = column_values('BarStatus') == b'Open'
+    for name, key in JSON_KEYS.items():
+        bars[name] = column_values(key).astype(BAR_DTYPE[name])
+    return bars
+
+def parse_bars(buffer: bytes) -> np.ndarray:
+    """Parse a buffer of bar log lines.
+    Args:
+        buffer (bytes): Whole lines, each a JSON bar as written by bars_daemon
+    Returns:
+        np.ndarray: A structured array with dtype BAR_DTYPE, one row per bar
+    """
+    if len(buffer.strip()) == 0:
+        return np.empty(0, dtype=BAR_DTYPE)
+    try:
+        bars = _parse_fast(buffer)
+    except ValueError:
+        bars = None
+    if bars is None:
+        bars = _parse_slow([line for line in buffer.splitlines() if line.strip()])
+    return bars
+
+def load_bar_log(filename: str, start: int = 0, end: int = None) -> np.ndarray:
+    """Load a bar log file, or the lines starting in the byte range [start, end).
+    Args:
+        filename (str): The bars/<date>/<ticker>.log file
+        start (int): The first byte of the range
+        end (int): The end of the range, None for the end of the file
+    Returns:
+        np.ndarray: A structured array with dtype BAR_DTYPE
+    """
+    return parse_bars(_read_range(filename, start, end))
+
+def _load_range(args: tuple) -> np.ndarray:
+    """Pool helper, args is (filename, start, end)"""
+    return load_bar_log(*args)
+
+def load_bar_logs(filenames: list, processes: int = None, chunk_bytes: int = 64 * 1024 * 1024) -> np.ndarray:
+    """Load several bar log files, splitting them in byte ranges parsed in parallel.
+    Args:
+        filenames (list): The log files, the bars are returned in this order
+        processes (int): The number of worker processes, 1 parses in this
+            process, None uses one per CPU
+        chunk_bytes (int): The maximum size of a byte range
+    Returns:
+        np.ndarray: A structured array with dtype BAR_DTYPE
+    """
+    ranges = []
+    for filename in filenames:
+        size = os.path.getsize(filename)
+        for start in range(0, max(size, 1), chunk_bytes):
+            ranges.append((filename, start, start + chunk_bytes))
+    if len(ranges) == 0:
+        return np.empty(0, dtype=BAR_DTYPE)
+    if processes == 1 or len(ranges) == 1:
+        chunks = [_load_range(r) for r in ranges]
+    else:
+        with Pool(processes) as pool:
+            chunks = pool.map(_load_range, ranges)
+    return np.concatenate(chunks)
+
+def to_bars(bars: np.ndarray) -> list:
+    """Convert a structured array of bars to a list of utils.bars.Bar"""
+    return [Bar._make(row) for row in bars.tolist()]
+
+
+if __name__ == "__main__":
+
+    # Compare the fast parser with the json path and time both
+    import sys
+    import time
+    import tempfile
+
+    bar_str = '{"High": "38422", "Low": "38417", "Open": "38417", "Close": "38419", "TimeStamp": "2024-02-14T15:49:00Z", "TotalVolume": "86", "DownTicks": 27, "DownVolume": 31, "TotalTicks": 82, "UnchangedTicks": 0, "UnchangedVolume": 0, "UpTicks": 55, "UpVolume": 55, "BarStatus": "Open", "time_received": "2024-02-14 15:48:22.513444"}\n'
+    filename = sys.argv[1] if len(sys.argv) > 1 else None
+    if filename is None:
+        filename = os.path.join(tempfile.mkdtemp(), "ES.log")
+        with open(filename, 'w') as f:
+            for i in range(200000):
+                f.write(bar_str.replace('"Close": "38419"', f'"Close": "{38000 + i % 500}.25"'))
+
+    start = time.time()
+    bars = load_bar_log(filename)
+    print(f"Fast path: {len(bars)} bars in {time.time() - start:.3f} seconds")
+    start = time.time()
+    with open(filename, 'rb') as f:
+        slow = _parse_slow(f.read().splitlines())
+    print(f"json path: {len(slow)} bars in {time.time() - start:.3f} seconds")
+    print(f"Identical: {np.array_equal(bars, slow)}")
+    start = time.time()
+    ranged = load_bar_logs([filename], processes=4, chunk_bytes=1024 * 1024)
+    print(f"Byte ranges: {len(ranged)} bars in {time.time() - start:.3f} seconds, identical: {np.array_equal(bars, ranged)}")
+    print(to_bars(bars[:1])[0])
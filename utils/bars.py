@@ -5,6 +5,11 @@ from collections import namedtuple
 from typing import NamedTuple
 import datetime
 
+# The regular trading session in local (Pacific) time, bar datetimes are
+# the local time the bar was received
+DAY_START = datetime.time(6, 30)
+DAY_END = datetime.time(13, 0)
+
 class _Bar(NamedTuple):
     """Private namedtuple class for a bar"""
     datetime: datetime.datetime 
@@ -30,7 +35,6 @@ class Bar(_Bar):
     def __new__(cls, *args, **kwargs):
         """"""
         this_bar = args[1]
-        print(this_bar)
         if type(this_bar) != dict:
             this_bar = json.loads(this_bar)
     
@@ -61,6 +65,39 @@ class Bar(_Bar):
     def is_up_bar(self) -> bool:
         """Determine if the bar is an up bar"""
         return self.close > self.open
+
+    def is_during_day(self) -> bool:
+        """Determine if the bar was received during the regular trading session"""
+        if self.datetime is None:
+            return False
+        return DAY_START <= self.datetime.time() < DAY_END
+
+    def get_local_time(self) -> str:
+        """Get the local time the bar was received as a string"""
+        return self.datetime.strftime("%Y-%m-%d %H:%M:%S")
+
+    def get_diff_seconds(self, other: 'Bar') -> float:
+        """Get the seconds between this bar and an earlier one"""
+        return (self.datetime - other.datetime).total_seconds()
+
+    @staticmethod
+    def are_previous_up_bars(bars: list, n: int) -> bool:
+        """Determine if the last n bars of a list are all up bars"""
+        return len(bars) >= n and all(bar.is_up_bar() for bar in bars[len(bars) - n:])
+
+    @staticmethod
+    def are_last_n_ticks_up(bars: list, n: int) -> bool:
+        """Determine if the close went up on each of the last n updates of a bar.
+        Args:
+            bars (list): The updates of the open bar, oldest first
+            n (int): The number of up ticks
+        Returns:
+            bool: True if the last n closes were each higher than the one before
+        """
+        if len(bars) < n + 1:
+            return False
+        last = bars[len(bars) - n - 1:]
+        return all(last[i].close > last[i - 1].close for i in range(1, len(last)))
     
 def is_bar_up(bar: Bar) -> bool:
     """Determine if the bar is an up bar"""
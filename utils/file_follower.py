@@ -0,0 +1,243 @@
+# Follow the bar log files written by bars_daemon
+import os
+import select
+import ctypes
+import ctypes.util
+import time
+from datetime import datetime as dt
+
+"""
+An in-process replacement for `tail -F` on bars/<date>/<ticker>.log.
+Complete lines are handed out in batches and the byte offset after each
+batch is persisted in a checkpoint file next to the log, so a restart
+resumes where it stopped instead of re-reading the file. When following
+the current day the follower moves to the next day's file after the
+daemon's midnight rollover. Changes are waited for with inotify when it
+is available, otherwise the file is polled.
+"""
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+class _Inotify:
+    """Minimal inotify wrapper over libc, None is returned by create()
+    when inotify is not available."""
+
+    def __init__(self, libc, fd: int):
+        self.libc = libc
+        self.fd = fd
+        self.watched = set()
+
+    @staticmethod
+    def create():
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        return _Inotify(libc, fd)
+
+    def watch(self, path: str) -> None:
+        """Watch a directory for files created, written or moved in"""
+        if path in self.watched or not os.path.isdir(path):
+            return
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask) >= 0:
+            self.watched.add(path)
+
+    def wait(self, timeout: float) -> None:
+        """Wait up to timeout seconds for an event and drain the events"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable:
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+class FileFollower:
+    """Follows the bar log of a ticker, yielding batches of complete lines."""
+
+    def __init__(self, bars_dir: str, ticker: str, date: str = None, name: str = "follower",
+                 resume: bool = True, batch_size: int = 1000, poll_interval: float = 0.5,
+                 extension: str = "log"):
+        """Constructor
+        Args:
+            bars_dir (str): The directory holding the <date> directories
+            ticker (str): The ticker, the file followed is <date>/<ticker>.<extension>
+            date (str): The date as YYYYMMDD, None for today. When following
+                today the follower moves on to the next day at midnight.
+            name (str): Name of the reader, each reader has its own checkpoint
+            resume (bool): Start from the checkpoint rather than the start of the file
+            batch_size (int): The maximum number of lines in a batch
+            poll_interval (float): Seconds between checks when there is no new data
+            extension (str): The extension of the followed file
+        """
+        self.bars_dir = bars_dir
+        self.ticker = ticker
+        self.name = name
+        self.resume = resume
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.extension = extension
+        today = dt.now().strftime("%Y%m%d")
+        self.date = date if date is not None else today
+        self.follow_days = self.date == today
+        self.offset = 0
+        self._fp = None
+        self._pending = b''
+        self._inotify = _Inotify.create()
+
+    def _filename(self, date: str) -> str:
+        return os.path.join(self.bars_dir, date, f"{self.ticker}.{self.extension}")
+
+    def _checkpoint_filename(self, date: str) -> str:
+        return os.path.join(self.bars_dir, date, f".{self.ticker}.{self.name}.offset")
+
+    def _read_checkpoint(self, date: str) -> int:
+        """Get the offset saved for the day's file, 0 if there is none"""
+        try:
+            with open(self._checkpoint_filename(date), 'r') as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def save_checkpoint(self) -> None:
+        """Persist the offset of the current file, atomically"""
+        filename = self._checkpoint_filename(self.date)
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, 'w') as f:
+            f.write(str(self.offset))
+        os.replace(tmp_filename, filename)
+
+    def _open(self) -> bool:
+        """Open the current day's file at the checkpoint.
+        Returns:
+            bool: False if the file does not exist yet
+        """
+        if self._inotify is not None:
+            self._inotify.watch(self.bars_dir)
+            self._inotify.watch(os.path.join(self.bars_dir, self.date))
+        try:
+            self._fp = open(self._filename(self.date), 'rb')
+        except FileNotFoundError:
+            return False
+        self.offset = self._read_checkpoint(self.date) if self.resume else 0
+        # A checkpoint past the end means the file was replaced, start over
+        if self.offset > os.fstat(self._fp.fileno()).st_size:
+            self.offset = 0
+        self._fp.seek(self.offset)
+        self._pending = b''
+        return True
+
+    def _read_lines(self) -> list:
+        """Read up to batch_size complete lines from the current file"""
+        lines = []
+        while len(lines) < self.batch_size:
+            line = self._fp.readline()
+            if not line:
+                break
+            if not line.endswith(b'\n'):
+                # Partial line, the daemon is still writing it
+                self._pending += line
+                break
+            line = self._pending + line
+            self._pending = b''
+            lines.append(line.rstrip(b'\r\n'))
+        return lines
+
+    def _rollover(self) -> bool:
+        """Move to the next day's file if the day has changed and the
+        daemon has created it. The current file has been read to its end.
+        A partial last line is never completed once the daemon has moved
+        on, it is dropped.
+        Returns:
+            bool: True if there is more to read without waiting, in the
+                new file or in the current one
+        """
+        if not self.follow_days:
+            return False
+        today = dt.now().strftime("%Y%m%d")
+        if today == self.date or not os.path.exists(self._filename(today)):
+            return False
+        # The last lines of the day may have been written since the current
+        # file was read to its end, they are read before moving on
+        if os.fstat(self._fp.fileno()).st_size > self._fp.tell():
+            return True
+        if len(self._pending) > 0:
+            print(f"Dropped a partial last line of {self._filename(self.date)}: {self._pending[:100]}")
+            self._pending = b''
+        self._fp.close()
+        self._fp = None
+        self.date = today
+        return True
+
+    def _wait(self) -> None:
+        """Wait for the file to change, or poll_interval seconds"""
+        if self._inotify is not None:
+            self._inotify.wait(self.poll_interval)
+        else:
+            time.sleep(self.poll_interval)
+
+    def batches(self):
+        """Generate batches of lines, without line endings, forever.
+        The checkpoint is saved once the consumer asks for the next batch,
+        i.e. after it has processed the previous one.
+        """
+        try:
+            while True:
+                if self._fp is None and not self._open():
+                    self._wait()
+                    continue
+                lines = self._read_lines()
+                if len(lines) > 0:
+                    yield lines
+                    self.offset = self._fp.tell() - len(self._pending)
+                    self.save_checkpoint()
+                    continue
+                if not self._rollover():
+                    self._wait()
+        finally:
+            if self._fp is not None:
+                self._fp.close()
+            if self._inotify is not None:
+                self._inotify.close()
+
+
+if __name__ == "__main__":
+
+    # Follow a file while another thread appends to it and rolls over
+    import shutil
+    import tempfile
+    import threading
+
+    bars_dir = tempfile.mkdtemp()
+    today = dt.now().strftime("%Y%m%d")
+    os.mkdir(os.path.join(bars_dir, today))
+
+    def writer():
+        with open(os.path.join(bars_dir, today, "ES.log"), 'a') as f:
+            for i in range(2500):
+                f.write(f'{{"Close": "{i}"}}\n')
+                if i % 500 == 0:
+                    f.flush()
+                    time.sleep(0.1)
+
+    threading.Thread(target=writer).start()
+    follower = FileFollower(bars_dir, "ES", batch_size=1000, poll_interval=0.1)
+    count = 0
+    for lines in follower.batches():
+        count += len(lines)
+        print(f"Batch of {len(lines)} lines, {count} so far")
+        if count == 2500:
+            break
+    shutil.rmtree(bars_dir)
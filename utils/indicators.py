@@ -1,4 +1,8 @@
 from typing import List
+from collections import deque
+import itertools
+import math
+import sys
 import pandas as pd
 from ta.volume import VolumeWeightedAveragePrice
 
@@ -15,8 +19,8 @@ def rsi(price: List[float], period: float) -> List[float]:
     price_difference = price.diff()
     
     # Separate the gains and losses from the price difference
-    gains = price_difference.clamp_min(0).abs()
-    losses = price_difference.clamp_max(0).abs()
+    gains = price_difference.clip(lower=0).abs()
+    losses = price_difference.clip(upper=0).abs()
     
     # Calculate the relative strength (RS)
     rs = gains.ewm(alpha=1 / period).mean() / losses.ewm(alpha=1 / period).mean()
@@ -43,17 +47,279 @@ def macd(price: List[float], fast: float, slow: float, signal_span: float) -> Li
     
     return signal_line
 
-def vwap(data: pd.DataFrame) -> pd.DataFrame:
+def vwap(data: pd.DataFrame, session=None) -> pd.DataFrame:
+    """
+    Calculate the Volume Weighted Average Price (VWAP).
+
+    :param data: DataFrame with the columns High, Low, Close and Volume, it is not modified.
+    :param session: Optional session key per row, e.g. the trading date. The
+        cumulative sums restart at each new session.
+    :return: A copy of data with the TP, PV, CumulativePV, CumulativeVolume and VWAP columns added.
+    """
+    data = data.copy()
     data['TP'] = (data['High'] + data['Low'] + data['Close']) / 3
     data['PV'] = data['TP'] * data['Volume']
-    data['CumulativePV'] = data['PV'].cumsum()
-    data['CumulativeVolume'] = data['Volume'].cumsum()
+    if session is None:
+        data['CumulativePV'] = data['PV'].cumsum()
+        data['CumulativeVolume'] = data['Volume'].cumsum()
+    else:
+        # Series.cumsum per session, GroupBy.cumsum uses Kahan summation
+        # so it would not match the running sums of StreamingVWAP
+        data['CumulativePV'] = data['PV'].groupby(session, sort=False).transform(lambda pv: pv.cumsum())
+        data['CumulativeVolume'] = data['Volume'].groupby(session, sort=False).transform(lambda v: v.cumsum())
     data['VWAP'] = data['CumulativePV'] / data['CumulativeVolume']
     return data
 
+def rolling_std(price: List[float], window: int) -> List[float]:
+    """
+    Calculate the rolling sample standard deviation.
+
+    :param price: List of price data.
+    :param window: The number of bars in the window.
+    :return: A list representing the standard deviation, NaN until the window is full.
+    """
+    return price.rolling(window).std()
+
 from ta.volume import VolumeWeightedAveragePrice
 
 # ...
 def vwap2(df, label='vwap', window=3, fillna=True):
         df[label] = VolumeWeightedAveragePrice(high=df['high'], low=df['low'], close=df["close"], volume=df['volume'], window=window, fillna=fillna).volume_weighted_average_price()
         return df
+
+
+"""
+Streaming versions of the indicators above, for live strategies that see one
+bar update at a time. Each update() is O(1) and returns the same value the
+batch function returns for the last bar.
+
+Bars are passed with closed=False while they are still forming. An open bar
+is evaluated against the state of the last closed bar without changing it, so
+it can be revised any number of times, and it is only committed once it is
+passed with closed=True.
+
+The arithmetic follows pandas step by step, ewm().mean() and
+rolling().std(), so the results are identical and not just close.
+"""
+
+def _divide(numerator: float, denominator: float) -> float:
+    """Float division with the numpy results for a zero denominator"""
+    if denominator == 0:
+        if numerator == 0 or numerator != numerator:
+            return math.nan
+        return math.copysign(math.inf, numerator) * math.copysign(1.0, denominator)
+    return numerator / denominator
+
+class _StreamingEwm:
+    """The pandas ewm(com=...).mean() recursion, with ignore_na=False."""
+
+    def __init__(self, com: float, adjust: bool):
+        alpha = 1. / (1. + com)
+        self.old_wt_factor = 1. - alpha
+        self.new_wt = 1. if adjust else alpha
+        self.adjust = adjust
+        # The weighted mean and the weight of the previous observations
+        self.state = (math.nan, 1.)
+
+    def step(self, value: float) -> tuple:
+        """Get the state after value, without committing it"""
+        weighted, old_wt = self.state
+        if weighted != weighted:
+            # No observation yet
+            return (value, old_wt)
+        old_wt *= self.old_wt_factor
+        if value == value:
+            if weighted != value:
+                weighted = (old_wt * weighted + self.new_wt * value) / (old_wt + self.new_wt)
+            old_wt = old_wt + self.new_wt if self.adjust else 1.
+        return (weighted, old_wt)
+
+class StreamingRSI:
+    """Streaming rsi(), Wilder smoothing with alpha = 1 / period."""
+
+    def __init__(self, period: float):
+        """Constructor
+        Args:
+            period (float): The period over which to calculate RSI
+        """
+        com = 1. / (1. / period) - 1.
+        self.gains = _StreamingEwm(com, adjust=True)
+        self.losses = _StreamingEwm(com, adjust=True)
+        self.prev_price = None
+
+    def update(self, price: float, closed: bool = True) -> float:
+        """Add or revise the last bar.
+        Args:
+            price (float): The price of the bar
+            closed (bool): False while the bar is still open
+        Returns:
+            float: The RSI, NaN for the first bar
+        """
+        if self.prev_price is None:
+            if closed:
+                self.prev_price = price
+            return math.nan
+        difference = price - self.prev_price
+        if difference != difference:
+            gains = self.gains.step(difference)
+            losses = self.losses.step(difference)
+        else:
+            gains = self.gains.step(difference if difference > 0 else 0.)
+            losses = self.losses.step(-difference if difference < 0 else 0.)
+        if closed:
+            self.gains.state = gains
+            self.losses.state = losses
+            self.prev_price = price
+        rs = _divide(gains[0], losses[0])
+        return 100 * (1 - _divide(1., 1. + rs))
+
+class StreamingMACD:
+    """Streaming macd(), the MACD line minus its signal EMA."""
+
+    def __init__(self, fast: float, slow: float, signal_span: float):
+        """Constructor
+        Args:
+            fast (float): The period for the fast EMA
+            slow (float): The period for the slow EMA
+            signal_span (float): The period for the signal line
+        """
+        self.fast_ema = _StreamingEwm((fast - 1) / 2., adjust=False)
+        self.slow_ema = _StreamingEwm((slow - 1) / 2., adjust=False)
+        self.signal_ema = _StreamingEwm((signal_span - 1) / 2., adjust=False)
+
+    def update(self, price: float, closed: bool = True) -> float:
+        """Add or revise the last bar.
+        Args:
+            price (float): The price of the bar
+            closed (bool): False while the bar is still open
+        Returns:
+            float: The MACD signal value
+        """
+        fast = self.fast_ema.step(price)
+        slow = self.slow_ema.step(price)
+        macd_line = fast[0] - slow[0]
+        signal = self.signal_ema.step(macd_line)
+        if closed:
+            self.fast_ema.state = fast
+            self.slow_ema.state = slow
+            self.signal_ema.state = signal
+        return macd_line - signal[0]
+
+class StreamingVWAP:
+    """Streaming vwap(), restarting at each new session."""
+
+    def __init__(self):
+        self.session = None
+        self.cumulative_pv = 0.
+        self.cumulative_volume = 0.
+
+    def update(self, high: float, low: float, close: float, volume: float,
+               closed: bool = True, session=None) -> float:
+        """Add or revise the last bar.
+        Args:
+            high (float): The high of the bar
+            low (float): The low of the bar
+            close (float): The close of the bar
+            volume (float): The volume of the bar
+            closed (bool): False while the bar is still open
+            session: The session key of the bar, e.g. the trading date.
+                The VWAP restarts when it changes.
+        Returns:
+            float: The VWAP
+        """
+        pv = (high + low + close) / 3 * volume
+        if session != self.session:
+            cumulative_pv = 0.
+            cumulative_volume = 0.
+        else:
+            cumulative_pv = self.cumulative_pv
+            cumulative_volume = self.cumulative_volume
+        if closed:
+            # Like cumsum(), a NaN is NaN at its bar and skipped in the sums
+            self.session = session
+            self.cumulative_pv = cumulative_pv if pv != pv else cumulative_pv + pv
+            self.cumulative_volume = cumulative_volume if volume != volume else cumulative_volume + volume
+        return _divide(cumulative_pv + pv, cumulative_volume + volume)
+
+class StreamingStd:
+    """Streaming rolling_std(), Welford's method with Kahan compensation
+    as in pandas rolling().var(). Like pandas the window is summed again
+    from scratch when removing a value loses too much precision, which is
+    rare, so an update is O(1) amortized."""
+
+    # Relative loss of the sum of squares considered catastrophic cancellation
+    INV_COND_TOL = sys.float_info.epsilon * 1e3
+
+    def __init__(self, window: int):
+        """Constructor
+        Args:
+            window (int): The number of bars in the window
+        """
+        self.window = window
+        self.values = deque()
+        # nobs, mean, sum of squared differences from the mean and the
+        # compensations of the adds and of the removes
+        self.state = (0, 0., 0., 0., 0.)
+
+    @classmethod
+    def _add(cls, state: tuple, value: float) -> tuple:
+        """Add a value, returns the new state and True if it is unstable"""
+        nobs, mean_x, ssqdm_x, comp_add, comp_remove = state
+        if value != value:
+            return state, False
+        nobs += 1
+        prev_mean = mean_x - comp_add
+        y = value - comp_add
+        t = y - mean_x
+        comp_add = t + mean_x - y
+        mean_x = mean_x + t / nobs
+        prev_ssqdm_x = ssqdm_x
+        ssqdm_x = ssqdm_x + (value - prev_mean) * (value - mean_x)
+        return (nobs, mean_x, ssqdm_x, comp_add, comp_remove), prev_ssqdm_x * cls.INV_COND_TOL > ssqdm_x
+
+    @classmethod
+    def _remove(cls, state: tuple, value: float) -> tuple:
+        """Remove a value, returns the new state and True if it is unstable"""
+        nobs, mean_x, ssqdm_x, comp_add, comp_remove = state
+        if value != value:
+            return state, False
+        nobs -= 1
+        if nobs == 0:
+            return (0, 0., 0., comp_add, comp_remove), False
+        prev_mean = mean_x - comp_remove
+        y = value - comp_remove
+        t = y - mean_x
+        comp_remove = t + mean_x - y
+        mean_x = mean_x - t / nobs
+        prev_ssqdm_x = ssqdm_x
+        ssqdm_x = ssqdm_x - (value - prev_mean) * (value - mean_x)
+        return (nobs, mean_x, ssqdm_x, comp_add, comp_remove), prev_ssqdm_x * cls.INV_COND_TOL > ssqdm_x
+
+    def update(self, price: float, closed: bool = True) -> float:
+        """Add or revise the last bar.
+        Args:
+            price (float): The price of the bar
+            closed (bool): False while the bar is still open
+        Returns:
+            float: The standard deviation, NaN until the window is full
+        """
+        state = self.state
+        unstable = False
+        is_full = len(self.values) == self.window
+        if is_full:
+            state, unstable = self._remove(state, self.values[0])
+        state, added_unstable = self._add(state, price)
+        if unstable or added_unstable:
+            state = (0, 0., 0., 0., 0.)
+            for value in itertools.chain(itertools.islice(self.values, int(is_full), None), (price,)):
+                state, _ = self._add(state, value)
+        if closed:
+            self.state = state
+            self.values.append(price)
+            if is_full:
+                self.values.popleft()
+        nobs, _, ssqdm_x, _, _ = state
+        if nobs < self.window or nobs <= 1:
+            return math.nan
+        variance = ssqdm_x / (nobs - 1)
+        return math.sqrt(variance) if variance > 0 else 0.
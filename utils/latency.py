@@ -0,0 +1,218 @@
+# Latency histograms of the stages a bar goes through
+import os
+import sys
+import json
+import time
+import atexit
+import datetime
+import threading
+import numpy as np
+
+"""
+Records how long each stage of the bar pipeline takes, per ticker, in
+histograms of the kind of HdrHistogram: values in microseconds go into
+buckets of 2 ** SUB_BUCKET_BITS linear sub-buckets per power of two, so any
+value is counted within 1 / 2 ** (SUB_BUCKET_BITS - 1) of itself from one
+microsecond to MAX_VALUE_US, in a fixed number of counters. Recording is an
+integer bit_length and a counter increment.
+
+The stages:
+
+    exchange_to_receipt    the TimeStamp of a closed bar to its receipt
+                           by bars_daemon
+    receipt_to_write       the receipt to the write of the bar log line
+    receipt_to_strategy    the receipt to the strategy processing the bar,
+                           through the bar log and the FileFollower
+    decision_to_alert      the strategy deciding a trade to the email of
+                           the alert sent
+
+Every EXPORT_INTERVAL seconds, on the next record, the histograms of the
+interval are appended to latency/<name>.jsonl with their percentiles and
+their non empty buckets, and start again. The buckets of any number of
+intervals can be merged, see the command line of this module.
+"""
+
+LATENCY_DIR = "latency"
+EXPORT_INTERVAL = 60.0
+SUB_BUCKET_BITS = 7
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+HALF_SUB_BUCKETS = SUB_BUCKETS // 2
+MAX_VALUE_US = (1 << 36) - 1
+NUM_BUCKETS = ((MAX_VALUE_US.bit_length() - SUB_BUCKET_BITS) + 2) * HALF_SUB_BUCKETS
+PERCENTILES = (50.0, 90.0, 99.0, 99.9)
+
+def bucket_index(value_us: int) -> int:
+    """Get the bucket of a value, values above MAX_VALUE_US are clamped"""
+    if value_us < SUB_BUCKETS:
+        return value_us
+    value_us = min(value_us, MAX_VALUE_US)
+    shift = value_us.bit_length() - SUB_BUCKET_BITS
+    return shift * HALF_SUB_BUCKETS + (value_us >> shift)
+
+def bucket_value(index: int) -> int:
+    """Get the lowest value of a bucket"""
+    if index < SUB_BUCKETS:
+        return index
+    shift = index // HALF_SUB_BUCKETS - 1
+    return (index - shift * HALF_SUB_BUCKETS) << shift
+
+class LatencyHistogram:
+    """Counts of latencies in log-linear buckets of microseconds."""
+
+    def __init__(self):
+        self.counts = [0] * NUM_BUCKETS
+        self.count = 0
+        self.negative = 0
+        self.min_us = None
+        self.max_us = 0
+
+    def record(self, seconds: float) -> None:
+        """Record a latency, negative ones, from clocks that disagree, are
+        only counted"""
+        value_us = int(seconds * 1e6)
+        if value_us < 0:
+            self.negative += 1
+            return
+        self.counts[bucket_index(value_us)] += 1
+        self.count += 1
+        if value_us > self.max_us:
+            self.max_us = value_us
+        if self.min_us is None or value_us < self.min_us:
+            self.min_us = value_us
+
+    def merge(self, buckets: dict) -> None:
+        """Add exported buckets, lowest value to count"""
+        for value, count in buckets.items():
+            self.counts[bucket_index(int(value))] += count
+            self.count += count
+
+    def percentile(self, percentile: float) -> int:
+        """Get the value at or below which percentile % of the latencies are,
+        in microseconds, the middle of its bucket within the min and max"""
+        if self.count == 0:
+            return None
+        counts = np.asarray(self.counts)
+        index = int(np.searchsorted(np.cumsum(counts), self.count * percentile / 100.0))
+        low = bucket_value(index)
+        value = (low + bucket_value(index + 1)) // 2 if index >= SUB_BUCKETS else low
+        return min(max(value, self.min_us or 0), self.max_us)
+
+    def summary(self) -> dict:
+        """Get the count and the percentiles in microseconds"""
+        summary = {'count': self.count, 'negative': self.negative, 'min_us': self.min_us}
+        for percentile in PERCENTILES:
+            summary[f"p{percentile:g}_us"] = self.percentile(percentile)
+        summary['max_us'] = self.max_us if self.count > 0 else None
+        return summary
+
+    def buckets(self) -> dict:
+        """Get the non empty buckets, lowest value to count"""
+        return {bucket_value(index): count for index, count in enumerate(self.counts) if count > 0}
+
+class LatencyRecorder:
+    """Histograms of the latency of each stage and ticker of one process,
+    exported periodically."""
+
+    def __init__(self, name: str, latency_dir: str = LATENCY_DIR, interval: float = EXPORT_INTERVAL):
+        """Constructor
+        Args:
+            name (str): The name of the process, the export file is <name>.jsonl
+            latency_dir (str): The directory of the export files, None to
+                not export
+            interval (float): Seconds between exports
+        """
+        self.name = name
+        self.latency_dir = latency_dir
+        self.interval = interval
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._next_export = time.monotonic() + interval
+        atexit.register(self.export)
+
+    def record(self, stage: str, seconds: float, ticker: str = "all") -> None:
+        """Record the latency of a stage
+        Args:
+            stage (str): The stage, e.g. 'receipt_to_write'
+            seconds (float): The latency
+            ticker (str): The ticker
+        """
+        with self._lock:
+            histogram = self.histograms.get((stage, ticker))
+            if histogram is None:
+                histogram = self.histograms[(stage, ticker)] = LatencyHistogram()
+            histogram.record(seconds)
+        if time.monotonic() >= self._next_export:
+            self.export()
+
+    def export(self) -> None:
+        """Append the histograms of the interval to the export file and
+        start new ones"""
+        with self._lock:
+            self._next_export = time.monotonic() + self.interval
+            histograms, self.histograms = self.histograms, {}
+        if self.latency_dir is None or len(histograms) == 0:
+            return
+        os.makedirs(self.latency_dir, exist_ok=True)
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        with open(os.path.join(self.latency_dir, f"{self.name}.jsonl"), 'a') as f:
+            for (stage, ticker), histogram in sorted(histograms.items()):
+                f.write(json.dumps({'time': now, 'stage': stage, 'ticker': ticker, **histogram.summary(),
+                                    'buckets': histogram.buckets()}) + "\n")
+
+def load_histograms(filenames: list, since: str = None) -> dict:
+    """Merge the exported histograms of files
+    Args:
+        filenames (list): The export files
+        since (str): Only the intervals exported from this ISO time
+    Returns:
+        dict: (stage, ticker) to its LatencyHistogram
+    """
+    histograms = {}
+    for filename in filenames:
+        with open(filename, 'r') as f:
+            for line in f:
+                exported = json.loads(line)
+                if since is not None and exported['time'] < since:
+                    continue
+                histogram = histograms.setdefault((exported['stage'], exported['ticker']), LatencyHistogram())
+                histogram.merge(exported['buckets'])
+                histogram.negative += exported['negative']
+                if exported['count'] > 0:
+                    histogram.max_us = max(histogram.max_us, exported['max_us'])
+                    histogram.min_us = exported['min_us'] if histogram.min_us is None \
+                        else min(histogram.min_us, exported['min_us'])
+    return histograms
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1:
+        # Print the percentiles of export files: latency.py <files> [--since <iso time>]
+        args = sys.argv[1:]
+        since = None
+        if '--since' in args:
+            since = args[args.index('--since') + 1]
+            args = args[:args.index('--since')] + args[args.index('--since') + 2:]
+        for (stage, ticker), histogram in sorted(load_histograms(args, since).items()):
+            summary = histogram.summary()
+            print(f"{stage:20} {ticker:8} n={summary['count']:<8} " +
+                  " ".join(f"p{p:g}={summary[f'p{p:g}_us'] / 1000:.1f}ms" for p in PERCENTILES) +
+                  f" max={summary['max_us'] / 1000:.1f}ms")
+        sys.exit(0)
+
+    # Check the accuracy of the percentiles and time record()
+    rng = np.random.default_rng(1)
+    latencies = rng.lognormal(np.log(0.02), 1.0, 200000)
+    histogram = LatencyHistogram()
+    latencies = latencies.tolist()
+    for latency in latencies:
+        histogram.record(latency)
+    for percentile in PERCENTILES:
+        exact = np.percentile(latencies, percentile) * 1e6
+        print(f"p{percentile:g}: {histogram.percentile(percentile)} us, exact {exact:.0f} us, "
+              f"error {abs(histogram.percentile(percentile) - exact) / exact:.2%}")
+    recorder = LatencyRecorder("test", latency_dir=None)
+    start = time.perf_counter()
+    for latency in latencies:
+        recorder.record('receipt_to_write', latency, 'ESH24')
+    print(f"record() takes {(time.perf_counter() - start) / len(latencies) * 1e9:.0f} ns")
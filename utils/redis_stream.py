@@ -0,0 +1,641 @@
+# Bar updates published to, and read from, Redis streams
+import json
+import asyncio
+from collections import deque
+
+"""
+A small Redis client on asyncio streams for the bar streams, in the manner
+of utils/async_stream, with only what publishing and reading them needs.
+
+Each ticker has its own stream, bars:<ticker>, whose entries have a single
+'line' field holding the JSON of the bar update as written to the bar logs,
+so a strategy can make a utils.bars.Bar of it. Streams are trimmed to about
+maxlen entries as they are written.
+
+BarPublisher.publish() only queues the update. A writer task sends the
+queued updates as one pipeline of XADD commands, one write and one read of
+the replies for the batch, and the updates arriving during a round trip go
+in the next batch, so batches grow with the rate instead of waiting on a
+timer. If Redis is down the updates are kept, up to max_pending, and sent
+once it is back.
+
+BarStreamReader reads the streams of some tickers as a consumer of a
+consumer group, so several strategy processes can share the work of a
+group, or each have its own group to get every update. Batches are
+acknowledged once the next one is asked for; after a restart the entries
+read but not acknowledged are read again first.
+"""
+
+REDIS_HOST = "localhost"
+REDIS_PORT = 6379
+STREAM_PREFIX = "bars:"
+DEFAULT_MAXLEN = 100000
+DEFAULT_READ_SIZE = 2 ** 16
+
+class RedisError(Exception):
+    """An error reply of Redis, or a reply that cannot be parsed."""
+    pass
+
+def stream_key(ticker: str) -> str:
+    """Get the stream of a ticker"""
+    return f"{STREAM_PREFIX}{ticker}"
+
+def encode_command(*args) -> bytes:
+    """Encode a command as a RESP array of bulk strings"""
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+class _Incomplete(Exception):
+    """The received bytes end before the reply"""
+    pass
+
+class ReplyParser:
+    """Incremental parser of RESP replies. Bulk strings are returned as
+    str, an error reply as a RedisError instance, not raised, and nil as
+    None. The arrays parsed so far are kept when the bytes run out, so a
+    large reply received in many reads is parsed once."""
+
+    def __init__(self):
+        self.buffer = b""
+        self.pos = 0
+        self.stack = []
+
+    def feed(self, data: bytes) -> None:
+        """Add received bytes"""
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+
+    def get(self):
+        """Get the next reply
+        Raises:
+            _Incomplete: If the bytes fed end before it
+        """
+        buffer = self.buffer
+        while True:
+            end = buffer.find(b"\r\n", self.pos)
+            if end < 0:
+                raise _Incomplete()
+            kind, rest = buffer[self.pos], buffer[self.pos + 1:end]
+            if kind == 0x24:  # $ bulk string
+                length = int(rest)
+                if length < 0:
+                    item = None
+                    self.pos = end + 2
+                elif len(buffer) < end + length + 4:
+                    raise _Incomplete()
+                else:
+                    item = buffer[end + 2:end + 2 + length].decode()
+                    self.pos = end + length + 4
+            elif kind == 0x2a:  # * array
+                length = int(rest)
+                self.pos = end + 2
+                if length > 0:
+                    self.stack.append(([], length))
+                    continue
+                item = None if length < 0 else []
+            elif kind == 0x2b:  # + simple string
+                item = rest.decode()
+                self.pos = end + 2
+            elif kind == 0x3a:  # : integer
+                item = int(rest)
+                self.pos = end + 2
+            elif kind == 0x2d:  # - error
+                item = RedisError(rest.decode())
+                self.pos = end + 2
+            else:
+                raise RedisError(f"Invalid reply line: {buffer[self.pos:end]}")
+            # Add the item to the arrays it completes
+            while len(self.stack) > 0:
+                items, length = self.stack[-1]
+                items.append(item)
+                if len(items) < length:
+                    break
+                self.stack.pop()
+                item = items
+            else:
+                return item
+
+class RedisConnection:
+    """A connection to Redis."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.parser = ReplyParser()
+
+    @staticmethod
+    async def open(host: str = REDIS_HOST, port: int = REDIS_PORT, timeout: float = 10.0) -> 'RedisConnection':
+        """Connect to Redis
+        Args:
+            host (str): The Redis host
+            port (int): The Redis port
+            timeout (float): Seconds to wait for the connection
+        Returns:
+            RedisConnection: The connection
+        """
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        return RedisConnection(reader, writer)
+
+    async def execute(self, *args):
+        """Run a command
+        Returns:
+            The reply
+        Raises:
+            RedisError: On an error reply
+        """
+        reply = (await self.pipeline([args]))[0]
+        if isinstance(reply, RedisError):
+            raise reply
+        return reply
+
+    async def pipeline(self, commands: list) -> list:
+        """Send commands in one write and read their replies
+        Args:
+            commands (list): The commands, tuples of their arguments
+        Returns:
+            list: The replies in the order of the commands, RedisError
+                instances for the commands that failed
+        """
+        self.writer.write(b"".join(encode_command(*command) for command in commands))
+        await self.writer.drain()
+        replies = []
+        while len(replies) < len(commands):
+            try:
+                replies.append(self.parser.get())
+            except _Incomplete:
+                data = await self.reader.read(DEFAULT_READ_SIZE)
+                if not data:
+                    raise ConnectionError("Connection closed by Redis")
+                self.parser.feed(data)
+        return replies
+
+    async def close(self) -> None:
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+class BarPublisher:
+    """Publishes bar updates to one Redis stream per ticker."""
+
+    def __init__(self, host: str = REDIS_HOST, port: int = REDIS_PORT, maxlen: int = DEFAULT_MAXLEN,
+                 batch_size: int = 1000, max_pending: int = 100000, retry_seconds: float = 1.0,
+                 max_retry_seconds: float = 30.0):
+        """Constructor
+        Args:
+            host (str): The Redis host
+            port (int): The Redis port
+            maxlen (int): About the most entries kept per stream
+            batch_size (int): Most updates per pipeline
+            max_pending (int): Most updates queued, the oldest are dropped
+                beyond it while Redis cannot be reached. Every update is
+                counted in published or dropped, the updates refused by
+                Redis and the ones not sent when closing are dropped too.
+            retry_seconds (float): Seconds before the first reconnection
+            max_retry_seconds (float): Most seconds between reconnections
+        """
+        self.host = host
+        self.port = port
+        self.maxlen = maxlen
+        self.batch_size = batch_size
+        self.retry_seconds = retry_seconds
+        self.max_retry_seconds = max_retry_seconds
+        self.published = 0
+        self.batches = 0
+        self.dropped = 0
+        self._pending = deque(maxlen=max_pending)
+        self._wakeup = asyncio.Event()
+        self._closing = False
+        self._conn = None
+        self._task = None
+
+    def start(self) -> None:
+        """Start the writer task, in the running event loop"""
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def publish(self, ticker: str, bar) -> None:
+        """Queue a bar update, never waits
+        Args:
+            ticker (str): The ticker
+            bar: The bar update, a dict or its JSON line
+        """
+        if len(self._pending) == self._pending.maxlen:
+            self.dropped += 1
+        self._pending.append((ticker, bar if isinstance(bar, str) else json.dumps(bar)))
+        self._wakeup.set()
+
+    async def close(self) -> None:
+        """Send the queued updates and stop the writer task"""
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+
+    async def _run(self) -> None:
+        retry = self.retry_seconds
+        while True:
+            if len(self._pending) == 0:
+                if self._closing:
+                    break
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+            try:
+                if self._conn is None:
+                    self._conn = await RedisConnection.open(self.host, self.port)
+                replies = await self._conn.pipeline(
+                    [("XADD", stream_key(ticker), "MAXLEN", "~", self.maxlen, "*", "line", line)
+                     for ticker, line in batch])
+            except (ConnectionError, OSError, asyncio.TimeoutError) as ex:
+                # Put the batch back in front and reconnect after a backoff.
+                # Updates were queued meanwhile, the oldest are dropped to
+                # make room as extendleft would drop the newest
+                overflow = len(self._pending) + len(batch) - self._pending.maxlen
+                if overflow > 0:
+                    self.dropped += overflow
+                    batch = batch[overflow:]
+                self._pending.extendleft(reversed(batch))
+                if self._conn is not None:
+                    await self._conn.close()
+                    self._conn = None
+                if self._closing:
+                    print(f"BarPublisher: {len(self._pending)} updates not sent, Redis unreachable: {ex}")
+                    self.dropped += len(self._pending)
+                    self._pending.clear()
+                    break
+                print(f"BarPublisher: Redis unreachable ({ex}), retrying in {retry:.1f} s")
+                await asyncio.sleep(retry)
+                retry = min(retry * 2, self.max_retry_seconds)
+                continue
+            retry = self.retry_seconds
+            errors = [reply for reply in replies if isinstance(reply, RedisError)]
+            if len(errors) > 0:
+                print(f"BarPublisher: {len(errors)} updates refused: {errors[0]}")
+            self.published += len(batch) - len(errors)
+            self.dropped += len(errors)
+            self.batches += 1
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+class BarStreamReader:
+    """Reads the bar streams of tickers as a member of a consumer group."""
+
+    def __init__(self, tickers: list, group: str, consumer: str, host: str = REDIS_HOST,
+                 port: int = REDIS_PORT, count: int = 1000, block_ms: int = 1000, start_id: str = "$",
+                 retry_seconds: float = 1.0, max_retry_seconds: float = 30.0):
+        """Constructor
+        Args:
+            tickers (list): The tickers to read
+            group (str): The consumer group, created if needed
+            consumer (str): The name of this consumer in the group, the same
+                across restarts to read its unacknowledged entries again
+            host (str): The Redis host
+            port (int): The Redis port
+            count (int): Most entries read per stream and read
+            block_ms (int): Milliseconds a read waits for new entries
+            start_id (str): Where a new group starts, '$' for the new
+                entries only, '0' for the whole streams
+            retry_seconds (float): Seconds before the first reconnection
+            max_retry_seconds (float): Most seconds between reconnections
+        """
+        self.tickers = list(tickers)
+        self.group = group
+        self.consumer = consumer
+        self.host = host
+        self.port = port
+        self.count = count
+        self.block_ms = block_ms
+        self.start_id = start_id
+        self.retry_seconds = retry_seconds
+        self.max_retry_seconds = max_retry_seconds
+        self._tickers = {stream_key(ticker): ticker for ticker in self.tickers}
+        self._conn = None
+        self._pending_ids = None
+
+    async def open(self) -> None:
+        """Connect and create the consumer groups that do not exist"""
+        self._conn = await RedisConnection.open(self.host, self.port)
+        replies = await self._conn.pipeline([("XGROUP", "CREATE", key, self.group, self.start_id, "MKSTREAM")
+                                             for key in self._tickers])
+        for reply in replies:
+            if isinstance(reply, RedisError) and not str(reply).startswith("BUSYGROUP"):
+                raise reply
+        # Entries read before a restart but not acknowledged come first
+        self._pending_ids = {key: "0" for key in self._tickers}
+
+    async def read(self) -> list:
+        """Read the next entries, waiting up to block_ms for new ones
+        Returns:
+            list: Tuples of the ticker, the entry id and the JSON line
+        """
+        if self._conn is None:
+            await self.open()
+        if self._pending_ids is not None:
+            entries, read = await self._read(["STREAMS"] + list(self._tickers) +
+                                             [self._pending_ids[key] for key in self._tickers])
+            if read:
+                return entries
+            self._pending_ids = None
+        entries, _ = await self._read(["BLOCK", self.block_ms, "STREAMS"] + list(self._tickers) +
+                                      [">"] * len(self._tickers))
+        return entries
+
+    async def _read(self, arguments: list) -> tuple:
+        """Run XREADGROUP
+        Returns:
+            tuple: The entries, and whether any entry was read, including
+                the pending entries trimmed from the streams
+        """
+        reply = await self._conn.execute("XREADGROUP", "GROUP", self.group, self.consumer,
+                                         "COUNT", self.count, *arguments)
+        entries = []
+        trimmed = []
+        read = False
+        for key, stream_entries in reply or []:
+            for entry_id, fields in stream_entries:
+                read = True
+                if self._pending_ids is not None:
+                    self._pending_ids[key] = entry_id
+                if fields is None:
+                    # Trimmed from the stream before it was acknowledged
+                    trimmed.append((self._tickers[key], entry_id, None))
+                    continue
+                entries.append((self._tickers[key], entry_id, dict(zip(fields[::2], fields[1::2]))['line']))
+        await self.ack(trimmed)
+        return entries, read
+
+    async def ack(self, entries: list) -> None:
+        """Acknowledge entries returned by read()"""
+        ids = {}
+        for ticker, entry_id, _ in entries:
+            ids.setdefault(stream_key(ticker), []).append(entry_id)
+        if len(ids) > 0:
+            await self._conn.pipeline([("XACK", key, self.group) + tuple(key_ids) for key, key_ids in ids.items()])
+
+    async def batches(self):
+        """Generate batches of (ticker, entry id, JSON line) forever. A
+        batch is acknowledged once the consumer asks for the next one, i.e.
+        after it has processed it."""
+        retry = self.retry_seconds
+        entries = []
+        try:
+            while True:
+                try:
+                    if len(entries) > 0:
+                        await self.ack(entries)
+                        entries = []
+                    entries = await self.read()
+                    retry = self.retry_seconds
+                except (ConnectionError, OSError, asyncio.TimeoutError) as ex:
+                    # The unacknowledged entries are read again after reconnecting
+                    entries = []
+                    await self.close()
+                    print(f"BarStreamReader: Redis unreachable ({ex}), retrying in {retry:.1f} s")
+                    await asyncio.sleep(retry)
+                    retry = min(retry * 2, self.max_retry_seconds)
+                    continue
+                if len(entries) > 0:
+                    yield entries
+        finally:
+            await self.close()
+
+    async def close(self) -> None:
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+
+if __name__ == "__main__":
+
+    # Publish and read bar updates of many tickers through a local stand-in
+    # of the Redis stream commands, pipelined and one command at a time
+    import time
+    import bisect
+    import socket
+
+    class _LocalRedis:
+        """Just enough of the Redis stream commands, in memory"""
+
+        def __init__(self):
+            self.streams = {}
+            self.groups = {}
+            self.last_id = (0, 0)
+            self.added = asyncio.Condition()
+
+        def _new_id(self) -> tuple:
+            ms = int(time.time() * 1000)
+            self.last_id = (ms, 0) if ms > self.last_id[0] else (self.last_id[0], self.last_id[1] + 1)
+            return self.last_id
+
+        async def handle(self, reader, writer):
+            parser = ReplyParser()
+            try:
+                while True:
+                    # Run the pipelined commands received, reply in one write
+                    data = await reader.read(DEFAULT_READ_SIZE)
+                    if not data:
+                        return
+                    parser.feed(data)
+                    replies = []
+                    while True:
+                        try:
+                            command = parser.get()
+                        except _Incomplete:
+                            break
+                        replies.append(await self.run(command))
+                    writer.write(b"".join(replies))
+                    await writer.drain()
+            except ConnectionError:
+                pass
+            finally:
+                writer.close()
+
+        @staticmethod
+        def _encode(reply) -> bytes:
+            if reply is None:
+                return b"*-1\r\n"
+            if isinstance(reply, int):
+                return b":%d\r\n" % reply
+            if isinstance(reply, RedisError):
+                return f"-{reply}\r\n".encode()
+            if isinstance(reply, str):
+                return b"$%d\r\n%s\r\n" % (len(reply.encode()), reply.encode())
+            return b"*%d\r\n" % len(reply) + b"".join(_LocalRedis._encode(item) for item in reply)
+
+        async def run(self, command: list) -> bytes:
+            name = command[0].upper()
+            if name == "PING":
+                return b"+PONG\r\n"
+            if name == "XADD":
+                key, i = command[1], 2
+                maxlen = None
+                if command[i].upper() == "MAXLEN":
+                    i += 1
+                    if command[i] in ("~", "="):
+                        i += 1
+                    maxlen = int(command[i])
+                    i += 1
+                entry_id = self._new_id()
+                stream = self.streams.setdefault(key, [])
+                stream.append((entry_id, command[i + 1:]))
+                if maxlen is not None and len(stream) > maxlen:
+                    del stream[:len(stream) - maxlen]
+                async with self.added:
+                    self.added.notify_all()
+                return self._encode(f"{entry_id[0]}-{entry_id[1]}")
+            if name == "XGROUP":
+                key, group, start = command[2], command[3], command[4]
+                groups = self.groups.setdefault(key, {})
+                if group in groups:
+                    return self._encode(RedisError("BUSYGROUP Consumer Group name already exists"))
+                self.streams.setdefault(key, [])
+                last = self.last_id if start == "$" else (0, 0)
+                groups[group] = {'last': last, 'pending': {}}
+                return b"+OK\r\n"
+            if name == "XREADGROUP":
+                group, consumer = command[2], command[3]
+                options = {command[i].upper(): command[i + 1] for i in range(4, command.index("STREAMS"), 2)}
+                keys = command[command.index("STREAMS") + 1:]
+                keys, ids = keys[:len(keys) // 2], keys[len(keys) // 2:]
+                count = int(options.get("COUNT", 1 << 30))
+                deadline = time.monotonic() + int(options.get("BLOCK", 0)) / 1000
+                while True:
+                    reply = []
+                    for key, start in zip(keys, ids):
+                        state = self.groups[key][group]
+                        if start == ">":
+                            stream = self.streams[key]
+                            first = bisect.bisect_right(stream, (state['last'], [chr(0x10ffff)]))
+                            entries = stream[first:first + count]
+                            if len(entries) > 0:
+                                state['last'] = entries[-1][0]
+                                state['pending'].update((entry[0], consumer) for entry in entries)
+                        else:
+                            stored = dict(self.streams[key])
+                            after = tuple(int(part) for part in start.split("-")) if "-" in start else (int(start), -1)
+                            entries = [(entry_id, stored.get(entry_id)) for entry_id, owner
+                                       in sorted(state['pending'].items()) if owner == consumer and entry_id > after][:count]
+                        if len(entries) > 0:
+                            reply.append([key, [[f"{i[0]}-{i[1]}", fields] for i, fields in entries]])
+                    remaining = deadline - time.monotonic()
+                    if len(reply) > 0 or "BLOCK" not in options or remaining <= 0:
+                        return self._encode(reply if len(reply) > 0 or "BLOCK" not in options else None)
+                    try:
+                        async with self.added:
+                            await asyncio.wait_for(self.added.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        pass
+            if name == "XACK":
+                pending = self.groups[command[1]][command[2]]['pending']
+                acked = 0
+                for entry_id in command[3:]:
+                    ms, seq = entry_id.split("-")
+                    acked += pending.pop((int(ms), int(seq)), None) is not None
+                return self._encode(acked)
+            if name == "XLEN":
+                return self._encode(len(self.streams.get(command[1], [])))
+            return self._encode(RedisError(f"ERR unknown command '{name}'"))
+
+    NUM_TICKERS = 10
+    NUM_UPDATES = 50000
+    BAR = {"High": "38422", "Low": "38417", "Open": "38417", "Close": "38419",
+           "TimeStamp": "2024-02-14T15:49:00Z", "TotalVolume": "86", "DownTicks": 27, "DownVolume": 31,
+           "TotalTicks": 82, "UnchangedTicks": 0, "UnchangedVolume": 0, "UpTicks": 55, "UpVolume": 55,
+           "BarStatus": "Open", "time_received": "2024-02-14 15:48:22.513444"}
+    tickers = [f"T{i}" for i in range(NUM_TICKERS)]
+
+    async def demo():
+        local = _LocalRedis()
+        server = await asyncio.start_server(local.handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+
+        # Two readers in a group share the updates, opened first so the
+        # group starts before them
+        readers = [BarStreamReader(tickers, "strategies", f"consumer_{i}", "127.0.0.1", port, block_ms=100)
+                   for i in range(2)]
+        for reader in readers:
+            await reader.open()
+
+        publisher = BarPublisher("127.0.0.1", port, maxlen=NUM_UPDATES)
+        publisher.start()
+        start = time.perf_counter()
+        for i in range(NUM_UPDATES):
+            publisher.publish(tickers[i % NUM_TICKERS], BAR)
+            if i % 100 == 99:
+                await asyncio.sleep(0)
+        await publisher.close()
+        elapsed = time.perf_counter() - start
+        assert publisher.published == NUM_UPDATES and publisher.dropped == 0
+        print(f"Pipelined: {publisher.published} updates in {publisher.batches} batches, "
+              f"{publisher.published / elapsed:,.0f} updates/s")
+
+        received = []
+        async def consume(reader):
+            async for entries in reader.batches():
+                received.extend(entries)
+        start = time.perf_counter()
+        consumers = [asyncio.create_task(consume(reader)) for reader in readers]
+        while len(received) < NUM_UPDATES and time.perf_counter() - start < 30:
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        # Every update read once, by one of the consumers
+        assert len(received) == publisher.published
+        assert len({(entry[0], entry[1]) for entry in received}) == len(received)
+        print(f"Read {len(received)} updates by 2 consumers, {len(received) / elapsed:,.0f} updates/s, "
+              f"Bar close {float(json.loads(received[-1][2])['Close'])}")
+        for task in consumers:
+            task.cancel()
+
+        conn = await RedisConnection.open("127.0.0.1", port)
+        line = json.dumps(BAR)
+        start = time.perf_counter()
+        for i in range(NUM_UPDATES // 10):
+            await conn.execute("XADD", stream_key(tickers[i % NUM_TICKERS]), "MAXLEN", "~", NUM_UPDATES, "*",
+                               "line", line)
+        elapsed = time.perf_counter() - start
+        print(f"One XADD per round trip: {NUM_UPDATES // 10 / elapsed:,.0f} updates/s")
+
+        # Unacknowledged entries are read again by a restarted consumer
+        reader = BarStreamReader(["X"], "replay", "consumer", "127.0.0.1", port, start_id="0")
+        await reader.open()
+        await conn.execute("XADD", stream_key("X"), "*", "line", line)
+        first = await reader.read()
+        await reader.close()
+        await reader.open()
+        again = await reader.read()
+        await reader.ack(again)
+        await reader.close()
+        await reader.open()
+        acknowledged = await reader.read()
+        assert len(first) == 1 and len(again) == 1 and len(acknowledged) == 0
+        print(f"Read {len(first)} entry, {len(again)} again after a restart, "
+              f"{len(acknowledged)} once acknowledged")
+        await reader.close()
+        await conn.close()
+        server.close()
+
+        # While Redis cannot be reached the oldest updates are dropped
+        # beyond max_pending, and every update is published or dropped
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        closed_port = sock.getsockname()[1]
+        sock.close()
+        publisher = BarPublisher("127.0.0.1", closed_port, max_pending=100, batch_size=30,
+                                 retry_seconds=0.01, max_retry_seconds=0.01)
+        publisher.start()
+        for i in range(1000):
+            publisher.publish("X", BAR)
+            if i % 10 == 9:
+                await asyncio.sleep(0.001)
+        await publisher.close()
+        assert publisher.published == 0 and publisher.dropped == 1000
+        print(f"Redis unreachable: {publisher.published} published, {publisher.dropped} dropped")
+
+    asyncio.run(demo())
@@ -0,0 +1,395 @@
+# Same host fan-out of the live bar updates through shared memory
+import time
+import struct
+import secrets
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+from utils.bar_journal import JOURNAL_DTYPE, RECORD, pack_bar
+
+"""
+bars_daemon publishes every bar update it receives to a ring of fixed width
+records in a multiprocessing.shared_memory segment, and any number of
+strategy processes on the box read them from there, instead of each tailing
+and parsing the JSON lines logs.
+
+    header:  magic b'JRBM', schema version (uint16), number of tickers
+             (uint16), capacity in records (uint32), record size (uint32),
+             instance id (uint64), then at WRITE_SEQ_OFFSET the sequence
+             number of the last record published (uint64) and at
+             CLOSED_OFFSET a flag set when the producer closes (uint64)
+    tickers: MAX_TICKERS names of TICKER_BYTES bytes at TICKERS_OFFSET
+    records: capacity records of BUS_DTYPE at RECORDS_OFFSET, the sequence
+             number, the index of the ticker and the fields of a bar
+             journal record
+
+There is a single producer. Record seq, numbered from 1, is in slot
+(seq - 1) % capacity. The producer clears the seq of the slot, writes the
+record, sets its seq and then publishes it by setting the header write_seq,
+so a reader never sees a record before it is complete.
+
+A reader keeps its own next sequence number, so readers do not know about
+each other and the producer does not wait for them. Records are returned as
+read only NumPy views of the ring, without copying. A reader more than
+capacity records behind has lost the oldest of them, it skips to the oldest
+record still in the ring and counts the ones lost. A view is only valid
+until the producer laps it; lapped() tells, after a batch has been used,
+whether it was overwritten meanwhile.
+
+A producer started again replaces the segment with a new one, with another
+instance id, whether or not the previous producer closed it, e.g. when it
+was killed. A reader with nothing to read checks the segment of the name
+every reattach_seconds and attaches to the new bus, from its start.
+"""
+
+MAGIC = b'JRBM'
+SCHEMA_VERSION = 1
+HEADER = struct.Struct('<4sHHIIQ')
+WRITE_SEQ_OFFSET = 32
+CLOSED_OFFSET = 40
+TICKERS_OFFSET = 64
+MAX_TICKERS = 64
+TICKER_BYTES = 16
+RECORDS_OFFSET = TICKERS_OFFSET + MAX_TICKERS * TICKER_BYTES
+
+BUS_NAME = "jrbot_bars"
+DEFAULT_CAPACITY = 2 ** 16
+REATTACH_SECONDS = 1.0
+
+BUS_DTYPE = np.dtype([('seq', '<u8'), ('ticker', '<u8')] +
+                     [(name, JOURNAL_DTYPE[name]) for name in JOURNAL_DTYPE.names])
+_SEQ = struct.Struct('<Q')
+# The segments created by the writers of this process
+_created = set()
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    """Attach to an existing segment without the resource tracker of this
+    process unlinking it when the process exits"""
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching registers the segment with the
+        # tracker, which is shared with the writer if it is in this process
+        shm = shared_memory.SharedMemory(name)
+        if name not in _created:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+class BarBusWriter:
+    """The producer of a shared memory bar bus."""
+
+    def __init__(self, tickers: list, name: str = BUS_NAME, capacity: int = DEFAULT_CAPACITY):
+        """Constructor, creates the segment, replacing one left by a producer
+        that did not close it
+        Args:
+            tickers (list): The tickers published
+            name (str): The name of the shared memory segment
+            capacity (int): The number of records in the ring
+        """
+        if len(tickers) > MAX_TICKERS:
+            raise ValueError(f"At most {MAX_TICKERS} tickers can be published, got {len(tickers)}")
+        self.tickers = list(tickers)
+        self.name = name
+        self.capacity = capacity
+        self._index = {ticker: i for i, ticker in enumerate(self.tickers)}
+        size = RECORDS_OFFSET + capacity * BUS_DTYPE.itemsize
+        try:
+            self._shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+            self._shm = shared_memory.SharedMemory(name, create=True, size=size)
+        _created.add(name)
+        self._buf = self._shm.buf
+        HEADER.pack_into(self._buf, 0, MAGIC, SCHEMA_VERSION, len(self.tickers), capacity,
+                         BUS_DTYPE.itemsize, secrets.randbits(64))
+        _SEQ.pack_into(self._buf, WRITE_SEQ_OFFSET, 0)
+        _SEQ.pack_into(self._buf, CLOSED_OFFSET, 0)
+        for i, ticker in enumerate(self.tickers):
+            encoded = ticker.encode()
+            if len(encoded) > TICKER_BYTES:
+                raise ValueError(f"Ticker {ticker} is longer than {TICKER_BYTES} bytes")
+            self._buf[TICKERS_OFFSET + i * TICKER_BYTES:TICKERS_OFFSET + (i + 1) * TICKER_BYTES] = \
+                encoded.ljust(TICKER_BYTES, b'\0')
+        self.seq = 0
+
+    def publish(self, ticker: str, bar: dict) -> None:
+        """Publish a bar update, as written to the JSON lines logs"""
+        self.publish_record(ticker, pack_bar(bar))
+
+    def publish_record(self, ticker: str, record: bytes) -> None:
+        """Publish a packed bar journal record"""
+        seq = self.seq + 1
+        offset = RECORDS_OFFSET + ((seq - 1) % self.capacity) * BUS_DTYPE.itemsize
+        _SEQ.pack_into(self._buf, offset, 0)
+        _SEQ.pack_into(self._buf, offset + 8, self._index[ticker])
+        self._buf[offset + 16:offset + 16 + RECORD.size] = record
+        _SEQ.pack_into(self._buf, offset, seq)
+        _SEQ.pack_into(self._buf, WRITE_SEQ_OFFSET, seq)
+        self.seq = seq
+
+    def close(self) -> None:
+        """Tell the readers the producer is gone and remove the segment"""
+        _SEQ.pack_into(self._buf, CLOSED_OFFSET, 1)
+        self._buf = None
+        self._shm.close()
+        self._shm.unlink()
+        _created.discard(self.name)
+
+class BarBusReader:
+    """A consumer of a shared memory bar bus."""
+
+    def __init__(self, name: str = BUS_NAME, from_start: bool = False,
+                 reattach_seconds: float = REATTACH_SECONDS):
+        """Constructor, attaches to the segment
+        Args:
+            name (str): The name of the shared memory segment
+            from_start (bool): Start from the oldest record in the ring
+                rather than the next one published
+            reattach_seconds (float): Seconds between checks for a new bus
+                of a restarted producer while there is nothing to read
+        Raises:
+            FileNotFoundError: If there is no producer
+        """
+        self.name = name
+        self.from_start = from_start
+        self.reattach_seconds = reattach_seconds
+        self.lost = 0
+        self.lapped_batches = 0
+        self.reattached = 0
+        self._next_reattach_check = time.monotonic() + reattach_seconds
+        self._shm = None
+        self._attach()
+
+    def _attach(self) -> None:
+        shm = _attach(self.name)
+        magic, version, num_tickers, capacity, record_size, instance = HEADER.unpack_from(shm.buf, 0)
+        if magic != MAGIC or version != SCHEMA_VERSION or record_size != BUS_DTYPE.itemsize:
+            shm.close()
+            raise ValueError(f"{self.name} is not a bar bus of version {SCHEMA_VERSION}")
+        self.close()
+        self._shm = shm
+        self.capacity = capacity
+        self.instance = instance
+        self.tickers = [bytes(shm.buf[TICKERS_OFFSET + i * TICKER_BYTES:
+                                      TICKERS_OFFSET + (i + 1) * TICKER_BYTES]).rstrip(b'\0').decode()
+                        for i in range(num_tickers)]
+        self._header = np.ndarray((2,), dtype='<u8', buffer=shm.buf, offset=WRITE_SEQ_OFFSET)
+        self.records = np.ndarray((capacity,), dtype=BUS_DTYPE, buffer=shm.buf, offset=RECORDS_OFFSET)
+        self.records.flags.writeable = False
+        write_seq = int(self._header[0])
+        self.next_seq = max(1, write_seq - capacity + 1) if self.from_start else write_seq + 1
+
+    @property
+    def closed(self) -> bool:
+        """True once the producer has closed the bus"""
+        return self._header[1] != 0
+
+    def replaced(self) -> bool:
+        """True if the segment of the name is a new bus, of a producer
+        started again, rather than the one attached"""
+        try:
+            shm = _attach(self.name)
+        except FileNotFoundError:
+            return False
+        magic, _, _, _, _, instance = HEADER.unpack_from(shm.buf, 0)
+        shm.close()
+        # A segment without the magic yet is still being created
+        return magic == MAGIC and instance != self.instance
+
+    def _reattach(self) -> bool:
+        """Attach to the new bus of a restarted producer, checking every
+        reattach_seconds.
+        Returns:
+            bool: True if the reader attached to a new bus
+        """
+        now = time.monotonic()
+        if now < self._next_reattach_check:
+            return False
+        self._next_reattach_check = now + self.reattach_seconds
+        if not self.replaced():
+            return False
+        self.from_start = True
+        self._attach()
+        self.reattached += 1
+        return True
+
+    def read(self, max_records: int = None) -> np.ndarray:
+        """Get the records published since the last read, without waiting.
+        Args:
+            max_records (int): Most records returned, all if None
+        Returns:
+            np.ndarray: A read only view of BUS_DTYPE records of the ring,
+                empty if there are none. Records wrapping around the end of
+                the ring are returned by the next read. After the producer
+                was started again they are the records of its new bus.
+        """
+        while True:
+            write_seq = int(self._header[0])
+            oldest = write_seq - self.capacity + 1
+            if self.next_seq < oldest:
+                self.lost += oldest - self.next_seq
+                self.next_seq = oldest
+            count = write_seq - self.next_seq + 1
+            if count <= 0:
+                if self._reattach():
+                    continue
+                return self.records[:0]
+            slot = (self.next_seq - 1) % self.capacity
+            count = min(count, self.capacity - slot)
+            if max_records is not None:
+                count = min(count, max_records)
+            records = self.records[slot:slot + count]
+            if records['seq'][0] != self.next_seq:
+                # Lapped by the producer since write_seq was read
+                continue
+            self.next_seq += count
+            return records
+
+    def lapped(self, records: np.ndarray) -> bool:
+        """Whether the producer overwrote records returned by read() since,
+        call it once they have been used. The producer writes in order, so
+        it overwrote the first of them before any other."""
+        if len(records) == 0:
+            return False
+        return records['seq'][0] != self.next_seq - len(records)
+
+    def batches(self, max_records: int = None, poll_interval: float = 0.001):
+        """Generate batches of records forever, waiting for new ones. A
+        batch that was lapped while it was used is counted in
+        lapped_batches. When the producer is started again, e.g. bars_daemon
+        is restarted, the reader attaches to the new bus once it exists.
+        Args:
+            max_records (int): Most records per batch
+            poll_interval (float): Seconds between checks for new records
+        """
+        while True:
+            records = self.read(max_records)
+            if len(records) > 0:
+                yield records
+                if self.lapped(records):
+                    self.lapped_batches += 1
+                    print(f"BarBusReader: a batch of {len(records)} records was overwritten while in use")
+                records = None
+                continue
+            records = None
+            time.sleep(poll_interval)
+
+    def ticker_index(self, ticker: str) -> int:
+        """Get the value of the ticker field of a ticker's records"""
+        return self.tickers.index(ticker)
+
+    def close(self) -> None:
+        if self._shm is not None:
+            self.records = None
+            self._header = None
+            try:
+                self._shm.close()
+            except BufferError:
+                # Views of the records are still referenced, the mapping
+                # is released with them
+                pass
+            self._shm = None
+
+
+if __name__ == "__main__":
+
+    # A producer publishes bar updates of a few tickers while several
+    # consumer processes, started like strategies with their own resource
+    # trackers, read them. Compared with each consumer parsing the same
+    # updates from JSON lines.
+    import os
+    import sys
+    import json
+    import subprocess
+    from utils.bars import Bar
+
+    NUM_UPDATES = 200000
+    NUM_CONSUMERS = 4
+    TICKERS = ['ESH24', 'NQH24', 'YMH24', 'RTYH24']
+    BAR = {"High": "38422", "Low": "38417", "Open": "38417", "Close": "38419",
+           "TimeStamp": "2024-02-14T15:49:00Z", "TotalVolume": "86", "DownTicks": 27, "DownVolume": 31,
+           "TotalTicks": 82, "UnchangedTicks": 0, "UnchangedVolume": 0, "UpTicks": 55, "UpVolume": 55,
+           "BarStatus": "Open", "time_received": "2024-02-14 15:48:22.513444"}
+
+    if len(sys.argv) == 3 and sys.argv[1] == "consume":
+        reader = BarBusReader(sys.argv[2])
+        print("ready", flush=True)
+        start = time.process_time()
+        count = 0
+        total = 0.0
+        while count < NUM_UPDATES:
+            records = reader.read()
+            if len(records) == 0:
+                time.sleep(0.0005)
+                continue
+            total += float(records['close'].sum())
+            count += len(records)
+            reader.lapped(records)
+        records = None
+        print(json.dumps([count, reader.lost, time.process_time() - start, total / count]))
+        reader.close()
+        sys.exit(0)
+
+    name = f"jrbot_bars_test_{os.getpid()}"
+    writer = BarBusWriter(TICKERS, name=name, capacity=2 ** 18)
+    parent = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    consumers = [subprocess.Popen([sys.executable, "-m", "utils.shm_bus", "consume", name], cwd=parent,
+                                  stdout=subprocess.PIPE, text=True) for _ in range(NUM_CONSUMERS)]
+    for consumer in consumers:
+        consumer.stdout.readline()
+    records = [pack_bar(dict(BAR, Close=str(38419 + i % 7))) for i in range(NUM_UPDATES)]
+    start = time.perf_counter()
+    for i, record in enumerate(records):
+        writer.publish_record(TICKERS[i % len(TICKERS)], record)
+    elapsed = time.perf_counter() - start
+    print(f"Published {NUM_UPDATES} updates at {NUM_UPDATES / elapsed:,.0f} updates/s")
+    for consumer in consumers:
+        count, lost, cpu, mean = json.loads(consumer.stdout.readline())
+        consumer.wait()
+        assert count == NUM_UPDATES and lost == 0 and abs(mean - (38419 + 3)) < 0.01
+        print(f"Consumer read {count} updates, lost {lost}, mean close {mean:.2f}, "
+              f"{cpu / count * 1e9:.0f} ns CPU per update")
+    writer.close()
+
+    lines = [json.dumps(dict(BAR, Close=str(38419 + i % 7))) for i in range(NUM_UPDATES // 10)]
+    start = time.process_time()
+    total = sum(Bar(line).close for line in lines)
+    cpu = time.process_time() - start
+    print(f"Parsing JSON lines into Bars: {cpu / len(lines) * 1e9:.0f} ns CPU per update and consumer")
+
+    # A reader too far behind skips the lost records
+    writer = BarBusWriter(TICKERS, name=name, capacity=8)
+    reader = BarBusReader(name)
+    for i in range(20):
+        writer.publish_record(TICKERS[0], records[i])
+    first = reader.read()
+    # The records up to the end of the ring, the others in the next read
+    assert list(first['seq']) == list(range(13, 17)) and reader.lost == 12
+    print(f"20 published in a ring of 8: read seq {first['seq'][0]} to {first['seq'][-1]}, lost {reader.lost}")
+    for i in range(8):
+        writer.publish_record(TICKERS[0], records[i])
+    assert reader.lapped(first)
+    print(f"Batch lapped after 8 more: {reader.lapped(first)}")
+    first = None
+    reader.close()
+    writer.close()
+
+    # A producer killed without close() and started again replaces the
+    # segment, the reader moves to the new bus
+    writer = BarBusWriter(TICKERS, name=name, capacity=8)
+    reader = BarBusReader(name, reattach_seconds=0.0)
+    writer.publish_record(TICKERS[0], records[0])
+    assert len(reader.read()) == 1
+    restarted = BarBusWriter(TICKERS[::-1], name=name, capacity=8)
+    for i in range(3):
+        restarted.publish_record(TICKERS[1], records[i])
+    batch = reader.read()
+    assert not reader.closed and reader.reattached == 1
+    assert len(batch) == 3 and reader.tickers[batch['ticker'][0]] == TICKERS[1]
+    print(f"After a restart without close: read {len(batch)} updates of the new bus")
+    batch = None
+    reader.close()
+    writer._buf = None
+    writer._shm.close()
+    restarted.close()
@@ -0,0 +1,495 @@
+# Delta encoded store of the intra-minute bar updates
+import os
+import sys
+import time
+import json
+import struct
+import datetime
+import numpy as np
+from utils.bar_loader import BAR_DTYPE, JSON_KEYS
+from utils.bar_journal import JOURNAL_DTYPE, record_to_bar
+
+"""
+bars_daemon receives many updates of the open bar each minute and most of
+them change a few fields, or only time_received. A snapshot file keeps every
+update but stores only what changed since the previous update of the same
+minute:
+
+    header: magic b'JRBS', schema version (uint16), 2 bytes reserved
+    record: varint mask of the changed fields
+            zigzag varint of the microseconds since the previous time_received
+            zigzag varint delta of each changed field, in FIELDS order
+
+The fields are the TimeStamp of the bar in seconds, is_open, the prices as
+integers of PRICE_SCALE and the volume and tick counts. When the TimeStamp
+changes a new minute starts and the other fields are encoded against zero,
+so the first update of a minute is a key frame a reader can start from.
+Reading reconstructs every update, identical to the journal records, so the
+up ticks of the open bar seen by a strategy are kept.
+
+An update with a price that is not a whole number of 1 / PRICE_SCALE is
+written as a full record instead, with only the RAW_MASK bit in the mask:
+
+    record: varint RAW_MASK
+            zigzag varint of the microseconds since the previous time_received
+            each field in FIELDS order, the prices as little endian doubles
+            and the others as zigzag varints
+
+After it the prices are encoded against zero again.
+
+Records are buffered and group committed like the bar journal. A partially
+written last record is ignored by the reader.
+"""
+
+MAGIC = b'JRBS'
+SCHEMA_VERSION = 1
+HEADER = struct.Struct('<4sH2x')
+PRICE_SCALE = 10000
+PRICE = struct.Struct('<d')
+
+FIELDS = ('timestamp', 'is_open') + tuple(JSON_KEYS)
+_PRICE_FIELDS = ('open', 'high', 'low', 'close')
+_EPOCH = datetime.datetime(1970, 1, 1)
+_ONE_SECOND = datetime.timedelta(seconds=1)
+_ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+RAW_MASK = 1 << len(FIELDS)
+
+def _encode_varint(value: int, out: bytearray) -> None:
+    """Append an unsigned varint, 7 bits per byte, least significant first"""
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def _zigzag(value: int) -> int:
+    """Map a signed integer to an unsigned one, small magnitudes stay small"""
+    return value << 1 if value >= 0 else ((-value) << 1) - 1
+
+def _decode_varint(data: bytes, pos: int) -> tuple:
+    """Get the unsigned varint at pos and the position after it"""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def _bar_to_values(bar: dict) -> tuple:
+    """Get the received time in microseconds and the FIELDS of a bar, as
+    written to the JSON lines logs, as integers, and the prices as floats
+    if one of them is not a whole number of 1 / PRICE_SCALE, else None"""
+    timestamp = datetime.datetime.strptime(bar['TimeStamp'], "%Y-%m-%dT%H:%M:%SZ")
+    time_received = datetime.datetime.fromisoformat(bar['time_received'])
+    values = [(timestamp - _EPOCH) // _ONE_SECOND, int(bar['BarStatus'] == 'Open')]
+    prices = None
+    for name, key in JSON_KEYS.items():
+        if name in _PRICE_FIELDS:
+            scaled = round(float(bar[key]) * PRICE_SCALE)
+            if scaled / PRICE_SCALE != float(bar[key]):
+                prices = tuple(float(bar[JSON_KEYS[price_name]]) for price_name in _PRICE_FIELDS)
+            values.append(scaled)
+        else:
+            values.append(int(bar[key]))
+    if prices is not None:
+        values = [0 if name in _PRICE_FIELDS else value for name, value in zip(FIELDS, values)]
+    return (time_received - _EPOCH) // _ONE_MICROSECOND, values, prices
+
+class SnapshotWriter:
+    """Appends bar updates to a snapshot file with group commit."""
+
+    def __init__(self, filename: str, flush_records: int = 100, flush_ms: float = 250.0):
+        """Constructor
+        Args:
+            filename (str): The snapshot file, created with a header if new.
+                An existing file is read to continue its delta encoding.
+            flush_records (int): Flush once this many records are buffered
+            flush_ms (float): Flush once the oldest buffered record is this old
+        """
+        self.filename = filename
+        self.flush_records = flush_records
+        self.flush_ms = flush_ms
+        self._buffer = bytearray()
+        self._num_buffered = 0
+        self._first_buffered_time = 0.0
+        self._last_received = 0
+        self._last_values = [0] * len(FIELDS)
+        is_new = not os.path.exists(filename) or os.path.getsize(filename) == 0
+        if not is_new:
+            _, end, self._last_received, self._last_values = _decode(_read_file(filename))
+            # Drop a partially written last record before appending
+            with open(filename, 'r+b') as f:
+                f.truncate(end)
+        self._fp = open(filename, 'ab')
+        if is_new:
+            self._fp.write(HEADER.pack(MAGIC, SCHEMA_VERSION))
+            self._fp.flush()
+
+    def write(self, bar: dict) -> None:
+        """Append a bar update, as written to the JSON lines logs.
+        Args:
+            bar (dict): The bar
+        Returns:
+            None
+        """
+        received, values, prices = _bar_to_values(bar)
+        if self._num_buffered == 0:
+            self._first_buffered_time = time.monotonic()
+        if prices is not None:
+            self._write_raw(received, values, prices)
+            return
+        previous = self._last_values
+        if values[0] != previous[0]:
+            # A new minute, encode it against zero
+            previous = [previous[0]] + [0] * (len(FIELDS) - 1)
+        mask = 0
+        deltas = []
+        for i, value in enumerate(values):
+            if value != previous[i]:
+                mask |= 1 << i
+                deltas.append(value - previous[i])
+        _encode_varint(mask, self._buffer)
+        _encode_varint(_zigzag(received - self._last_received), self._buffer)
+        for delta in deltas:
+            _encode_varint(_zigzag(delta), self._buffer)
+        self._last_received = received
+        self._last_values = values
+        self._num_buffered += 1
+        self.maybe_flush()
+
+    def _write_raw(self, received: int, values: list, prices: tuple) -> None:
+        """Append a full record with the prices as doubles, see the module
+        docstring"""
+        _encode_varint(RAW_MASK, self._buffer)
+        _encode_varint(_zigzag(received - self._last_received), self._buffer)
+        prices = iter(prices)
+        for name, value in zip(FIELDS, values):
+            if name in _PRICE_FIELDS:
+                self._buffer += PRICE.pack(next(prices))
+            else:
+                _encode_varint(_zigzag(value), self._buffer)
+        self._last_received = received
+        self._last_values = values
+        self._num_buffered += 1
+        self.maybe_flush()
+
+    def maybe_flush(self) -> None:
+        """Flush if flush_records are buffered or the oldest is flush_ms old.
+        Call this periodically when bars may stop arriving."""
+        if self._num_buffered == 0:
+            return
+        if self._num_buffered >= self.flush_records or \
+                (time.monotonic() - self._first_buffered_time) * 1000.0 >= self.flush_ms:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the buffered records to the file"""
+        if self._num_buffered > 0:
+            self._fp.write(self._buffer)
+            self._fp.flush()
+            self._buffer = bytearray()
+            self._num_buffered = 0
+
+    def close(self) -> None:
+        """Flush and close the file"""
+        self.flush()
+        self._fp.close()
+
+def _read_file(filename: str) -> bytes:
+    """Read a snapshot file, raising ValueError if it is not supported"""
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if len(data) < HEADER.size:
+        raise ValueError(f"{filename} is too short to be a snapshot file")
+    magic, version = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError(f"{filename} is not a snapshot file")
+    if version != SCHEMA_VERSION:
+        raise ValueError(f"{filename} has unsupported schema version {version}")
+    return data
+
+def _decode(data: bytes) -> tuple:
+    """Decode the records of a snapshot file.
+    Returns:
+        tuple: The states as an array of JOURNAL_DTYPE, the offset after
+            the last whole record, and the received time and the FIELDS
+            after it to continue the encoding from
+    """
+    # The field indexes of each mask seen, most updates share a few masks
+    mask_fields = {}
+    rows = []
+    # Row index to the prices of the full records with doubles
+    raw_prices = {}
+    received = 0
+    values = [0] * len(FIELDS)
+    pos = HEADER.size
+    end = pos
+    size = len(data)
+    try:
+        while pos < size:
+            # The fields of a record, the one byte varints inline
+            byte = data[pos]
+            pos += 1
+            if byte < 0x80:
+                mask = byte
+            else:
+                mask = byte & 0x7f
+                shift = 7
+                while True:
+                    byte = data[pos]
+                    pos += 1
+                    mask |= (byte & 0x7f) << shift
+                    if byte < 0x80:
+                        break
+                    shift += 7
+            if mask == RAW_MASK:
+                delta, pos = _decode_varint(data, pos)
+                raw_received = received + (delta >> 1 if not delta & 1 else -((delta + 1) >> 1))
+                raw_values = []
+                prices = []
+                for name in FIELDS:
+                    if name in _PRICE_FIELDS:
+                        prices.append(PRICE.unpack_from(data, pos)[0])
+                        pos += PRICE.size
+                        raw_values.append(0)
+                    else:
+                        value, pos = _decode_varint(data, pos)
+                        raw_values.append(value >> 1 if not value & 1 else -((value + 1) >> 1))
+                received, values = raw_received, raw_values
+                raw_prices[len(rows)] = prices
+                rows.append((values[0], received, *values[1:]))
+                end = pos
+                continue
+            fields = mask_fields.get(mask)
+            if fields is None:
+                fields = tuple(i for i in range(len(FIELDS)) if mask >> i & 1)
+                mask_fields[mask] = fields
+            if mask & 1:
+                values = [values[0]] + [0] * (len(FIELDS) - 1)
+            for i in (-1,) + fields:
+                byte = data[pos]
+                pos += 1
+                if byte < 0x80:
+                    value = byte
+                else:
+                    value = byte & 0x7f
+                    shift = 7
+                    while True:
+                        byte = data[pos]
+                        pos += 1
+                        value |= (byte & 0x7f) << shift
+                        if byte < 0x80:
+                            break
+                        shift += 7
+                delta = value >> 1 if not value & 1 else -((value + 1) >> 1)
+                if i < 0:
+                    received += delta
+                else:
+                    values[i] += delta
+            rows.append((values[0], received, *values[1:]))
+            end = pos
+    except (IndexError, struct.error):
+        # A partially written last record
+        pass
+
+    states = np.empty(len(rows), dtype=JOURNAL_DTYPE)
+    if len(rows) == 0:
+        return states, end, 0, [0] * len(FIELDS)
+    columns = np.array(rows, dtype=np.int64)
+    states['timestamp'] = columns[:, 0].astype('datetime64[s]')
+    states['datetime'] = columns[:, 1].astype('datetime64[us]')
+    states['is_open'] = columns[:, 2] != 0
+    for i, name in enumerate(FIELDS[2:]):
+        states[name] = columns[:, i + 3] / PRICE_SCALE if name in _PRICE_FIELDS else columns[:, i + 3]
+    for row, prices in raw_prices.items():
+        for name, price in zip(_PRICE_FIELDS, prices):
+            states[name][row] = price
+    # The state after the last whole record, a torn one may have changed values
+    return states, end, rows[-1][1], [rows[-1][0]] + list(rows[-1][2:])
+
+def read_snapshots(filename: str, start=None, end=None) -> np.ndarray:
+    """Reconstruct the updates of a snapshot file.
+    Args:
+        filename (str): The snapshot file
+        start: Only the updates of bars with a TimeStamp at or after this,
+            a datetime or a string like '2024-02-14T15:49:00', None for all
+        end: Only the updates of bars with a TimeStamp at or before this
+    Returns:
+        np.ndarray: An array of JOURNAL_DTYPE records, one per update. The
+            BAR_DTYPE fields give utils.bars.Bar with bar_loader.to_bars.
+    """
+    states, _, _, _ = _decode(_read_file(filename))
+    if start is not None:
+        states = states[states['timestamp'] >= np.datetime64(start, 's')]
+    if end is not None:
+        states = states[states['timestamp'] <= np.datetime64(end, 's')]
+    return states
+
+def to_bar_array(states: np.ndarray) -> np.ndarray:
+    """Get the BAR_DTYPE fields of reconstructed updates, as parsed from
+    the JSON lines logs by bar_loader"""
+    bars = np.empty(len(states), dtype=BAR_DTYPE)
+    for name in BAR_DTYPE.names:
+        bars[name] = states[name]
+    return bars
+
+def load_snapshots(bars_dir: str, ticker: str, start, end) -> np.ndarray:
+    """Reconstruct the updates of a ticker over a time range from the daily
+    <bars_dir>/<YYYYMMDD>/<ticker>.snap files written by bars_daemon.
+    Args:
+        bars_dir (str): The bars directory
+        ticker (str): The ticker
+        start (datetime.datetime): The first bar TimeStamp, UTC
+        end (datetime.datetime): The last bar TimeStamp, UTC
+    Returns:
+        np.ndarray: An array of JOURNAL_DTYPE records in time order
+    """
+    # The files are named by the local date the updates were received
+    # and a TimeStamp is within a day of it
+    chunks = []
+    day = start.date() - datetime.timedelta(days=1)
+    while day <= end.date() + datetime.timedelta(days=1):
+        filename = os.path.join(bars_dir, day.strftime("%Y%m%d"), f"{ticker}.snap")
+        if os.path.exists(filename):
+            chunks.append(read_snapshots(filename, start, end))
+        day += datetime.timedelta(days=1)
+    if len(chunks) == 0:
+        return np.empty(0, dtype=JOURNAL_DTYPE)
+    return np.concatenate(chunks)
+
+def jsonl_to_snapshots(jsonl_filename: str, snapshot_filename: str) -> int:
+    """Convert a JSON lines bar log to a snapshot file.
+    Returns:
+        int: The number of bars converted
+    """
+    writer = SnapshotWriter(snapshot_filename, flush_records=10000, flush_ms=float('inf'))
+    count = 0
+    with open(jsonl_filename, 'r') as f:
+        for line in f:
+            if line.strip():
+                bar = json.loads(line)
+                if 'Heartbeat' in bar:
+                    continue
+                writer.write(bar)
+                count += 1
+    writer.close()
+    return count
+
+def snapshots_to_jsonl(snapshot_filename: str, jsonl_filename: str) -> int:
+    """Convert a snapshot file to a JSON lines bar log.
+    Returns:
+        int: The number of bars converted
+    """
+    states = read_snapshots(snapshot_filename)
+    with open(jsonl_filename, 'w') as f:
+        for record in states:
+            f.write(f"{json.dumps(record_to_bar(record))}\n")
+    return len(states)
+
+
+if __name__ == "__main__":
+
+    # Convert between the formats: snapshot_store.py <input> <output>
+    # The direction is chosen from the input file extension. Without
+    # arguments, compare the sizes and replay times of the formats on
+    # generated updates.
+    if len(sys.argv) == 3:
+        if sys.argv[1].endswith('.snap'):
+            print(f"Converted {snapshots_to_jsonl(sys.argv[1], sys.argv[2])} bars")
+        else:
+            print(f"Converted {jsonl_to_snapshots(sys.argv[1], sys.argv[2])} bars")
+        sys.exit(0)
+
+    import random
+    import tempfile
+    from utils.bars import Bar
+    from utils.bar_loader import to_bars
+    from utils.bar_journal import jsonl_to_journal, read_journal
+
+    # About 3 updates a second, half of them with no change but time_received
+    random.seed(1)
+    tmp_dir = tempfile.mkdtemp()
+    jsonl_filename = os.path.join(tmp_dir, "ES.log")
+    received = datetime.datetime(2024, 2, 14, 6, 30)
+    close = 5000.0
+    with open(jsonl_filename, 'w') as f:
+        for minute in range(6 * 60):
+            timestamp = datetime.datetime(2024, 2, 14, 14, 31) + datetime.timedelta(minutes=minute)
+            bar = {'High': close, 'Low': close, 'Open': close, 'Close': close, 'TotalVolume': 0,
+                   'DownTicks': 0, 'DownVolume': 0, 'TotalTicks': 0, 'UnchangedTicks': 0,
+                   'UnchangedVolume': 0, 'UpTicks': 0, 'UpVolume': 0}
+            for update in range(180):
+                received += datetime.timedelta(microseconds=random.randint(200000, 450000))
+                if random.random() < 0.5:
+                    ticks = random.randint(1, 5)
+                    close += random.choice((-0.25, 0, 0.25))
+                    bar['Close'] = close
+                    bar['High'] = max(bar['High'], close)
+                    bar['Low'] = min(bar['Low'], close)
+                    bar['TotalVolume'] += ticks * 3
+                    bar['TotalTicks'] += ticks
+                    bar['UpTicks'] += ticks
+                    bar['UpVolume'] += ticks * 3
+                line = {key: str(value) if key in ('High', 'Low', 'Open', 'Close', 'TotalVolume') else value
+                        for key, value in bar.items()}
+                line = {key: value[:-2] if isinstance(value, str) and value.endswith('.0') else value
+                        for key, value in line.items()}
+                line['TimeStamp'] = timestamp.strftime("%Y-%m-%dT%H:%M:%SZ")
+                line['BarStatus'] = 'Open' if update < 179 else 'Closed'
+                line['time_received'] = received.strftime("%Y-%m-%d %H:%M:%S.%f")
+                f.write(f"{json.dumps(line)}\n")
+
+    snapshot_filename = os.path.join(tmp_dir, "ES.snap")
+    journal_filename = os.path.join(tmp_dir, "ES.bin")
+    count = jsonl_to_snapshots(jsonl_filename, snapshot_filename)
+    jsonl_to_journal(jsonl_filename, journal_filename)
+    for name, filename in (("JSON lines", jsonl_filename), ("journal", journal_filename),
+                           ("snapshots", snapshot_filename)):
+        print(f"{name}: {os.path.getsize(filename) / count:.1f} bytes per update")
+
+    start = time.time()
+    with open(jsonl_filename, 'r') as f:
+        json_bars = [Bar(line) for line in f]
+    print(f"Replay from JSON lines: {len(json_bars)} bars in {time.time() - start:.3f} seconds")
+    start = time.time()
+    snapshot_bars = to_bars(to_bar_array(read_snapshots(snapshot_filename)))
+    print(f"Replay from snapshots: {len(snapshot_bars)} bars in {time.time() - start:.3f} seconds")
+    print(f"Identical: {json_bars == snapshot_bars}")
+    print(f"Identical to the journal: {np.array_equal(read_snapshots(snapshot_filename), read_journal(journal_filename))}")
+
+    # Appending continues the encoding, a torn last record is dropped
+    with open(snapshot_filename, 'ab') as f:
+        f.write(b'\xff')
+    writer = SnapshotWriter(snapshot_filename)
+    with open(jsonl_filename, 'r') as f:
+        for line in f.readlines()[:10]:
+            writer.write(json.loads(line))
+    writer.close()
+    appended = read_snapshots(snapshot_filename)
+    print(f"Appended: {len(appended) == count + 10 and np.array_equal(appended[count:], appended[:10])}")
+    window = read_snapshots(snapshot_filename, '2024-02-14T15:00:00', '2024-02-14T15:04:00')
+    print(f"Updates of 15:00 to 15:04: {len(window)}")
+
+    # Prices finer than 1 / PRICE_SCALE are written as full records, and
+    # the updates after them, also after reopening, are delta encoded again
+    fine_filename = os.path.join(tmp_dir, "EURUSD.snap")
+    with open(jsonl_filename, 'r') as f:
+        lines = [json.loads(line) for line in f.readlines()[:20]]
+    for i in (3, 4, 12):
+        lines[i]['Close'] = lines[i]['Low'] = f"{float(lines[i]['Close']) + 0.000015:.6f}"
+    writer = SnapshotWriter(fine_filename)
+    for line in lines[:10]:
+        writer.write(line)
+    writer.close()
+    writer = SnapshotWriter(fine_filename)
+    for line in lines[10:]:
+        writer.write(line)
+    writer.close()
+    fine = read_snapshots(fine_filename)
+    assert len(fine) == len(lines)
+    assert [float(price) for price in fine['close']] == [float(line['Close']) for line in lines]
+    assert [float(price) for price in fine['low']] == [float(line['Low']) for line in lines]
+    assert np.array_equal(fine['total_volume'], [int(line['TotalVolume']) for line in lines])
+    print(f"Fine prices: {len(fine)} updates in {os.path.getsize(fine_filename) - HEADER.size} bytes")
@@ -0,0 +1,183 @@
+# vectorized.py
+
+from abc import ABCMeta, abstractmethod
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from event import SignalEvent
+from strategy import Strategy
+
+
+class VectorizedStrategy(Strategy):
+    """
+    VectorizedStrategy is an abstract base class for strategies that can
+    run both bar-by-bar through the event queue (calculate_signals) and
+    over a whole range of aligned bars at once (generate_positions).
+
+    generate_positions must be causal, i.e. the position at bar t may only
+    depend on bars 0..t, so that both paths produce the same signals.
+    """
+
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def generate_positions(self, bars):
+        """
+        Calculates the target position for every ticker and bar.
+
+        Parameters:
+        bars - The dict returned by HistoricalDbData.read_aligned_from_dbase().
+
+        Returns:
+        A 2-D array of shape (tickers, datetimes) holding 1 (long),
+        -1 (short), 0 (flat) or NaN where the ticker has no bar.
+        """
+        raise NotImplementedError("Should implement generate_positions()")
+
+
+class MovingAverageCrossStrategy(VectorizedStrategy):
+    """
+    Goes long when the fast simple moving average of the close is above
+    the slow one, and is flat otherwise. Each ticker is evaluated on its
+    own bars only, so minutes where a ticker has no bar are skipped.
+    """
+
+    def __init__(self, bars, events, fast=20, slow=50, strategy_id='ma_cross'):
+        """
+        Initialises the strategy.
+
+        Parameters:
+        bars - The DataHandler object that provides bar information.
+        events - The Event Queue object.
+        fast - The fast moving average lookback.
+        slow - The slow moving average lookback.
+        strategy_id - The id put on the SignalEvents.
+        """
+        self.bars = bars
+        self.events = events
+        self.fast = fast
+        self.slow = slow
+        self.strategy_id = strategy_id
+        self.positions = {}
+
+    def calculate_signals(self, event):
+        """
+        Bar-by-bar path, called for every MarketEvent. Emits a 'LONG'
+        SignalEvent when entering and an 'EXIT' SignalEvent when leaving.
+        Only the tickers with a new bar in the event are evaluated.
+        """
+        if event.type != 'MARKET':
+            return
+        for ticker in event.tickers:
+            closes = self.bars.get_latest_bars_values(ticker, 'close', self.slow)
+            if len(closes) < self.slow:
+                continue
+            position = 1 if closes[-self.fast:].mean() > closes.mean() else 0
+            if position != self.positions.get(ticker, 0):
+                signal_type = 'LONG' if position == 1 else 'EXIT'
+                dt = self.bars.get_latest_bar_datetime(ticker)
+                self.events.put(SignalEvent(self.strategy_id, ticker, dt, signal_type, 1.0))
+                self.positions[ticker] = position
+
+    def generate_positions(self, bars):
+        """
+        Vectorized path, see VectorizedStrategy.generate_positions().
+        """
+        close = bars['close']
+        positions = np.full(close.shape, np.nan)
+        for k in range(close.shape[0]):
+            valid = np.flatnonzero(~np.isnan(close[k]))
+            closes = close[k, valid]
+            if len(closes) < self.slow:
+                positions[k, valid] = 0
+                continue
+            slow_ma = sliding_window_view(closes, self.slow).mean(axis=-1)
+            fast_ma = sliding_window_view(closes[self.slow - self.fast:], self.fast).mean(axis=-1)
+            ticker_positions = np.zeros(len(closes))
+            ticker_positions[self.slow - 1:] = (fast_ma > slow_ma).astype(np.float64)
+            positions[k, valid] = ticker_positions
+        return positions
+
+
+class VectorizedBacktest(object):
+    """
+    Runs a VectorizedStrategy over the whole range of aligned bars in
+    one pass, as an alternative to replaying HistoricalDbData bar by bar.
+
+    Trades are entered and exited at the close of the bar where the
+    position changes, matching a market order filled on that bar in the
+    event-driven path.
+    """
+
+    def __init__(self, bars, strategy):
+        """
+        Parameters:
+        bars - The dict returned by HistoricalDbData.read_aligned_from_dbase().
+        strategy - A VectorizedStrategy object.
+        """
+        self.bars = bars
+        self.strategy = strategy
+
+    @staticmethod
+    def _ffill(arr):
+        """Forward fills NaN along the time axis, leading NaN become 0."""
+        idx = np.where(np.isnan(arr), 0, np.arange(arr.shape[1]))
+        np.maximum.accumulate(idx, axis=1, out=idx)
+        filled = arr[np.arange(arr.shape[0])[:, None], idx]
+        return np.nan_to_num(filled, nan=0.0)
+
+    def run(self):
+        """
+        Runs the backtest.
+
+        Returns:
+        A dict of ticker to a dict with 'entries' and 'exits' (indices into
+        bars['datetime']), 'positions' (the position held after each bar),
+        'pnl' (the per bar profit, in points),
+        'total_profit' and 'num_trades'.
+        """
+        positions = self._ffill(self.strategy.generate_positions(self.bars))
+        close = self._ffill(self.bars['close'])
+
+        # Position changes, the position before the first bar is flat
+        previous = np.zeros_like(positions)
+        previous[:, 1:] = positions[:, :-1]
+        changes = positions != previous
+
+        # Profit of each bar comes from the position held over the previous bar
+        pnl = np.zeros_like(close)
+        pnl[:, 1:] = previous[:, 1:] * np.diff(close, axis=1)
+
+        results = {}
+        for k, ticker in enumerate(self.bars['tickers']):
+            entries = np.flatnonzero(changes[k] & (positions[k] != 0))
+            exits = np.flatnonzero(changes[k] & (previous[k] != 0))
+            results[ticker] = {
+                'entries': entries,
+                'exits': exits,
+                'positions': positions[k],
+                'pnl': pnl[k],
+                'total_profit': pnl[k].sum(),
+                'num_trades': len(entries),
+            }
+        return results
+
+    def signal_events(self, results=None):
+        """
+        Converts the entries and exits into the SignalEvents the
+        event-driven path would have put on the queue, in time order.
+        Useful for checking both paths agree.
+        """
+        if results is None:
+            results = self.run()
+        strategy_id = getattr(self.strategy, 'strategy_id', None)
+        signals = []
+        for ticker, result in results.items():
+            for i in result['exits']:
+                signals.append((i, 0, ticker, 'EXIT'))
+            for i in result['entries']:
+                signal_type = 'LONG' if result['positions'][i] > 0 else 'SHORT'
+                signals.append((i, 1, ticker, signal_type))
+        signals.sort(key=lambda s: (s[0], s[2], s[1]))
+        return [SignalEvent(strategy_id, ticker, self.bars['datetime'][i], signal_type, 1.0)
+                for i, _, ticker, signal_type in signals]